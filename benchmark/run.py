@@ -0,0 +1,489 @@
+"""
+End-to-end crawl benchmark. We serve up a synthetic web (see
+:py:mod:`benchmark.synthetic_web`), start the real web API
+(``txserver.tac``) and some workers (``txclient.tac``) with ``twistd``,
+submit a job seeded with each host's first page, and wait for it to finish.
+Then we print what we saw as JSON, so runs can be compared::
+
+    PYTHONPATH=. python -m benchmark.run --workers 2 --hosts 8 > before.json
+
+Everything talks to the Redis given by the usual settings (see
+:py:mod:`crawler.conf`), which should be a local one you don't mind us
+writing to. Each run's pages get their own URLs, so runs don't share page
+cache entries.
+
+Any of the crawler's settings can be set in the environment as usual, and
+get passed along to the services. A few are given benchmark-friendly
+defaults (see ``SERVICE_ENV_DEFAULTS``) unless they've been set already.
+"""
+
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from StringIO import StringIO
+
+import txredisapi
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web.client import Agent, FileBodyProducer, readBody
+
+from benchmark.synthetic_web import SiteGraph, start_synthetic_web
+from crawler.conf import REDIS_HOST, REDIS_PORT
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEB_API_TAC = os.path.join(
+    REPO_ROOT, 'crawler', 'webapi_service', 'txserver.tac')
+WORKER_TAC = os.path.join(
+    REPO_ROOT, 'crawler', 'crawler_worker', 'txclient.tac')
+
+# Our synthetic hosts are all local, and we want to see how fast the
+# crawler can go rather than how polite it is.
+SERVICE_ENV_DEFAULTS = {
+    'HOST_REQUESTS_PER_SECOND': '0',
+    'HOST_MAX_CONNECTIONS': '0',
+    'CRAWL_RETRY_BASE_DELAY': '0.1',
+}
+# How often we check on the job.
+POLL_INTERVAL = 0.5
+# How long the services get to start up.
+STARTUP_TIMEOUT = 30
+# How long the services get to shut down before we kill them.
+SHUTDOWN_TIMEOUT = 10
+
+
+def get_args(argv):
+    parser = argparse.ArgumentParser(
+        description="Crawls a synthetic web with the real services and "
+                    "reports how it went, as JSON.")
+    add = parser.add_argument
+    add('--workers', type=int, default=2, help="Worker processes to start.")
+    add('--hosts', type=int, default=8, help="Synthetic hosts to serve.")
+    add('--pages-per-host', type=int, default=200)
+    add('--fan-out', type=int, default=10, help="Links per page.")
+    add('--images', type=int, default=5, help="Images per page.")
+    add('--page-size', type=int, default=20000, help="Bytes per page.")
+    add('--cross-host-ratio', type=float, default=0.1,
+        help="The share of links that go to another host.")
+    add('--max-depth', type=int, default=3,
+        help="How many links deep to crawl from each host's first page.")
+    add('--slow-hosts', type=int, default=0,
+        help="How many hosts wait --slow-delay seconds before answering.")
+    add('--slow-delay', type=float, default=0.5)
+    add('--failing-hosts', type=int, default=0,
+        help="How many hosts answer --failure-rate of requests with a 503.")
+    add('--failure-rate', type=float, default=0.2)
+    add('--seed', type=int, default=0, help="Seeds the site graph.")
+    add('--timeout', type=float, default=300,
+        help="Seconds to wait for the job before giving up on it.")
+    add('--base-port', type=int, default=18000,
+        help="The services listen on ports counting up from this one.")
+    add('--log-dir', help="Where the services' logs go. Created if it "
+                          "doesn't exist. Defaults to a new temporary "
+                          "directory.")
+    add('--output', default='-', help="Where the results go. '-' (the "
+                                      "default) is stdout.")
+    return parser.parse_args(argv)
+
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+class ServiceProcess(object):
+    """
+    One of the crawler's ``.tac`` files, running under ``twistd``.
+    """
+
+    def __init__(self, name, tac_path, env, log_dir, http_port):
+        """
+        :param str name: What to call it in the results.
+        :param str tac_path: The ``.tac`` file to run.
+        :param dict env: Its environment.
+        :param str log_dir: Its log goes in here, as ``<name>.log``.
+        :param int http_port: Where its /metrics is served.
+        """
+
+        self.name = name
+        self.http_port = http_port
+        self.log_path = os.path.join(log_dir, '%s.log' % name)
+        self.process = subprocess.Popen(
+            [sys.executable, '-c',
+             'from twisted.scripts.twistd import run; run()',
+             '--nodaemon', '--pidfile=', '--logfile', self.log_path,
+             '--python', tac_path],
+            cwd=REPO_ROOT, env=env)
+
+    @inlineCallbacks
+    def get_metrics(self):
+        """
+        :rtype: str
+        :returns: The text of its /metrics.
+        """
+
+        response = yield Agent(reactor).request(
+            'GET', 'http://127.0.0.1:%d/metrics' % self.http_port)
+        body = yield readBody(response)
+        if response.code != 200:
+            raise RuntimeError("%s's /metrics gave us a %d." % (
+                self.name, response.code))
+        returnValue(body)
+
+    @inlineCallbacks
+    def wait_until_up(self):
+        started_at = time.time()
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("%s exited, see %s" % (
+                    self.name, self.log_path))
+            try:
+                yield self.get_metrics()
+            except Exception:
+                if time.time() - started_at > STARTUP_TIMEOUT:
+                    raise RuntimeError("%s didn't come up, see %s" % (
+                        self.name, self.log_path))
+                yield sleep(0.2)
+            else:
+                return
+
+    def get_peak_rss(self):
+        """
+        :rtype: int
+        :returns: The most memory it's had resident, in bytes, or None if
+            we can't tell (we need Linux's /proc).
+        """
+
+        try:
+            with open('/proc/%d/status' % self.process.pid) as status_file:
+                for line in status_file:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+        return None
+
+    def stop(self):
+        if self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        stop_by = time.time() + SHUTDOWN_TIMEOUT
+        while self.process.poll() is None and time.time() < stop_by:
+            time.sleep(0.1)
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def get_service_env(args):
+    """
+    :rtype: dict
+    :returns: The environment the services have in common.
+    """
+
+    env = dict(os.environ)
+    for name, value in SERVICE_ENV_DEFAULTS.items():
+        env.setdefault(name, value)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [REPO_ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    env['MAX_CRAWL_DEPTH'] = str(args.max_depth)
+    env['WEB_API_PORT'] = str(args.base_port)
+    env['ZMQ_BROADCAST_BIND'] = 'tcp://127.0.0.1:%d' % (args.base_port + 50)
+    env['ZMQ_REPEATER_BIND'] = 'tcp://127.0.0.1:%d' % (args.base_port + 51)
+    env['ZMQ_PUSHERS'] = env['ZMQ_BROADCAST_BIND']
+    env['ZMQ_REPEATERS'] = env['ZMQ_REPEATER_BIND']
+    # Each worker gets its own peer port; they're all listed here.
+    env['CRAWLER_PEERS'] = ','.join(
+        'tcp://127.0.0.1:%d' % (args.base_port + 100 + i)
+        for i in range(args.workers))
+    return env
+
+
+def start_services(args, log_dir):
+    """
+    :rtype: tuple
+    :returns: The web API's :py:class:`ServiceProcess`, and a list of the
+        workers'.
+    """
+
+    env = get_service_env(args)
+    web_api = ServiceProcess('web_api', WEB_API_TAC, env, log_dir,
+                             args.base_port)
+    workers = []
+    for i in range(args.workers):
+        worker_env = dict(env)
+        worker_env['CRAWLER_METRICS_PORT'] = str(args.base_port + 70 + i)
+        worker_env['CRAWLER_PEER_BIND'] = \
+            'tcp://127.0.0.1:%d' % (args.base_port + 100 + i)
+        workers.append(ServiceProcess(
+            'worker_%d' % i, WORKER_TAC, worker_env, log_dir,
+            args.base_port + 70 + i))
+    return web_api, workers
+
+
+@inlineCallbacks
+def get_redis_command_count(conn):
+    """
+    :rtype: int
+    :returns: How many commands Redis has run since it started.
+    """
+
+    info = yield conn.execute_command('INFO', 'stats')
+    for line in info.splitlines():
+        if line.startswith('total_commands_processed:'):
+            returnValue(int(line.split(':')[1]))
+    raise RuntimeError("Redis didn't tell us how many commands it has run.")
+
+
+def parse_histogram(metrics_text, name):
+    """
+    :param str metrics_text: A /metrics page.
+    :param str name: A histogram's name.
+    :rtype: dict
+    :returns: Bucket upper bound -> cumulative count, added up over every
+        set of labels.
+    """
+
+    buckets = {}
+    prefix = name + '_bucket{'
+    for line in metrics_text.splitlines():
+        if not line.startswith(prefix):
+            continue
+        labels, count = line[len(prefix):].rsplit('} ', 1)
+        bound = labels.split('le="')[1].split('"')[0]
+        bound = float('inf') if bound == '+Inf' else float(bound)
+        buckets[bound] = buckets.get(bound, 0) + int(count)
+    return buckets
+
+
+def parse_counter(metrics_text, name, label_name=None):
+    """
+    :param str metrics_text: A /metrics page.
+    :param str name: A counter's name.
+    :param str label_name: If given, break the count down by this label.
+    :returns: The count, or a dict of label value -> count.
+    """
+
+    values = {}
+    for line in metrics_text.splitlines():
+        if not (line.startswith(name + ' ') or line.startswith(name + '{')):
+            continue
+        series, value = line.rsplit(' ', 1)
+        key = None
+        if label_name and '%s="' % label_name in series:
+            key = series.split('%s="' % label_name)[1].split('"')[0]
+        values[key] = values.get(key, 0) + float(value)
+    if label_name:
+        return values
+    return values.get(None, 0)
+
+
+def get_quantile(buckets, quantile):
+    """
+    Estimates a quantile from a histogram's buckets, the same way
+    Prometheus' ``histogram_quantile()`` does.
+
+    :param dict buckets: As from :py:func:`parse_histogram`.
+    :param float quantile: Between 0 and 1.
+    :rtype: float
+    """
+
+    bounds = sorted(buckets)
+    if not bounds or not buckets[bounds[-1]]:
+        return None
+    rank = quantile * buckets[bounds[-1]]
+    lower_bound = lower_count = 0
+    for bound in bounds:
+        count = buckets[bound]
+        if count >= rank:
+            if bound == float('inf'):
+                # All we know is that it's past the last real bucket.
+                return lower_bound
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * \
+                (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return lower_bound
+
+
+@inlineCallbacks
+def submit_job(args, urls):
+    """
+    :rtype: str
+    :returns: The new job's ID.
+    """
+
+    response = yield Agent(reactor).request(
+        'POST', 'http://127.0.0.1:%d/?format=lines&max_depth=%d' % (
+            args.base_port, args.max_depth),
+        None, FileBodyProducer(StringIO('\n'.join(urls))))
+    body = yield readBody(response)
+    if response.code != 200:
+        raise RuntimeError("Job submission failed (%d): %s" % (
+            response.code, body))
+    returnValue(str(json.loads(body)['id']))
+
+
+@inlineCallbacks
+def get_job_summary(args, job_id):
+    response = yield Agent(reactor).request(
+        'GET', 'http://127.0.0.1:%d/job/%s?summary=1' % (
+            args.base_port, job_id))
+    body = yield readBody(response)
+    returnValue(json.loads(body))
+
+
+def is_job_finished(summary):
+    if summary.get('archived'):
+        return True
+    return not summary.get('ingesting') and \
+        summary['crawls_pending_count'] == 0 and \
+        summary['crawls_in_progress_count'] == 0
+
+
+@inlineCallbacks
+def wait_for_job(args, job_id, started_at):
+    """
+    :rtype: tuple
+    :returns: The job's last summary, and whether it finished in time.
+    """
+
+    while True:
+        summary = yield get_job_summary(args, job_id)
+        if is_job_finished(summary):
+            returnValue((summary, True))
+        if time.time() - started_at > args.timeout:
+            returnValue((summary, False))
+        yield sleep(POLL_INTERVAL)
+
+
+@inlineCallbacks
+def run_benchmark(args, log_dir):
+    """
+    :rtype: dict
+    :returns: The results.
+    """
+
+    run_id = uuid.uuid4().hex[:8]
+    graph = SiteGraph(
+        run_id, args.hosts, args.pages_per_host, args.fan_out, args.images,
+        args.page_size, args.cross_host_ratio, args.seed)
+    hosts = start_synthetic_web(
+        graph, args.slow_hosts, args.slow_delay, args.failing_hosts,
+        args.failure_rate)
+
+    web_api, workers = start_services(args, log_dir)
+    services = [web_api] + workers
+    try:
+        for service in services:
+            yield service.wait_until_up()
+
+        redis_conn = yield txredisapi.Connection(REDIS_HOST, REDIS_PORT)
+        commands_before = yield get_redis_command_count(redis_conn)
+        started_at = time.time()
+        job_id = yield submit_job(args, graph.get_seed_urls())
+        summary, finished = yield wait_for_job(args, job_id, started_at)
+        elapsed = time.time() - started_at
+        commands = (yield get_redis_command_count(redis_conn)) - \
+            commands_before
+        yield redis_conn.disconnect()
+
+        latency_buckets = {}
+        crawls = {}
+        retries = 0
+        for worker in workers:
+            metrics_text = yield worker.get_metrics()
+            for bound, count in parse_histogram(
+                    metrics_text, 'crawler_crawl_seconds').items():
+                latency_buckets[bound] = latency_buckets.get(bound, 0) + count
+            for outcome, count in parse_counter(
+                    metrics_text, 'crawler_crawls_total', 'outcome').items():
+                crawls[outcome] = crawls.get(outcome, 0) + int(count)
+            retries += int(parse_counter(
+                metrics_text, 'crawler_fetch_retries_total'))
+
+        rss = dict((service.name, service.get_peak_rss())
+                   for service in services)
+    finally:
+        for service in services:
+            service.stop()
+
+    completed = summary['crawls_completed_count']
+    failed = summary['crawls_failed_count']
+    results = {
+        'run_id': run_id,
+        'job_id': job_id,
+        'finished': finished,
+        'options': vars(args),
+        'environment': dict(
+            (name, get_service_env(args)[name])
+            for name in sorted(SERVICE_ENV_DEFAULTS)),
+        'elapsed_seconds': elapsed,
+        'pages_completed': completed,
+        'pages_failed': failed,
+        'images_found': summary['images_count'],
+        'pages_per_second': completed / elapsed if elapsed else None,
+        'crawl_latency_seconds': {
+            'count': int(latency_buckets.get(float('inf'), 0)),
+            'p50': get_quantile(latency_buckets, 0.5),
+            'p99': get_quantile(latency_buckets, 0.99),
+        },
+        'crawls': crawls,
+        'fetch_retries': retries,
+        'requests_served': sum(host.requests for host in hosts),
+        # This includes the summaries we poll for, a few per second.
+        'redis_commands': commands,
+        'redis_commands_per_page':
+            float(commands) / (completed + failed)
+            if completed + failed else None,
+        'peak_rss_bytes': {
+            'web_api': rss['web_api'],
+            'workers': [rss[worker.name] for worker in workers],
+            # ru_maxrss is in kilobytes on Linux.
+            'benchmark': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * 1024,
+        },
+        'log_dir': log_dir,
+    }
+    returnValue(results)
+
+
+def main(argv=None):
+    args = get_args(sys.argv[1:] if argv is None else argv)
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='crawler-benchmark-')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+    outcome = {}
+
+    @inlineCallbacks
+    def run():
+        try:
+            outcome['results'] = yield run_benchmark(args, log_dir)
+        except Exception as exc:
+            outcome['error'] = exc
+        finally:
+            reactor.stop()
+
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+    if 'error' in outcome:
+        sys.stderr.write("Benchmark failed: %s\n" % outcome['error'])
+        return 1
+    results_json = json.dumps(outcome['results'], indent=2, sort_keys=True)
+    if args.output == '-':
+        print results_json
+    else:
+        with open(args.output, 'w') as output_file:
+            output_file.write(results_json + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
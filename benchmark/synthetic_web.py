@@ -0,0 +1,174 @@
+"""
+A made-up web for the crawler to chew on. Each "host" is a Twisted web
+server on its own local port (the crawler's politeness limits go by host
+and port), serving pages generated on the fly from a seeded graph, so the
+same options always give the same site.
+
+Page URLs look like ``http://127.0.0.1:<port>/<run_id>/p/<n>``. The run ID
+keeps one run's pages out of another's page cache entries.
+"""
+
+import random
+
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+from twisted.web.server import Site, NOT_DONE_YET
+
+
+class SiteGraph(object):
+    """
+    Which pages link to which, and what's on them. Nothing is stored; each
+    page is worked out from the seed whenever it's asked for.
+    """
+
+    def __init__(self, run_id, hosts, pages_per_host, fan_out, image_count,
+                 page_size, cross_host_ratio=0.1, seed=0):
+        """
+        :param str run_id: Goes at the start of every path.
+        :param int hosts: How many hosts there are.
+        :param int pages_per_host: How many pages each host has.
+        :param int fan_out: How many links each page has.
+        :param int image_count: How many <img> tags each page has.
+        :param int page_size: Roughly how many bytes each page is. Pages are
+            padded out to this if their links and images come up short.
+        :param float cross_host_ratio: The share of links that go to some
+            other host.
+        :param int seed: Seeds the graph.
+        """
+
+        self.run_id = run_id
+        self.hosts = hosts
+        self.pages_per_host = pages_per_host
+        self.fan_out = fan_out
+        self.image_count = image_count
+        self.page_size = page_size
+        self.cross_host_ratio = cross_host_ratio
+        self.seed = seed
+        # Filled in once the hosts are listening.
+        self.ports = []
+
+    def get_url(self, host_index, page_index):
+        return 'http://127.0.0.1:%d/%s/p/%d' % (
+            self.ports[host_index], self.run_id, page_index)
+
+    def get_seed_urls(self):
+        """
+        :rtype: list
+        :returns: Each host's first page.
+        """
+
+        return [self.get_url(host_index, 0)
+                for host_index in range(self.hosts)]
+
+    def render_page(self, host_index, page_index):
+        """
+        :rtype: str
+        :returns: The page's HTML.
+        """
+
+        rng = random.Random(hash((self.seed, host_index, page_index)))
+        parts = ['<html><head><title>Page %d</title></head><body>' % (
+            page_index)]
+        for image_index in range(self.image_count):
+            parts.append('<img src="/%s/i/%d-%d.png">' % (
+                self.run_id, page_index, image_index))
+        for _ in range(self.fan_out):
+            if self.hosts > 1 and rng.random() < self.cross_host_ratio:
+                link_host = rng.randrange(self.hosts)
+            else:
+                link_host = host_index
+            parts.append('<a href="%s">link</a>' % self.get_url(
+                link_host, rng.randrange(self.pages_per_host)))
+        body = ''.join(parts)
+        padding = self.page_size - len(body) - len('</body></html>')
+        if padding > 0:
+            body += '<p>%s</p>' % ('x' * max(0, padding - 7))
+        return body + '</body></html>'
+
+
+class SyntheticHostResource(Resource):
+    """
+    One host's pages. Anything that isn't one of its pages is a 404.
+    """
+
+    isLeaf = True
+
+    def __init__(self, graph, host_index, delay=0, failure_rate=0):
+        """
+        :param SiteGraph graph: The graph the pages come from.
+        :param int host_index: Which of the graph's hosts this is.
+        :param float delay: Seconds to wait before answering.
+        :param float failure_rate: The share of requests answered with a
+            503, which the crawler retries.
+        """
+
+        Resource.__init__(self)
+
+        self.graph = graph
+        self.host_index = host_index
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.requests = 0
+
+    def render_GET(self, request):
+        self.requests += 1
+        if self.delay:
+            call = reactor.callLater(self.delay, self._respond, request)
+            request.notifyFinish().addErrback(lambda _: call.cancel())
+            return NOT_DONE_YET
+        return self._get_response(request)
+
+    def _respond(self, request):
+        request.write(self._get_response(request))
+        request.finish()
+
+    def _get_response(self, request):
+        if self.failure_rate and random.random() < self.failure_rate:
+            request.setResponseCode(503)
+            return 'Try again later.'
+
+        page_index = self._get_page_index(request.postpath)
+        if page_index is None:
+            request.setResponseCode(404)
+            return 'No such page.'
+        request.setHeader('Content-Type', 'text/html; charset=utf-8')
+        return self.graph.render_page(self.host_index, page_index)
+
+    def _get_page_index(self, path):
+        if len(path) != 3 or path[0] != self.graph.run_id or path[1] != 'p':
+            return None
+        try:
+            page_index = int(path[2])
+        except ValueError:
+            return None
+        if not 0 <= page_index < self.graph.pages_per_host:
+            return None
+        return page_index
+
+
+def start_synthetic_web(graph, slow_hosts=0, slow_delay=0, failing_hosts=0,
+                        failure_rate=0):
+    """
+    Starts listening for each of the graph's hosts. The first ``slow_hosts``
+    hosts are slow, and the next ``failing_hosts`` fail some of the time.
+
+    :param SiteGraph graph: The graph to serve.
+    :rtype: list
+    :returns: The hosts' :py:class:`SyntheticHostResource` instances.
+    """
+
+    resources = []
+    for host_index in range(graph.hosts):
+        delay = rate = 0
+        if host_index < slow_hosts:
+            delay = slow_delay
+        elif host_index < slow_hosts + failing_hosts:
+            rate = failure_rate
+        resource = SyntheticHostResource(graph, host_index, delay, rate)
+        site = Site(resource)
+        site.noisy = False
+        site.log = lambda request: None
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        graph.ports.append(port.getHost().port)
+        resources.append(resource)
+    return resources
@@ -7,6 +7,20 @@ don't have time to adjust.
 """
 
 import os
+import socket
+
+
+def _get_list(env_var, default):
+    """
+    :param str env_var: An env var holding a comma-separated list.
+    :param str default: Used if the env var isn't set.
+    :rtype: list
+    :returns: The list's (stripped, non-empty) members.
+    """
+
+    value = os.environ.get(env_var, default)
+    return [member.strip() for member in value.split(',') if member.strip()]
+
 
 REDIS_HOST = os.environ.get('REDIS_1_PORT_6379_TCP_ADDR', '127.0.0.1')
 REDIS_PORT = int(os.environ.get('REDIS_1_PORT_6379_TCP_PORT', 6379))
@@ -15,5 +29,259 @@ ZMQ_PUSHER = os.environ.get('WEB_1_PORT_8050_TCP', 'tcp://127.0.0.1:8050')
 
 ZMQ_REPEATER = os.environ.get('WEB_1_PORT_8051_TCP', 'tcp://127.0.0.1:8051')
 
-MAX_CRAWL_DEPTH = 1
+# You can run as many web API instances (brokers) as you'd like. Workers
+# connect to all of them, pulling work from each and spreading delegated
+# links across their repeaters.
+ZMQ_PUSHERS = _get_list('ZMQ_PUSHERS', ZMQ_PUSHER)
+ZMQ_REPEATERS = _get_list('ZMQ_REPEATERS', ZMQ_REPEATER)
+
+# Where a web API instance listens. Change these to run more than one
+# instance on the same host.
+WEB_API_PORT = int(os.environ.get('WEB_API_PORT', 8000))
+ZMQ_BROADCAST_BIND = os.environ.get('ZMQ_BROADCAST_BIND', 'tcp://0.0.0.0:8050')
+ZMQ_REPEATER_BIND = os.environ.get('ZMQ_REPEATER_BIND', 'tcp://0.0.0.0:8051')
+
+# How crawl announcements get from the web API to the workers. 'zeromq' is
+# fast but forgets everything on restart. 'redis_streams' uses a Redis
+# Stream with a consumer group, so unacknowledged work survives restarts and
+# gets picked back up if a worker dies.
+QUEUE_BACKEND = os.environ.get('QUEUE_BACKEND', 'zeromq')
+REDIS_STREAM_KEY = os.environ.get('REDIS_STREAM_KEY', 'crawl-queue')
+REDIS_STREAM_GROUP = os.environ.get('REDIS_STREAM_GROUP', 'crawlers')
+# Each worker needs a name that's unique within the consumer group.
+REDIS_STREAM_CONSUMER = os.environ.get(
+    'REDIS_STREAM_CONSUMER', '%s-%d' % (socket.gethostname(), os.getpid()))
+# Most entries (crawl batches) a worker reads per XREADGROUP, and how long
+# (in ms) the read blocks waiting for new ones.
+REDIS_STREAM_READ_COUNT = int(os.environ.get('REDIS_STREAM_READ_COUNT', 4))
+REDIS_STREAM_BLOCK_MS = int(os.environ.get('REDIS_STREAM_BLOCK_MS', 2000))
+# Entries that have gone this long (in ms) without being acknowledged are
+# assumed to belong to a dead worker, and get claimed by someone else. We
+# check for them every REDIS_STREAM_CLAIM_INTERVAL seconds. A live worker
+# resets the idle time of the entries it's still crawling three times per
+# REDIS_STREAM_CLAIM_IDLE_MS, so slow crawls don't get claimed out from under
+# it.
+REDIS_STREAM_CLAIM_IDLE_MS = int(
+    os.environ.get('REDIS_STREAM_CLAIM_IDLE_MS', 5 * 60 * 1000))
+REDIS_STREAM_CLAIM_INTERVAL = int(
+    os.environ.get('REDIS_STREAM_CLAIM_INTERVAL', 30))
+# Approximate cap on the stream's length, in case nobody is consuming.
+REDIS_STREAM_MAXLEN = int(os.environ.get('REDIS_STREAM_MAXLEN', 1000000))
+
+# How workers hand off the links they find. 'broker' sends them back through
+# a web API instance's repeater. 'peer' pushes them straight to other workers
+# (CRAWLER_PEERS), each of which also listens on CRAWLER_PEER_BIND, so
+# delegated work never hops through a broker.
+CRAWLER_DELEGATION_MODE = os.environ.get('CRAWLER_DELEGATION_MODE', 'broker')
+CRAWLER_PEER_BIND = os.environ.get('CRAWLER_PEER_BIND', 'tcp://0.0.0.0:8060')
+CRAWLER_PEERS = _get_list('CRAWLER_PEERS', '')
+
+# How many links deep we'll follow from a job's seeds. Jobs can ask for less
+# (with max_depth), but never more.
+MAX_CRAWL_DEPTH = int(os.environ.get('MAX_CRAWL_DEPTH', 1))
 CRAWLER_USER_AGENT = "gtaylor's dockerized crawler 1.0"
+
+# Each worker keeps one HTTP connection pool around for all of its crawls.
+# Since most links we follow stay on the same host, re-using connections
+# saves us a TCP (and possibly TLS) handshake per fetch.
+HTTP_POOL_MAX_PERSISTENT_PER_HOST = int(
+    os.environ.get('HTTP_POOL_MAX_PERSISTENT_PER_HOST', 4))
+# Seconds an idle cached connection is kept open before we close it.
+HTTP_POOL_IDLE_TIMEOUT = int(os.environ.get('HTTP_POOL_IDLE_TIMEOUT', 30))
+
+# The most crawls a single worker will have going at once. Anything beyond
+# this waits in a small local backlog, and we don't ask for more work until
+# we catch up, so idle workers get a shot at it instead.
+CRAWLER_MAX_IN_FLIGHT = int(os.environ.get('CRAWLER_MAX_IN_FLIGHT', 16))
+# Brokers only send a worker crawl batches it has asked for. Once it has
+# room (and nothing backlogged), a worker asks each broker for this many
+# batches at a time. If one hasn't sent anything for
+# CRAWLER_CREDIT_REFRESH_INTERVAL seconds, we ask again, in case it was
+# restarted or the request got lost.
+CRAWLER_BROKER_CREDITS = int(os.environ.get('CRAWLER_BROKER_CREDITS', 1))
+CRAWLER_CREDIT_REFRESH_INTERVAL = float(
+    os.environ.get('CRAWLER_CREDIT_REFRESH_INTERVAL', 5))
+# Links delegated straight to peers (CRAWLER_DELEGATION_MODE='peer') aren't
+# asked for. How many messages ZeroMQ will queue up on either side of a
+# worker -> worker pipe, and the size (in bytes) of each side's TCP buffer.
+# Keep these small so the PUSH socket moves on to another worker instead of
+# piling work up on a busy one.
+CRAWLER_PULL_HWM = int(os.environ.get('CRAWLER_PULL_HWM', 8))
+ZMQ_BROADCAST_HWM = int(os.environ.get('ZMQ_BROADCAST_HWM', 8))
+CRAWLER_PEER_BUFFER_SIZE = int(
+    os.environ.get('CRAWLER_PEER_BUFFER_SIZE', 64 * 1024))
+# When no worker has asked for work (or every peer's or repeater's pipe is
+# full), the sender holds on to messages and tries again after this many
+# seconds.
+ZMQ_BROADCAST_RETRY_INTERVAL = float(
+    os.environ.get('ZMQ_BROADCAST_RETRY_INTERVAL', 0.05))
+# While announcements are backed up, the broadcaster shares the workers out
+# evenly between jobs rather than first come, first served. Within a job,
+# shallower crawls go first, and each level of depth makes a URL count this
+# many times over against its job's share, so deep fan-outs yield to seeds.
+CRAWL_DEPTH_COST = float(os.environ.get('CRAWL_DEPTH_COST', 2))
+# If set, a job won't be handed more work while it has (roughly) this many
+# URLs in progress. Each broadcaster checks the job counters in Redis every
+# JOB_IN_FLIGHT_REFRESH_INTERVAL seconds to see where jobs are at.
+JOB_MAX_IN_FLIGHT = int(os.environ.get('JOB_MAX_IN_FLIGHT', 0))
+JOB_IN_FLIGHT_REFRESH_INTERVAL = float(
+    os.environ.get('JOB_IN_FLIGHT_REFRESH_INTERVAL', 1))
+# Bulk submissions (POST /?format=lines or /?format=ndjson) are read and
+# enqueued BULK_SUBMIT_CHUNK_SIZE URLs at a time, carrying on in the
+# background once the job has been created. While the broadcaster has more
+# than BULK_SUBMIT_MAX_BACKLOG announcements waiting to go out, we hold off
+# for BULK_SUBMIT_BACKOFF seconds rather than pile more up in memory.
+BULK_SUBMIT_CHUNK_SIZE = int(os.environ.get('BULK_SUBMIT_CHUNK_SIZE', 1000))
+BULK_SUBMIT_MAX_BACKLOG = int(os.environ.get('BULK_SUBMIT_MAX_BACKLOG', 400))
+BULK_SUBMIT_BACKOFF = float(os.environ.get('BULK_SUBMIT_BACKOFF', 0.5))
+
+# How we remember which URLs a job has already seen, so we don't crawl the
+# same page over and over. 'set' checks against the job's set of all URLs.
+# 'bloom' uses a fixed-size Bloom filter instead, which is much smaller for
+# very large jobs, at the cost of occasionally skipping a URL we haven't
+# actually seen. In 'bloom' mode, the job's URL set only holds the seeds.
+JOB_URL_DEDUP_MODE = os.environ.get('JOB_URL_DEDUP_MODE', 'set')
+# Bloom filter size (in bits) and number of hash functions. The defaults
+# (2 MB per job) keep false positives around 1% up to ~1.7M URLs.
+JOB_URL_BLOOM_BITS = int(os.environ.get('JOB_URL_BLOOM_BITS', 2 ** 24))
+JOB_URL_BLOOM_HASHES = int(os.environ.get('JOB_URL_BLOOM_HASHES', 7))
+
+# We stop reading (and drop the connection) once a response body gets this
+# big. Anything we've extracted up to that point is kept.
+CRAWLER_MAX_BODY_SIZE = int(
+    os.environ.get('CRAWLER_MAX_BODY_SIZE', 2 * 1024 * 1024))
+
+# Where HTML parsing happens. 'streaming' tokenizes bodies on the reactor as
+# they arrive. 'process' buffers each body (up to CRAWLER_MAX_BODY_SIZE) and
+# hands it to a pool of parser processes, so a big page can't stall the
+# reactor, and one worker process can use every core on the box.
+CRAWLER_PARSER_BACKEND = os.environ.get('CRAWLER_PARSER_BACKEND', 'streaming')
+# Number of parser processes for the 'process' backend. 0 means one per CPU.
+CRAWLER_PARSER_POOL_SIZE = int(os.environ.get('CRAWLER_PARSER_POOL_SIZE', 0))
+# Each parser process is replaced after parsing this many pages, so one that
+# has bloated on a pathological page doesn't hang on to the memory forever.
+# 0 means they live as long as the pool does.
+CRAWLER_PARSER_MAX_TASKS_PER_CHILD = int(
+    os.environ.get('CRAWLER_PARSER_MAX_TASKS_PER_CHILD', 500))
+# If a parser process has been on a page for this many seconds, we kill it
+# and retry the page later. One that gets OOM-killed or segfaults takes its
+# page with it, so without this we'd wait forever.
+CRAWLER_PARSE_TIMEOUT = float(os.environ.get('CRAWLER_PARSE_TIMEOUT', 30))
+
+# Crawl announcements carry a job header plus up to this many URLs each.
+# Bigger batches mean fewer messages, smaller ones spread work more evenly.
+CRAWL_MESSAGE_BATCH_SIZE = int(os.environ.get('CRAWL_MESSAGE_BATCH_SIZE', 25))
+# If set, batches go out zlib-compressed rather than as JSON. Receivers
+# understand both, so this can be flipped one service at a time.
+CRAWL_MESSAGE_COMPACT = os.environ.get('CRAWL_MESSAGE_COMPACT', '0') == '1'
+
+# Workers buffer up "this URL is done, here are its images" writes and send
+# them to Redis in batches. A batch goes out once it has this many URLs in
+# it, or this many seconds after its first URL, whichever comes first.
+RECORD_FLUSH_MAX_URLS = int(os.environ.get('RECORD_FLUSH_MAX_URLS', 100))
+RECORD_FLUSH_INTERVAL = float(os.environ.get('RECORD_FLUSH_INTERVAL', 0.1))
+
+# How job state is laid out in Redis. 'full' keeps each job's URLs and images
+# in plain sets. 'compact' stores each URL string once (in a list), tracks
+# state in bitmaps, and dedupes by 64-bit fingerprint, which takes a good deal
+# less memory on big jobs. JOB_URL_DEDUP_MODE only applies to 'full'. Every
+# service needs the same setting.
+JOB_STORAGE_LAYOUT = os.environ.get('JOB_STORAGE_LAYOUT', 'full')
+# Reading a whole compact job back (for /job/<id>, or to archive it) goes
+# this many list entries per script call, so a big job doesn't hold Redis up
+# for the whole read.
+JOB_COMPACT_READ_PAGE_SIZE = int(
+    os.environ.get('JOB_COMPACT_READ_PAGE_SIZE', 5000))
+
+# Finished jobs, and jobs that haven't made any progress in JOB_IDLE_TIMEOUT
+# seconds, get squashed into a single compressed archive blob. The web API
+# checks for them every JOB_ARCHIVE_SWEEP_INTERVAL seconds (0 turns this
+# off). Archives expire after JOB_ARCHIVE_TTL seconds (0 keeps them forever).
+JOB_ARCHIVE_SWEEP_INTERVAL = float(
+    os.environ.get('JOB_ARCHIVE_SWEEP_INTERVAL', 60))
+JOB_IDLE_TIMEOUT = float(os.environ.get('JOB_IDLE_TIMEOUT', 60 * 60))
+JOB_ARCHIVE_TTL = int(os.environ.get('JOB_ARCHIVE_TTL', 7 * 24 * 60 * 60))
+
+# Workers cache each job's budget (and whether it has been stopped), and hear
+# about stopped jobs over Redis pub/sub. In case they miss a message, cached
+# entries are only trusted for this many seconds.
+JOB_CONTROL_CACHE_TTL = float(os.environ.get('JOB_CONTROL_CACHE_TTL', 30))
+
+# Clients following a job's progress stream (/job/<id>/events) get a comment
+# line every JOB_EVENTS_KEEPALIVE_INTERVAL seconds, so that proxies don't
+# give up on a quiet job.
+JOB_EVENTS_KEEPALIVE_INTERVAL = float(
+    os.environ.get('JOB_EVENTS_KEEPALIVE_INTERVAL', 15))
+
+# Workers share a cache of what they've extracted from each page, so jobs
+# that crawl the same sites don't have to download and parse everything
+# again. Cached pages younger than PAGE_CACHE_FRESH_SECONDS are used as-is.
+# Older ones are revalidated with a conditional GET. Entries expire after
+# PAGE_CACHE_TTL seconds, and beyond PAGE_CACHE_MAX_ENTRIES, the oldest are
+# evicted. Pages whose compressed entry would be over
+# PAGE_CACHE_MAX_ENTRY_BYTES aren't cached at all.
+PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', '1') == '1'
+PAGE_CACHE_FRESH_SECONDS = int(os.environ.get('PAGE_CACHE_FRESH_SECONDS', 300))
+PAGE_CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', 24 * 60 * 60))
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 100000))
+PAGE_CACHE_MAX_ENTRY_BYTES = int(
+    os.environ.get('PAGE_CACHE_MAX_ENTRY_BYTES', 256 * 1024))
+
+# Per-host politeness, shared by every worker through Redis. Each host gets
+# HOST_REQUESTS_PER_SECOND requests per second (in bursts of up to
+# HOST_BURST), and at most HOST_MAX_CONNECTIONS fetches at once. 0 turns a
+# limit off. A connection slot that's held longer than HOST_LEASE_TTL seconds
+# is assumed to belong to a dead worker and reclaimed.
+HOST_REQUESTS_PER_SECOND = float(
+    os.environ.get('HOST_REQUESTS_PER_SECOND', 2))
+HOST_BURST = int(os.environ.get('HOST_BURST', 4))
+HOST_MAX_CONNECTIONS = int(os.environ.get('HOST_MAX_CONNECTIONS', 4))
+HOST_LEASE_TTL = float(os.environ.get('HOST_LEASE_TTL', 120))
+# Crawls waiting on a throttled host don't count towards
+# CRAWLER_MAX_IN_FLIGHT, so other hosts keep getting served. This caps how
+# many of them a worker lets pile up before it stops taking new work.
+CRAWLER_MAX_HOST_WAITING = int(os.environ.get('CRAWLER_MAX_HOST_WAITING', 256))
+
+# HTTP timeouts, in seconds. We give up on connecting after
+# HTTP_CONNECT_TIMEOUT, on getting the response headers after
+# HTTP_RESPONSE_TIMEOUT, and on the whole fetch (body and all) after
+# HTTP_TOTAL_TIMEOUT.
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_RESPONSE_TIMEOUT = float(os.environ.get('HTTP_RESPONSE_TIMEOUT', 30))
+HTTP_TOTAL_TIMEOUT = float(os.environ.get('HTTP_TOTAL_TIMEOUT', 60))
+# Fetches that fail in a way that might not happen again (timeouts, dropped
+# connections, 5xx, 429) are retried up to CRAWL_MAX_RETRIES times, waiting
+# CRAWL_RETRY_BASE_DELAY seconds before the first retry and doubling from
+# there. URLs that still fail are marked as failed in their job.
+CRAWL_MAX_RETRIES = int(os.environ.get('CRAWL_MAX_RETRIES', 3))
+CRAWL_RETRY_BASE_DELAY = float(os.environ.get('CRAWL_RETRY_BASE_DELAY', 2))
+# After HOST_BREAKER_THRESHOLD failures in a row, a worker stops trying a
+# host for HOST_BREAKER_COOLDOWN seconds, failing its URLs straight away.
+HOST_BREAKER_THRESHOLD = int(os.environ.get('HOST_BREAKER_THRESHOLD', 5))
+HOST_BREAKER_COOLDOWN = float(os.environ.get('HOST_BREAKER_COOLDOWN', 60))
+
+# Both the web API (at /metrics on WEB_API_PORT) and the workers (at
+# /metrics on CRAWLER_METRICS_PORT) serve up counters, gauges and latency
+# histograms in Prometheus' text format. Each worker on a host needs its own
+# port, so the workers' endpoint is off (0) unless you give them one.
+CRAWLER_METRICS_PORT = int(os.environ.get('CRAWLER_METRICS_PORT', 0))
+# The log lines we'd otherwise write for every message and URL add up. Set
+# this below 1 to only log that fraction of them. The metrics still count
+# everything.
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+
+# A worker can be profiled while it runs, for PROFILE_DEFAULT_SECONDS at a
+# time. Either send it SIGUSR2, or (if CRAWLER_METRICS_PORT is set) POST to
+# /profile on that port, with optional ``mode`` and ``seconds`` query args.
+# ``cprofile`` profiles every call, ``sample`` only looks at the stack every
+# PROFILE_SAMPLE_INTERVAL seconds of CPU time, which costs a good deal less.
+# Either way, the stats get dumped in PROFILE_OUTPUT_DIR.
+PROFILE_DEFAULT_MODE = os.environ.get('PROFILE_DEFAULT_MODE', 'cprofile')
+PROFILE_DEFAULT_SECONDS = float(os.environ.get('PROFILE_DEFAULT_SECONDS', 30))
+PROFILE_SAMPLE_INTERVAL = float(
+    os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+PROFILE_OUTPUT_DIR = os.environ.get('PROFILE_OUTPUT_DIR', '/tmp')
+# Any crawl that takes longer than this many seconds gets logged, along with
+# how long each stage (waiting on the host, fetching, parsing, recording)
+# took. 0 turns this off.
+SLOW_CRAWL_THRESHOLD = float(os.environ.get('SLOW_CRAWL_THRESHOLD', 0))
@@ -0,0 +1,163 @@
+"""
+Each worker keeps a table of the jobs it has crawled for: their budgets,
+their (compiled) scope rules, and whether they've been stopped (cancelled,
+out of budget, or past their deadline). That way, a worker can drop work
+for a stopped job without a trip to Redis for every URL.
+
+Entries are loaded from Redis the first time we see a job, and thrown away
+when the job is stopped (we hear about that over pub/sub, see
+:py:class:`JobControlListenerService
+<crawler.crawler_worker.services.job_control.JobControlListenerService>`),
+or after ``JOB_CONTROL_CACHE_TTL`` seconds in case we missed the news.
+"""
+
+import time
+
+from twisted.python import log
+from twisted.internet.defer import Deferred, succeed
+
+from crawler.conf import JOB_CONTROL_CACHE_TTL
+from crawler.lib.crawl_scope import CrawlScope
+from crawler.lib.data_store import get_job_control, stop_job
+
+# Lazy-loaded by get_job_control_table().
+__JOB_CONTROL_TABLE = None
+
+
+class JobControlTable(object):
+    """
+    A cache of :py:func:`crawler.lib.data_store.get_job_control` results.
+    """
+
+    def __init__(self, ttl=JOB_CONTROL_CACHE_TTL):
+        """
+        :param float ttl: How long (in seconds) we trust a cached entry.
+        """
+
+        self.ttl = ttl
+        # job_id -> (control dict, when we loaded it).
+        self.entries = {}
+        # job_id -> Deferreds waiting on a load that's already under way.
+        self._loading = {}
+        # Jobs that were invalidated while we were loading them, so what we
+        # loaded may already be out of date.
+        self._invalidated_while_loading = set()
+
+    def get(self, job_id):
+        """
+        :param str job_id: A job's UUID4 ID string.
+        :rtype: Deferred
+        :returns: A Deferred that fires with the job's control dict. See
+            :py:func:`crawler.lib.data_store.get_job_control`, except that
+            ``scope`` is a :py:class:`CrawlScope
+            <crawler.lib.crawl_scope.CrawlScope>`.
+        """
+
+        entry = self.entries.get(job_id)
+        if entry and time.time() - entry[1] < self.ttl:
+            return succeed(self._check_deadline(job_id, entry[0]))
+
+        d = Deferred()
+        if job_id in self._loading:
+            self._loading[job_id].append(d)
+            return d
+
+        self._loading[job_id] = [d]
+        get_job_control(job_id).addCallbacks(
+            self._loaded, self._load_failed,
+            callbackArgs=(job_id,), errbackArgs=(job_id,))
+        return d
+
+    def _loaded(self, control, job_id):
+        control['scope'] = self._compile_scope(job_id, control['scope'])
+        if job_id in self._invalidated_while_loading:
+            self._invalidated_while_loading.discard(job_id)
+        else:
+            self._prune()
+            self.entries[job_id] = (control, time.time())
+
+        control = self._check_deadline(job_id, control)
+        for d in self._loading.pop(job_id):
+            d.callback(control)
+
+    def _load_failed(self, failure, job_id):
+        # Claiming the URL will still catch stopped jobs, so carry on as if
+        # this one is running, and try again next time.
+        log.err(failure, "Failed to load job control for %s" % job_id)
+        self._invalidated_while_loading.discard(job_id)
+        for d in self._loading.pop(job_id):
+            d.callback({'budget': {}, 'scope': None, 'stopped': None})
+
+    def _compile_scope(self, job_id, rules):
+        """
+        Compiling the regexes is the expensive bit, so we only do it once
+        per load.
+        """
+
+        if not rules:
+            return None
+        try:
+            return CrawlScope.from_dict(rules)
+        except ValueError:
+            # The web API checks the rules, so this shouldn't happen. Better
+            # to crawl too much than nothing at all.
+            log.err(None, "Invalid scope rules for %s" % job_id)
+            return None
+
+    def _check_deadline(self, job_id, control):
+        """
+        The one budget that doesn't need Redis to check. The first time we
+        notice a job is past its deadline, we stop it for everyone.
+        """
+
+        deadline = control['budget'].get('deadline')
+        if control['stopped'] or not deadline or time.time() < deadline:
+            return control
+
+        control['stopped'] = 'deadline'
+        stop_job(job_id, 'deadline').addErrback(
+            lambda failure: failure.trap(ValueError))\
+            .addErrback(log.err, "Failed to stop job %s" % job_id)
+        return control
+
+    def _prune(self):
+        """
+        Forget about entries that have expired. Loads are rare, so it's fine
+        for this to look at every entry.
+        """
+
+        now = time.time()
+        for job_id, (_, loaded_at) in self.entries.items():
+            if now - loaded_at >= self.ttl:
+                del self.entries[job_id]
+
+    def invalidate(self, job_id):
+        """
+        :param str job_id: The job that has changed.
+        """
+
+        self.entries.pop(job_id, None)
+        if job_id in self._loading:
+            self._invalidated_while_loading.add(job_id)
+
+    def clear(self):
+        """
+        Forget everything. Used when we may have missed an invalidation.
+        """
+
+        self.entries.clear()
+        self._invalidated_while_loading.update(self._loading)
+
+
+def get_job_control_table():
+    """
+    Lazy-load the process's job control table.
+
+    :rtype: JobControlTable
+    """
+
+    global __JOB_CONTROL_TABLE
+
+    if not __JOB_CONTROL_TABLE:
+        __JOB_CONTROL_TABLE = JobControlTable()
+    return __JOB_CONTROL_TABLE
@@ -3,18 +3,76 @@ Where the sausage is made. This Redis listener passes job announcements off
 to :py:func:`crawl_job_url` in this module for crawling.
 """
 
+import random
+import time
+
 from twisted.python import log
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import readBody
+from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.web.client import ResponseFailed, ResponseNeverReceived, \
+    RequestTransmissionFailed
 
-from crawler.lib.data_store import record_images_for_url
+from crawler.lib.data_store import record_images_for_url, claim_job_url, \
+    enqueue_unseen_urls, fail_job_url
 from crawler.webapi_service.lib.job_queue import enqueue_crawling_job
-from crawler.lib.tx_http import visit_url, get_response_headers
-from crawler.conf import MAX_CRAWL_DEPTH
-from crawler.crawler_worker.lib.response_parser import parse_response
+from crawler.lib import metrics
+from crawler.lib.misc_utils import log_sampled
+from crawler.lib.tx_http import visit_url, get_response_headers, \
+    discard_response_body, read_body, get_body_size, FetchTimeout
+from crawler.lib.page_cache import get_cached_page, is_fresh, \
+    get_conditional_headers, cache_page, refresh_cached_page
+from crawler.conf import MAX_CRAWL_DEPTH, CRAWLER_PARSER_BACKEND, \
+    CRAWLER_MAX_BODY_SIZE, PAGE_CACHE_ENABLED, CRAWL_MAX_RETRIES, \
+    CRAWL_RETRY_BASE_DELAY
+from crawler.crawler_worker.lib.response_parser import parse_response_stream, \
+    is_parseable_content_type, PARSE_SECONDS
+from crawler.crawler_worker.lib.parse_pool import parse_response_in_pool, \
+    ParseError
+from crawler.crawler_worker.lib.politeness import get_host_scheduler, \
+    get_circuit_breaker, HostCircuitOpen
+from crawler.crawler_worker.lib.job_control import get_job_control_table
+from crawler.crawler_worker.lib.profiling import start_crawl_trace
+
+# Errors that have a decent chance of going away if we try again.
+TRANSIENT_FETCH_ERRORS = (
+    FetchTimeout, ConnectError, DNSLookupError, ResponseFailed,
+    ResponseNeverReceived, RequestTransmissionFailed)
+# HTTP codes that mean "not right now" rather than "no".
+TRANSIENT_HTTP_CODES = (408, 429)
+
+CRAWLS = metrics.counter(
+    'crawler_crawls_total',
+    "URLs handled, by outcome: fetched, cached (a fresh page cache hit), "
+    "failed, skipped (already crawled) or dropped (job stopped).",
+    ['outcome'])
+CRAWL_SECONDS = metrics.histogram(
+    'crawler_crawl_seconds',
+    "How long crawls took from start to finish, including waiting on hosts "
+    "and retries, by outcome: fetched, cached or failed.", ['outcome'])
+FETCH_RETRIES = metrics.counter(
+    'crawler_fetch_retries_total', "Fetches retried after a transient error.")
+# Kept up to date by the listener services.
+CRAWLS_IN_FLIGHT = metrics.gauge(
+    'crawler_crawls_in_flight',
+    "Crawls under way, including those waiting their turn with a host.")
+CRAWLS_BACKLOGGED = metrics.gauge(
+    'crawler_crawls_backlogged',
+    "Crawls received that we haven't had room to start yet.")
+CRAWLS_WAITING_ON_HOSTS = metrics.gauge(
+    'crawler_crawls_waiting_on_hosts',
+    "Crawls waiting their turn with a throttled host.")
+
+
+class FetchError(Exception):
+    """
+    Raised when the server answers with something other than a page.
+    """
+
+    def __init__(self, message, is_transient):
+        Exception.__init__(self, message)
+        self.is_transient = is_transient
 
 
-@inlineCallbacks
 def crawl_job_url(delegator_svc, job_id, url, depth):
     """
     Crawl a URL for images. Record any images that we found under the job's
@@ -22,30 +80,254 @@ def crawl_job_url(delegator_svc, job_id, url, depth):
     fire off additional crawling announcements for the worker pool to
     tear into together, rather than trying to do it all here.
 
+    If it takes longer than ``SLOW_CRAWL_THRESHOLD``, we log how long each
+    stage took.
+
     :param str job_id: The crawling job's UUID4 string.
     :param str url: The URL to crawl.
     :param int depth: The depth of this crawling job. If it's 0, this is the
         top-level crawl in the job.
+    :rtype: Deferred
     """
 
-    # Abstraction over Twisted's HTTP client. We'll follow redirs, validate
-    # SSL certificates, and try to work for most cases.
-    response = yield visit_url(url, follow_redirs=True)
+    trace = start_crawl_trace(job_id, url)
+    d = _crawl_job_url(delegator_svc, job_id, url, depth, trace)
+    d.addBoth(trace.finish)
+    return d
 
-    if response.code != 200:
-        log.err("URL %s failed with non-200 HTTP code: %d" % (url, response.code))
+
+@inlineCallbacks
+def _crawl_job_url(delegator_svc, job_id, url, depth, trace):
+    """
+    Does the work for :py:func:`crawl_job_url`, marking each stage on
+    ``trace`` as it goes.
+    """
+
+    started_at = time.time()
+    # If the job has been cancelled (or has run out of budget), there's no
+    # need to bother Redis about it. This is almost always cached.
+    control = yield get_job_control_table().get(job_id)
+    trace.mark('job_control')
+    if control['stopped']:
+        CRAWLS.inc(outcome='dropped')
+        log_sampled("Dropping URL %s, whose job (%s) has been stopped (%s).",
+                    url, job_id, control['stopped'])
         returnValue(None)
 
-    headers = get_response_headers(response)
-    # If this were a production environment, we'd probably want to try to
-    # figure out chunked response body parsing. We could end up with some
-    # huge body sizes as-is.
-    body = yield readBody(response)
-    # Look through the response's body for possible images and other links.
-    image_urls, links_to_crawl = parse_response(url, headers, body)
-    yield record_images_for_url(job_id, url, image_urls)
+    # Let the job know we're on it. If the URL was already crawled (say, a
+    # message that got delivered twice), we're done before we've started.
+    claimed = yield claim_job_url(job_id, url)
+    trace.mark('claim')
+    if not claimed:
+        CRAWLS.inc(outcome='skipped')
+        log_sampled("Skipping URL %s, which has already been crawled or "
+                    "whose job (%s) has been stopped or archived.", url, job_id)
+        returnValue(None)
+
+    # Other jobs may well have crawled this page recently.
+    page = None
+    if PAGE_CACHE_ENABLED:
+        page = yield get_cached_page(url)
+        trace.mark('page_cache')
+
+    if page and is_fresh(page):
+        image_urls, links_to_crawl = page['images'], page['links']
+        num_bytes = 0
+        outcome = 'cached'
+        CRAWLS.inc(outcome=outcome)
+    else:
+        result = yield _fetch_page_with_retries(job_id, url, page, trace)
+        if result is None:
+            CRAWLS.inc(outcome='failed')
+            CRAWL_SECONDS.observe_since(started_at, outcome='failed')
+            returnValue(None)
+        image_urls, links_to_crawl, num_bytes = result
+        outcome = 'fetched'
+        CRAWLS.inc(outcome=outcome)
+
+    # This write gets batched up with others, so get the links delegated
+    # while it waits.
+    recorded = record_images_for_url(job_id, url, image_urls, num_bytes)
 
+    # Jobs can ask to go less deep than we normally would.
+    max_depth = min(
+        MAX_CRAWL_DEPTH, control['budget'].get('max_depth', MAX_CRAWL_DEPTH))
     # Rather than try to follow the links in the current invocation, hand
     # these off so the work may be distributed across the pool.
-    if links_to_crawl and depth < MAX_CRAWL_DEPTH:
-        enqueue_crawling_job(delegator_svc, job_id, links_to_crawl, depth=depth + 1)
+    if links_to_crawl and depth < max_depth and control['scope']:
+        # The page cache is shared between jobs, so it holds every link.
+        # Trim them down to what this job wants before they cost anything.
+        links_to_crawl = control['scope'].filter_links(links_to_crawl)
+    if links_to_crawl and depth < max_depth:
+        # Navigation links show up on every page. Skip anything this job
+        # has already crawled or queued, and add the rest to its pending set.
+        links_to_crawl = yield enqueue_unseen_urls(job_id, links_to_crawl)
+        if links_to_crawl:
+            enqueue_crawling_job(
+                delegator_svc, job_id, links_to_crawl, depth=depth + 1)
+        trace.mark('delegate')
+
+    yield recorded
+    trace.mark('record')
+    CRAWL_SECONDS.observe_since(started_at, outcome=outcome)
+
+
+@inlineCallbacks
+def _fetch_page_with_retries(job_id, url, page, trace):
+    """
+    Fetches a page, waiting our turn with the host each time. Transient
+    failures are retried with exponential backoff, up to
+    ``CRAWL_MAX_RETRIES`` times. If we still can't get it (or the host's
+    circuit breaker is open), the URL is marked as failed in its job.
+
+    :param str job_id: The crawling job's UUID4 string.
+    :param str url: The URL to crawl.
+    :param dict page: The page's (stale) cache entry, or None.
+    :param trace: The crawl's :py:class:`CrawlTrace`.
+    :rtype: tuple
+    :returns: Same as :py:func:`_fetch_page`, or None if we gave up.
+    """
+
+    scheduler = get_host_scheduler()
+    breaker = get_circuit_breaker()
+    attempt = 0
+    while True:
+        delay = 0
+        if attempt:
+            # Jittered, so a host that hiccuped doesn't get all of its
+            # retries back at the same moment.
+            delay = CRAWL_RETRY_BASE_DELAY * 2 ** (attempt - 1) * \
+                random.uniform(0.5, 1.0)
+        attempt += 1
+
+        result = error = None
+        try:
+            breaker.check(url)
+            # Wait our turn, so we don't hammer the site.
+            lease = yield scheduler.acquire(url, delay=delay)
+            trace.mark('host_wait')
+            try:
+                result = yield _fetch_page(url, page, trace)
+            finally:
+                scheduler.release(lease)
+        except HostCircuitOpen as exc:
+            error, is_transient = exc, False
+        except FetchError as exc:
+            # The server answered, so it isn't down. Just not happy.
+            error, is_transient = exc, exc.is_transient
+            if is_transient:
+                breaker.record_failure(url)
+            else:
+                breaker.record_success(url)
+        except TRANSIENT_FETCH_ERRORS as exc:
+            error, is_transient = exc, True
+            breaker.record_failure(url)
+        except ParseError as exc:
+            # Not the server's fault. If a parser process died or got stuck
+            # on the page, it's worth another go.
+            error, is_transient = exc, exc.is_transient
+            breaker.record_success(url)
+        except Exception as exc:
+            log.err(None, "Unexpected error while fetching %s" % url)
+            error, is_transient = exc, False
+        else:
+            breaker.record_success(url)
+
+        if not error:
+            returnValue(result)
+        if is_transient and attempt <= CRAWL_MAX_RETRIES:
+            FETCH_RETRIES.inc()
+            log.msg("Fetching %s failed (%s), retry %d of %d." % (
+                url, error, attempt, CRAWL_MAX_RETRIES))
+            continue
+
+        log.msg("Giving up on %s for job %s: %s" % (url, job_id, error))
+        yield fail_job_url(job_id, url)
+        trace.mark('record')
+        returnValue(None)
+
+
+@inlineCallbacks
+def _fetch_page(url, page, trace):
+    """
+    Downloads and parses a page, unless we've got it cached and the server
+    tells us it hasn't changed.
+
+    :param str url: The URL to crawl.
+    :param dict page: The page's (stale) cache entry, or None.
+    :param trace: The crawl's :py:class:`CrawlTrace`.
+    :rtype: tuple
+    :returns: A tuple in the form of (image_response_url_set,
+        links_to_crawl_set, bytes_downloaded).
+    :raises: FetchError if we get anything other than a page (or a 304).
+    """
+
+    # Abstraction over Twisted's HTTP client. We'll follow redirs, validate
+    # SSL certificates, and try to work for most cases. Connections come out
+    # of (and go back into) the worker's shared keep-alive pool.
+    request_headers = get_conditional_headers(page) if page else None
+    response = yield visit_url(
+        url, follow_redirs=True, headers=request_headers)
+    trace.mark('visit_url')
+
+    if response.code == 304 and page:
+        # Not modified, so what we've got cached is still good.
+        yield discard_response_body(response)
+        trace.mark('read_body')
+        yield refresh_cached_page(url, page)
+        trace.mark('page_cache')
+        returnValue((page['images'], page['links'], get_body_size(response)))
+
+    if response.code != 200:
+        # Deal with the body so the connection can go back in the pool.
+        yield discard_response_body(response)
+        trace.mark('read_body')
+        raise FetchError(
+            "non-200 HTTP code: %d" % response.code,
+            is_transient=response.code >= 500 or
+            response.code in TRANSIENT_HTTP_CODES)
+
+    headers = get_response_headers(response)
+    if is_parseable_content_type(headers):
+        # Look through the response's body for possible images and other
+        # links.
+        result = yield _parse_response_body(url, headers, response, trace)
+    else:
+        # PDFs, videos, zips, etc. We can tell from the headers alone, so
+        # don't bother downloading the body.
+        yield discard_response_body(response)
+        trace.mark('read_body')
+        result = (set(), set())
+
+    if PAGE_CACHE_ENABLED:
+        yield cache_page(url, result[0], result[1], headers)
+        trace.mark('page_cache')
+    returnValue(result + (get_body_size(response),))
+
+
+@inlineCallbacks
+def _parse_response_body(url, headers, response, trace):
+    """
+    Hands the response body to whichever parser backend we're configured
+    for. Either way, we won't read more than ``CRAWLER_MAX_BODY_SIZE``.
+
+    :rtype: tuple
+    :returns: A tuple of sets in the form of (image_response_url_set,
+        links_to_crawl_set).
+    """
+
+    if CRAWLER_PARSER_BACKEND == 'process':
+        # Buffer the body, then parse it off in another process so we don't
+        # stall the reactor.
+        body = yield read_body(response, CRAWLER_MAX_BODY_SIZE)
+        trace.mark('read_body')
+        started_at = time.time()
+        result = yield parse_response_in_pool(url, headers, body)
+        PARSE_SECONDS.observe_since(started_at, backend='process')
+        trace.mark('parse')
+    else:
+        # Parse as the body streams in, so we never hold the whole thing
+        # in memory.
+        result = yield parse_response_stream(url, headers, response)
+        trace.mark('read_and_parse')
+    returnValue(result)
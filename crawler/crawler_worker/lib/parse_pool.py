@@ -0,0 +1,266 @@
+"""
+Runs :py:func:`parse_response` in a pool of child processes, so that
+parsing big pages doesn't tie up the reactor (or a single core). Results
+come back to the reactor thread as Deferreds.
+
+The pool is started by :py:class:`ParsePoolService`, which should be the
+first service in the worker so that we fork before any sockets are open.
+multiprocessing forks replacement children later on (when one exits after
+``max_tasks_per_child`` pages, or dies), so those close every file
+descriptor that the first children didn't have.
+
+If a child dies mid-parse (OOM killer, segfault), multiprocessing quietly
+replaces it, but the page it was working on never comes back. So children
+tell us when they start on a page, and if it isn't done
+``CRAWLER_PARSE_TIMEOUT`` seconds later, we kill the child (in case it's
+stuck rather than dead) and fail that page's Deferred with a transient
+:py:class:`ParseError`. Time spent waiting in the pool's queue doesn't count.
+"""
+
+import itertools
+import multiprocessing
+import os
+import signal
+import threading
+import traceback
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import log
+
+from crawler.conf import CRAWLER_PARSE_TIMEOUT
+from crawler.crawler_worker.lib.response_parser import parse_response
+
+# NOTE: We're not multi-threaded currently. If you were to introduce a
+# threadpool, this would probably be a bad idea.
+__PARSE_POOL = None
+# Children send (task_id, pid) down this when they start on a page.
+__STARTED_WRITER = None
+# The file descriptors the first children had. Later ones close the rest.
+__POOL_FDS = None
+# Task ID -> the Deferred for a page that's in the pool.
+__PENDING = {}
+# Task ID -> (pid, timeout call) for the pages a child has started on.
+__RUNNING = {}
+__TASK_IDS = itertools.count()
+
+
+class ParseError(Exception):
+    """
+    Raised when parsing blew up in one of the pool's child processes, or
+    never finished.
+    """
+
+    def __init__(self, message, is_transient):
+        """
+        :param bool is_transient: True if the page might well parse if we
+            tried again (the child died or got stuck), False if the parser
+            choked on it.
+        """
+
+        super(ParseError, self).__init__(message)
+        self.is_transient = is_transient
+
+
+def _get_open_fds():
+    """
+    :rtype: set
+    :returns: The file descriptors this process has open, or None if we
+        can't tell.
+    """
+
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return None
+    # One of those was listdir()'s own, which is closed by now.
+    return set(fd for fd in fds if _is_open(fd))
+
+
+def _is_open(fd):
+    try:
+        os.fstat(fd)
+    except OSError:
+        return False
+    return True
+
+
+def _init_child():
+    """
+    Runs once in each child process. Ctrl+C goes to the whole process group,
+    but it's the parent's job to shut the children down. It does that with
+    SIGTERM, so we mustn't keep the reactor's handler for it, which children
+    started after the reactor is running would otherwise inherit. The same
+    goes for any sockets the worker has opened since.
+    """
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # None in the first children, which is fine, since they're what we're
+    # trying to look like.
+    if __POOL_FDS is None:
+        return
+    for fd in (_get_open_fds() or set()) - __POOL_FDS:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def _parse_in_child(task_id, response_url, headers, body):
+    """
+    This is what actually runs in the child process. Exceptions don't cross
+    the process boundary in a way we can catch, so we hand back a
+    (succeeded, result) tuple instead.
+    """
+
+    __STARTED_WRITER.send((task_id, os.getpid()))
+    try:
+        return True, parse_response(response_url, headers, body)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _watch_started(started_reader):
+    """
+    Runs on a thread of its own, passing word of pages being started on over
+    to the reactor thread. Returns once every child is gone and the pool has
+    been stopped.
+    """
+
+    while True:
+        try:
+            task_id, pid = started_reader.recv()
+        except (EOFError, IOError):
+            return
+        reactor.callFromThread(_parse_started, task_id, pid)
+
+
+def start_parse_pool(pool_size=None, max_tasks_per_child=None):
+    """
+    :param int pool_size: The number of parser processes to start. If None
+        (or 0), we start one per CPU.
+    :param int max_tasks_per_child: Replace each parser process after it
+        has parsed this many pages. If None (or 0), they're never replaced.
+    """
+
+    global __PARSE_POOL, __STARTED_WRITER, __POOL_FDS
+
+    if __PARSE_POOL:
+        return
+
+    # Writes this small to a pipe are atomic, so the children can share it
+    # without a lock (which one of them might get killed holding).
+    started_reader, __STARTED_WRITER = multiprocessing.Pipe(duplex=False)
+    pool_size = pool_size or multiprocessing.cpu_count()
+    __PARSE_POOL = multiprocessing.Pool(
+        pool_size, _init_child, maxtasksperchild=max_tasks_per_child or None)
+    __POOL_FDS = _get_open_fds()
+
+    watcher = threading.Thread(target=_watch_started, args=(started_reader,))
+    watcher.daemon = True
+    watcher.start()
+    log.msg("Started parser pool with %d process(es)." % pool_size)
+
+
+def stop_parse_pool():
+    global __PARSE_POOL, __STARTED_WRITER, __POOL_FDS
+
+    if not __PARSE_POOL:
+        return
+
+    __PARSE_POOL.terminate()
+    __PARSE_POOL = None
+    # With the children gone, this was the last writer, so the watcher
+    # thread's recv() gives up.
+    __STARTED_WRITER.close()
+    __STARTED_WRITER = None
+    __POOL_FDS = None
+
+    pending = __PENDING.values()
+    __PENDING.clear()
+    for pid, timeout_call in __RUNNING.values():
+        timeout_call.cancel()
+    __RUNNING.clear()
+    for d in pending:
+        d.errback(ParseError("The parser pool was stopped.", True))
+
+
+def _parse_started(task_id, pid):
+    """
+    A child has started on a page, so its time starts now.
+    """
+
+    # The result can beat us here.
+    if task_id not in __PENDING:
+        return
+    __RUNNING[task_id] = (pid, reactor.callLater(
+        CRAWLER_PARSE_TIMEOUT, _parse_timed_out, task_id))
+
+
+def _parse_timed_out(task_id):
+    """
+    A child has had a page for longer than ``CRAWLER_PARSE_TIMEOUT``. It's
+    either dead, in which case the pool has already replaced it, or stuck,
+    in which case we kill it and then the pool replaces it.
+    """
+
+    pid, _ = __RUNNING.pop(task_id)
+    d = __PENDING.pop(task_id)
+    log.err("Parser process %d took longer than %ss with a page, killing it."
+            % (pid, CRAWLER_PARSE_TIMEOUT))
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        # Already dead.
+        pass
+    d.errback(ParseError(
+        "Gave up on parsing after %ss." % CRAWLER_PARSE_TIMEOUT, True))
+
+
+def _finish_parse(task_id, succeeded, value):
+    """
+    Hands a result from the pool to its Deferred, unless we've already
+    given up on it.
+    """
+
+    d = __PENDING.pop(task_id, None)
+    if d is None:
+        return
+    running = __RUNNING.pop(task_id, None)
+    if running:
+        running[1].cancel()
+    if succeeded:
+        d.callback(value)
+    else:
+        d.errback(ParseError(value, False))
+
+
+def parse_response_in_pool(response_url, headers, body):
+    """
+    Same arguments as :py:func:`parse_response`, but the parsing happens
+    in a child process.
+
+    :rtype: Deferred
+    :returns: A Deferred that fires with a tuple of sets in the form of
+        (image_response_url_set, links_to_crawl_set), or fails with
+        :py:class:`ParseError` if the parse blew up or timed out.
+    """
+
+    if not __PARSE_POOL:
+        raise RuntimeError("The parser pool hasn't been started.")
+
+    task_id = next(__TASK_IDS)
+    d = __PENDING[task_id] = Deferred()
+
+    def _handle_result(result):
+        # We're on one of the pool's helper threads here, so we have to
+        # hop back over to the reactor thread before touching the Deferred.
+        succeeded, value = result
+        reactor.callFromThread(_finish_parse, task_id, succeeded, value)
+
+    __PARSE_POOL.apply_async(
+        _parse_in_child, (task_id, response_url, headers, body),
+        callback=_handle_result)
+    return d
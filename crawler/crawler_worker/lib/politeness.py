@@ -0,0 +1,392 @@
+"""
+Keeps us from hammering any one site. Before fetching a page, a crawl asks
+the :py:class:`HostScheduler` for a slot on the page's host. Slots are
+handed out by a token bucket (``HOST_REQUESTS_PER_SECOND``, with bursts of
+up to ``HOST_BURST``) and a cap on concurrent connections
+(``HOST_MAX_CONNECTIONS``). Both live in Redis, so the limits hold across
+every worker, not just this one.
+
+Crawls for a throttled host wait their turn in a per-host queue. Nothing is
+dropped, and crawls for other hosts carry on in the meantime.
+
+Hosts that keep failing get cut off for a while by the worker's
+:py:class:`CircuitBreaker`.
+"""
+
+from collections import deque
+import time
+import urlparse
+import uuid
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred
+
+from crawler.conf import HOST_REQUESTS_PER_SECOND, HOST_BURST, \
+    HOST_MAX_CONNECTIONS, HOST_LEASE_TTL, HOST_BREAKER_THRESHOLD, \
+    HOST_BREAKER_COOLDOWN
+from crawler.lib.data_store import get_redis_conn, register_script, \
+    run_script
+
+# NOTE: We're not multi-threaded currently. If you were to introduce a
+# threadpool, this would probably be a bad idea.
+# Lazy-loaded by get_host_scheduler().
+__HOST_SCHEDULER = None
+# Lazy-loaded by get_circuit_breaker().
+__CIRCUIT_BREAKER = None
+
+# How long to wait before asking again when a host is at its connection cap.
+# A release by this worker wakes us up sooner.
+CONNECTION_CAP_RETRY_INTERVAL = 0.1
+
+# KEYS: the host's token bucket (a hash), the host's connection leases (a
+# sorted set scored by when they were taken). ARGV: requests per second,
+# burst size, max connections, our lease ID, lease TTL (ms). A limit of 0
+# means no limit. Returns 0 if we got a slot, -1 if the host is at its
+# connection cap, or else how many milliseconds until a token frees up.
+# Redis's clock is used, so workers don't need theirs to agree. Before Redis
+# 5, a script can't write after reading the clock unless it asks for its
+# effects to be replicated, rather than the script itself.
+_ACQUIRE_HOST_SLOT_SCRIPT = """
+redis.replicate_commands()
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_connections = tonumber(ARGV[3])
+local lease_ttl = tonumber(ARGV[5])
+
+if max_connections > 0 then
+    -- Leases from workers that died without releasing them.
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now - lease_ttl)
+    if redis.call('ZCARD', KEYS[2]) >= max_connections then
+        return -1
+    end
+end
+
+if rate > 0 then
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate / 1000)
+    if tokens < 1 then
+        return math.ceil((1 - tokens) * 1000 / rate)
+    end
+    redis.call('HMSET', KEYS[1], 'tokens', tokens - 1, 'updated', now)
+    -- Once it would have refilled, the bucket may as well go away.
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+end
+
+if max_connections > 0 then
+    redis.call('ZADD', KEYS[2], now, ARGV[4])
+    redis.call('PEXPIRE', KEYS[2], lease_ttl)
+end
+return 0
+"""
+register_script('acquire_host_slot', _ACQUIRE_HOST_SLOT_SCRIPT)
+
+
+def get_host_key(url):
+    """
+    What the politeness limits go by. Unlike
+    :py:func:`crawler.lib.crawl_scope.get_host`, this keeps the port, since
+    two servers on the same host are two different servers to be polite to.
+
+    :param str url: A URL.
+    :rtype: str
+    :returns: The host (and port, if there is one) we'd be connecting to.
+    """
+
+    return urlparse.urlsplit(url).netloc.lower()
+
+
+def _get_host_keys(host):
+    """
+    :param str host: A host, as returned by :py:func:`get_host_key`.
+    :rtype: list
+    :returns: The host's token bucket and connection lease keys.
+    """
+
+    if isinstance(host, unicode):
+        host = host.encode('utf-8')
+    return ['host_bucket:%s' % host, 'host_leases:%s' % host]
+
+
+class HostLease(object):
+    """
+    A slot on a host, handed out by :py:meth:`HostScheduler.acquire`. Pass it
+    back to :py:meth:`HostScheduler.release` once the fetch is done.
+    """
+
+    def __init__(self, host, lease_id):
+        self.host = host
+        self.lease_id = lease_id
+
+
+class HostScheduler(object):
+    """
+    Hands out per-host fetch slots, queueing crawls for hosts that are over
+    their limits. See the module docstring for the details.
+    """
+
+    def __init__(self, rate=HOST_REQUESTS_PER_SECOND, burst=HOST_BURST,
+                 max_connections=HOST_MAX_CONNECTIONS,
+                 lease_ttl=HOST_LEASE_TTL):
+        """
+        :param float rate: Requests per second, per host. 0 for no limit.
+        :param int burst: How many requests can go out back to back before
+            the rate limit kicks in.
+        :param int max_connections: Concurrent fetches per host. 0 for no
+            limit.
+        :param float lease_ttl: How long (in seconds) before we assume a
+            connection lease's worker died and reclaim it.
+        """
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_connections = max_connections
+        self.lease_ttl_ms = int(lease_ttl * 1000)
+        # host -> deque of Deferreds waiting for a slot.
+        self.queues = {}
+        # Crawls backing off before they join their host's queue.
+        self.delayed = 0
+        # Hosts we're currently asking Redis about.
+        self._busy_hosts = set()
+        # host -> DelayedCall for our next try.
+        self._retry_calls = {}
+        # Called with no arguments whenever the number of waiting crawls
+        # changes. Listeners use this to keep the right number of crawls
+        # going.
+        self.observers = []
+        self._notify_call = None
+
+    @property
+    def is_enabled(self):
+        return bool(self.rate or self.max_connections)
+
+    @property
+    def waiting(self):
+        """
+        :rtype: int
+        :returns: How many crawls are waiting on a slot.
+        """
+
+        return self.delayed + sum(
+            len(queue) for queue in self.queues.values())
+
+    def acquire(self, url, delay=0):
+        """
+        :param str url: The URL we'd like to fetch.
+        :param float delay: Don't hand out a slot for at least this many
+            seconds. Used to back off before retrying.
+        :rtype: Deferred
+        :returns: A Deferred that fires with a :py:class:`HostLease` once
+            it's our turn.
+        """
+
+        host = get_host_key(url)
+        d = Deferred()
+        if delay:
+            self.delayed += 1
+            self._notify_observers()
+            reactor.callLater(delay, self._end_delay, host, d)
+        else:
+            self._queue(host, d)
+        return d
+
+    def _end_delay(self, host, d):
+        self.delayed -= 1
+        self._notify_observers()
+        self._queue(host, d)
+
+    def _queue(self, host, d):
+        if not self.is_enabled:
+            d.callback(HostLease(host, None))
+            return
+
+        self.queues.setdefault(host, deque()).append(d)
+        self._notify_observers()
+        self._schedule_host(host)
+
+    def release(self, lease):
+        """
+        :param HostLease lease: The lease we got from :py:meth:`acquire`.
+        """
+
+        if not lease.lease_id or not self.max_connections:
+            return
+        get_redis_conn().addCallback(
+            lambda conn: conn.zrem(_get_host_keys(lease.host)[1],
+                                   lease.lease_id))\
+            .addCallback(lambda _: self._wake_host(lease.host))\
+            .addErrback(log.err, "Failed to release slot on %s" % lease.host)
+
+    def _wake_host(self, host):
+        """
+        A slot on the host may have opened up. Try now, rather than waiting
+        for the next scheduled retry.
+        """
+
+        retry_call = self._retry_calls.pop(host, None)
+        if retry_call and retry_call.active():
+            retry_call.cancel()
+        self._schedule_host(host)
+
+    def _schedule_host(self, host):
+        if host in self._busy_hosts or host in self._retry_calls:
+            return
+        self._serve_host(host).addErrback(
+            log.err, "Host scheduler failed for %s" % host)
+
+    @inlineCallbacks
+    def _serve_host(self, host):
+        """
+        Hands out slots to the host's queue, in order, until it's empty or
+        Redis tells us to back off.
+        """
+
+        self._busy_hosts.add(host)
+        try:
+            while self.queues.get(host):
+                lease_id = uuid.uuid4().hex
+                try:
+                    wait_ms = yield run_script(
+                        'acquire_host_slot', _get_host_keys(host),
+                        [self.rate, self.burst, self.max_connections,
+                         lease_id, self.lease_ttl_ms])
+                except Exception:
+                    # Better to be a little rude than to stop crawling
+                    # altogether because Redis hiccuped.
+                    log.err(None, "Failed to get a slot on %s. Going ahead "
+                                  "anyway." % host)
+                    wait_ms, lease_id = 0, None
+
+                if wait_ms:
+                    if wait_ms < 0:
+                        delay = CONNECTION_CAP_RETRY_INTERVAL
+                    else:
+                        delay = wait_ms / 1000.0
+                    self._retry_calls[host] = reactor.callLater(
+                        delay, self._retry_host, host)
+                    return
+
+                d = self.queues[host].popleft()
+                self._notify_observers()
+                d.callback(HostLease(host, lease_id))
+            self.queues.pop(host, None)
+        finally:
+            self._busy_hosts.discard(host)
+
+    def _retry_host(self, host):
+        self._retry_calls.pop(host, None)
+        self._schedule_host(host)
+
+    def _notify_observers(self):
+        # Observers tend to start more crawls, which come right back here
+        # for slots. Calling them on the next reactor tick (once, however
+        # many changes there were) keeps that from recursing.
+        if not self._notify_call:
+            self._notify_call = reactor.callLater(0, self._call_observers)
+
+    def _call_observers(self):
+        self._notify_call = None
+        for observer in self.observers:
+            observer()
+
+
+class HostCircuitOpen(Exception):
+    """
+    Raised instead of fetching from a host that's been failing.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Tracks consecutive fetch failures per host. Once a host has failed
+    ``threshold`` times in a row, we stop trying it for ``cooldown``
+    seconds. After that, one fetch is let through to see whether it has
+    recovered. If it fails, we're back to waiting.
+
+    This is per worker, so each worker finds out about a bad host for
+    itself, but it doesn't take many fetches to do so.
+    """
+
+    def __init__(self, threshold=HOST_BREAKER_THRESHOLD,
+                 cooldown=HOST_BREAKER_COOLDOWN):
+        """
+        :param int threshold: Consecutive failures before we cut a host off.
+            0 turns the breaker off.
+        :param float cooldown: How long (in seconds) a host stays cut off.
+        """
+
+        self.threshold = threshold
+        self.cooldown = cooldown
+        # host -> consecutive failures.
+        self.failures = {}
+        # host -> when we'll next let a fetch through.
+        self.open_until = {}
+
+    def check(self, url):
+        """
+        :param str url: The URL we'd like to fetch.
+        :raises: HostCircuitOpen if its host is cut off.
+        """
+
+        host = get_host_key(url)
+        open_until = self.open_until.get(host)
+        if open_until is None:
+            return
+        now = time.time()
+        if now < open_until:
+            raise HostCircuitOpen(
+                "%s has failed %d times in a row." % (
+                    host, self.failures.get(host, 0)))
+        # Let this one through as a test, but nobody else until we hear how
+        # it went.
+        self.open_until[host] = now + self.cooldown
+
+    def record_success(self, url):
+        host = get_host_key(url)
+        self.failures.pop(host, None)
+        if self.open_until.pop(host, None):
+            log.msg("Host %s has recovered." % host)
+
+    def record_failure(self, url):
+        if not self.threshold:
+            return
+        host = get_host_key(url)
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            if host not in self.open_until:
+                log.msg("Host %s has failed %d times in a row. Leaving it "
+                        "alone for %ds." % (
+                            host, self.failures[host], self.cooldown))
+            self.open_until[host] = time.time() + self.cooldown
+
+
+def get_circuit_breaker():
+    """
+    Lazy-load the process's circuit breaker.
+
+    :rtype: CircuitBreaker
+    """
+
+    global __CIRCUIT_BREAKER
+
+    if not __CIRCUIT_BREAKER:
+        __CIRCUIT_BREAKER = CircuitBreaker()
+    return __CIRCUIT_BREAKER
+
+
+def get_host_scheduler():
+    """
+    Lazy-load the process's host scheduler.
+
+    :rtype: HostScheduler
+    """
+
+    global __HOST_SCHEDULER
+
+    if not __HOST_SCHEDULER:
+        __HOST_SCHEDULER = HostScheduler()
+    return __HOST_SCHEDULER
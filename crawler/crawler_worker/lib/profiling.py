@@ -0,0 +1,353 @@
+"""
+Ways to see where a worker's time is going, without restarting it.
+
+The :py:class:`Profiler` profiles the whole worker for a while, then dumps
+the stats to ``PROFILE_OUTPUT_DIR``. It's started by SIGUSR2 (see
+:py:mod:`crawler.crawler_worker.services.profiling`) or by POSTing to
+:py:class:`ProfileResource`. In ``cprofile`` mode, we get a pstats file
+(``python -m pstats <file>``). In ``sample`` mode, we get a file of folded
+stacks with a count apiece, which flamegraph.pl and speedscope both read.
+
+A :py:class:`CrawlTrace` times each stage of a single crawl, and logs the
+lot if the crawl took longer than ``SLOW_CRAWL_THRESHOLD``.
+
+With nothing switched on, none of this costs anything more than a no-op
+method call per stage.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import signal
+import time
+from collections import OrderedDict
+from StringIO import StringIO
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.web.resource import Resource
+
+from crawler.conf import PROFILE_DEFAULT_MODE, PROFILE_DEFAULT_SECONDS, \
+    PROFILE_SAMPLE_INTERVAL, PROFILE_OUTPUT_DIR, SLOW_CRAWL_THRESHOLD
+
+# Lazy-loaded by get_profiler().
+__PROFILER = None
+
+PROFILE_MODES = ('cprofile', 'sample')
+# How many of the most expensive functions we log after a cProfile run.
+PROFILE_LOG_TOP = 25
+# No runaway profiles, please.
+PROFILE_MAX_SECONDS = 600
+
+
+class ProfilerBusy(Exception):
+    """
+    Raised when asked to start profiling while we already are.
+    """
+
+
+class _StackSampler(object):
+    """
+    Every so often (in CPU time, so an idle worker doesn't get sampled),
+    SIGPROF interrupts whatever we're doing and we count the stack we
+    were in.
+    """
+
+    def __init__(self, interval):
+        """
+        :param float interval: Seconds of CPU time between samples.
+        """
+
+        self.interval = interval
+        # Folded stack (outermost first, ';' separated) -> times seen.
+        self.stacks = {}
+        self.previous_handler = None
+
+    def enable(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        # Restart any system call we interrupt, rather than fail it.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s (%s:%d)' % (
+                code.co_name, code.co_filename, code.co_firstlineno))
+            frame = frame.f_back
+        stack = ';'.join(reversed(names))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def dump_stats(self, path):
+        with open(path, 'w') as stats_file:
+            for stack, count in sorted(self.stacks.items()):
+                stats_file.write('%s %d\n' % (stack, count))
+
+    def get_summary(self):
+        """
+        :rtype: str
+        :returns: How many samples we took.
+        """
+
+        return "%d sample(s) over %d distinct stack(s)." % (
+            sum(self.stacks.values()), len(self.stacks))
+
+
+class _CProfiler(object):
+    """
+    Puts cProfile behind the same interface as :py:class:`_StackSampler`.
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def enable(self):
+        self.profile.enable()
+
+    def disable(self):
+        self.profile.disable()
+
+    def dump_stats(self, path):
+        self.profile.dump_stats(path)
+
+    def get_summary(self):
+        """
+        :rtype: str
+        :returns: The most expensive functions, by cumulative time.
+        """
+
+        output = StringIO()
+        pstats.Stats(self.profile, stream=output)\
+            .sort_stats('cumulative').print_stats(PROFILE_LOG_TOP)
+        return output.getvalue()
+
+
+class Profiler(object):
+    """
+    Profiles the worker for a while. There's only ever one run at a time.
+    """
+
+    def __init__(self, output_dir=PROFILE_OUTPUT_DIR):
+        self.output_dir = output_dir
+        self.mode = None
+        self.started_at = None
+        self.output_path = None
+        self.backend = None
+        self.stop_call = None
+
+    @property
+    def is_running(self):
+        return self.backend is not None
+
+    def start(self, mode=PROFILE_DEFAULT_MODE,
+              seconds=PROFILE_DEFAULT_SECONDS):
+        """
+        :param str mode: One of ``PROFILE_MODES``.
+        :param float seconds: How long to profile for.
+        :rtype: str
+        :returns: Where the stats will be written.
+        :raises: ValueError if the mode or duration aren't valid,
+            ProfilerBusy if we're already profiling.
+        """
+
+        if mode not in PROFILE_MODES:
+            raise ValueError(
+                "mode must be one of: %s" % ', '.join(PROFILE_MODES))
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError(
+                "seconds must be more than 0 and at most %d." %
+                PROFILE_MAX_SECONDS)
+        if self.is_running:
+            raise ProfilerBusy(
+                "Already profiling, until %s is written." % self.output_path)
+
+        self.mode = mode
+        self.started_at = time.time()
+        extension = 'pstats' if mode == 'cprofile' else 'folded'
+        self.output_path = os.path.join(
+            self.output_dir, 'crawler-worker-%d-%d.%s' % (
+                os.getpid(), self.started_at, extension))
+        if mode == 'cprofile':
+            self.backend = _CProfiler()
+        else:
+            self.backend = _StackSampler(PROFILE_SAMPLE_INTERVAL)
+        self.backend.enable()
+        self.stop_call = reactor.callLater(seconds, self.stop)
+
+        log.msg("Profiling (%s) for %ss, stats will be written to %s" % (
+            mode, seconds, self.output_path))
+        return self.output_path
+
+    def stop(self):
+        """
+        Stops profiling (if we were), and writes out the stats.
+        """
+
+        if not self.is_running:
+            return
+        backend, self.backend = self.backend, None
+        backend.disable()
+        if self.stop_call.active():
+            self.stop_call.cancel()
+        self.stop_call = None
+
+        try:
+            backend.dump_stats(self.output_path)
+        except (IOError, OSError) as exc:
+            log.err("Couldn't write profile stats to %s: %s" % (
+                self.output_path, exc))
+            return
+        log.msg("Profiled (%s) for %.1fs, stats written to %s\n%s" % (
+            self.mode, time.time() - self.started_at, self.output_path,
+            backend.get_summary()))
+
+    def toggle(self):
+        """
+        Starts a run with the defaults, or stops the one that's going.
+        """
+
+        if self.is_running:
+            self.stop()
+        else:
+            self.start()
+
+    def get_status(self):
+        """
+        :rtype: dict
+        """
+
+        return {
+            'running': self.is_running,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'output_path': self.output_path,
+        }
+
+
+def get_profiler():
+    """
+    Lazy-load the process's profiler.
+
+    :rtype: Profiler
+    """
+
+    global __PROFILER
+
+    if not __PROFILER:
+        __PROFILER = Profiler()
+    return __PROFILER
+
+
+# noinspection PyPep8Naming
+class ProfileResource(Resource):
+    """
+    URL: /profile
+
+    GET for the profiler's status. POST to start profiling, with optional
+    ``mode`` (one of ``PROFILE_MODES``) and ``seconds`` query args.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(get_profiler().get_status())
+
+    def render_POST(self, request):
+        request.setHeader('Content-Type', 'application/json')
+        mode = request.args.get('mode', [PROFILE_DEFAULT_MODE])[0]
+        try:
+            seconds = float(
+                request.args.get('seconds', [PROFILE_DEFAULT_SECONDS])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            return json.dumps({'message': "seconds must be a number."})
+
+        try:
+            get_profiler().start(mode, seconds)
+        except ValueError as exc:
+            request.setResponseCode(400)
+            return json.dumps({'message': str(exc)})
+        except ProfilerBusy as exc:
+            request.setResponseCode(409)
+            return json.dumps({'message': str(exc)})
+        return json.dumps(get_profiler().get_status())
+
+
+class CrawlTrace(object):
+    """
+    Times the stages of one crawl. Each call to :py:meth:`mark` charges the
+    time since the last one to the given stage. Stages that come up more
+    than once (retries, say) add up.
+    """
+
+    def __init__(self, job_id, url, threshold):
+        """
+        :param str job_id: The crawling job's UUID4 string.
+        :param str url: The URL being crawled.
+        :param float threshold: Crawls taking longer than this (in seconds)
+            get logged.
+        """
+
+        self.job_id = job_id
+        self.url = url
+        self.threshold = threshold
+        self.started_at = self.marked_at = time.time()
+        # Stage name -> seconds, in the order they first came up.
+        self.stages = OrderedDict()
+
+    def mark(self, stage):
+        """
+        :param str stage: What we've been doing since the last mark.
+        """
+
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.marked_at
+        self.marked_at = now
+
+    def finish(self, result=None):
+        """
+        Logs the stages if the crawl was slow. Hands back ``result``, so this
+        can go straight on the crawl's Deferred.
+        """
+
+        elapsed = time.time() - self.started_at
+        if elapsed >= self.threshold:
+            log.msg("Slow crawl (%.3fs) of %s for job %s: %s" % (
+                elapsed, self.url, self.job_id, ', '.join(
+                    '%s=%.3fs' % stage for stage in self.stages.items())))
+        return result
+
+
+class _NullCrawlTrace(object):
+    """
+    Stands in for a :py:class:`CrawlTrace` when tracing is switched off.
+    """
+
+    def mark(self, stage):
+        pass
+
+    def finish(self, result=None):
+        return result
+
+
+NULL_CRAWL_TRACE = _NullCrawlTrace()
+
+
+def start_crawl_trace(job_id, url):
+    """
+    :param str job_id: The crawling job's UUID4 string.
+    :param str url: The URL being crawled.
+    :returns: A :py:class:`CrawlTrace`, or a stand-in that does nothing if
+        ``SLOW_CRAWL_THRESHOLD`` is 0.
+    """
+
+    if not SLOW_CRAWL_THRESHOLD:
+        return NULL_CRAWL_TRACE
+    return CrawlTrace(job_id, url, SLOW_CRAWL_THRESHOLD)
@@ -1,12 +1,51 @@
 """
 A quick and dirty HTTP response parser. Picks out interesting bits of data
 and tosses it out for other pieces higher on the stack to use.
+
+There are two ways in: :py:func:`parse_response_stream` tokenizes the body
+incrementally as it comes off the wire, while :py:func:`parse_response`
+takes a fully buffered body and runs it through BeautifulSoup.
 """
 
-from urlparse import urljoin
+import codecs
+import posixpath
+import time
+from HTMLParser import HTMLParser, HTMLParseError
+from urlparse import urljoin, urlparse
 
 from bs4 import BeautifulSoup
+from twisted.internet.defer import Deferred
+from twisted.internet.protocol import Protocol
 from twisted.python import log
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+from crawler.conf import CRAWLER_MAX_BODY_SIZE
+from crawler.lib import metrics
+from crawler.lib.misc_utils import remove_cr_and_lf
+from crawler.lib.tx_http import deliver_body
+
+# Links ending in these are images. We record them rather than crawl them.
+LINKED_IMAGE_EXTENSIONS = frozenset([
+    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg', '.ico',
+    '.tif', '.tiff',
+])
+# Links ending in these are almost certainly not HTML, so there's no sense
+# in sending a worker after them.
+SKIPPED_LINK_EXTENSIONS = frozenset([
+    '.pdf', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.tar', '.rar', '.7z',
+    '.exe', '.msi', '.dmg', '.iso', '.apk', '.bin',
+    '.mp3', '.wav', '.ogg', '.flac', '.m4a',
+    '.mp4', '.m4v', '.avi', '.mov', '.wmv', '.flv', '.webm', '.mkv',
+    '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.odt',
+    '.css', '.js', '.json', '.woff', '.woff2', '.ttf', '.eot',
+])
+
+PARSE_SECONDS = metrics.histogram(
+    'crawler_parse_seconds',
+    "Time spent parsing each page. For the streaming backend, this is just "
+    "the time spent in the tokenizer, not waiting on the body.",
+    ['backend'])
 
 
 def parse_response(response_url, headers, body):
@@ -22,18 +61,9 @@ def parse_response(response_url, headers, body):
         links_to_crawl_set).
     """
 
-    # TODO: Might consider making these exceptions.
-    if 'content-type' not in headers:
-        log.err('Missing Content-Type header. Skipping.')
-        return set(), set()
-    content_type = headers['content-type'].lower()
-    if 'text/html' not in content_type:
-        log.err('Content type "%s" not parseable. Skipping.' % content_type)
+    if not is_parseable_content_type(headers):
         return set(), set()
 
-    # If this were a production environment, we'd probably want to try to
-    # figure out chunked response body parsing. We could end up with some
-    # huge body sizes as-is.
     soup = BeautifulSoup(body)
     image_response_url_set = set([])
     links_to_crawl_set = set([])
@@ -44,7 +74,216 @@ def parse_response(response_url, headers, body):
         elif tag.name == 'img':
             _record_image(response_url, tag, image_response_url_set)
 
-    return image_response_url_set, links_to_crawl_set
+    linked_image_url_set, links_to_crawl_set = classify_links(
+        links_to_crawl_set)
+    return image_response_url_set | linked_image_url_set, links_to_crawl_set
+
+
+def parse_response_stream(response_url, headers, response,
+                          max_body_size=CRAWLER_MAX_BODY_SIZE):
+    """
+    Like :py:func:`parse_response`, but we pick out images and links as
+    the body arrives instead of buffering the whole thing first. If the
+    body grows past ``max_body_size``, we drop the connection and go with
+    whatever we found up to that point.
+
+    Check :py:func:`is_parseable_content_type` before calling this, so we
+    don't bother reading bodies we can't use.
+
+    :param str response_url: The URL that the response came from.
+    :param dict headers: A dict of response headers.
+    :param response: The Twisted HTTP client response to read the body from.
+    :param int max_body_size: The most body bytes we'll read, in bytes.
+    :rtype: Deferred
+    :returns: A Deferred that fires with a tuple of sets in the form of
+        (image_response_url_set, links_to_crawl_set).
+    """
+
+    d = Deferred()
+    deliver_body(response, StreamingResponseParser(
+        response_url, _get_charset(headers), max_body_size, d))
+    return d
+
+
+class _LinkExtractor(HTMLParser):
+    """
+    An incremental tokenizer that records <img src> and <a href> values
+    as it runs across them. Feed it as much or as little as you have.
+    """
+
+    def __init__(self, response_url):
+        HTMLParser.__init__(self)
+
+        self.response_url = response_url
+        self.image_response_url_set = set([])
+        self.links_to_crawl_set = set([])
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            _record_link(self.response_url, dict(attrs), self.links_to_crawl_set)
+        elif tag == 'img':
+            _record_image(
+                self.response_url, dict(attrs), self.image_response_url_set)
+
+    # <img /> and friends.
+    handle_startendtag = handle_starttag
+
+
+class StreamingResponseParser(Protocol):
+    """
+    Receives a response body chunk by chunk and feeds it through a
+    :py:class:`_LinkExtractor`. Fires its Deferred with the extracted
+    (image_response_url_set, links_to_crawl_set) once the body is done, or
+    once we've read ``max_body_size`` bytes of it, whichever comes first.
+    """
+
+    def __init__(self, response_url, charset, max_body_size, deferred):
+        """
+        :param str response_url: The URL that the response came from.
+        :param str charset: The body's character set.
+        :param int max_body_size: The most body bytes we'll read.
+        :param Deferred deferred: Fired with the results.
+        """
+
+        self.response_url = response_url
+        self.max_body_size = max_body_size
+        self.deferred = deferred
+        self.bytes_received = 0
+        self.is_truncated = False
+        # Set if the document is too broken for the tokenizer to continue.
+        self.is_unparseable = False
+        self.extractor = _LinkExtractor(response_url)
+        self.decoder = _get_incremental_decoder(charset)
+        self.parse_seconds = 0.0
+
+    def dataReceived(self, data):
+        if self.is_truncated:
+            return
+
+        self.bytes_received += len(data)
+        if self.bytes_received > self.max_body_size:
+            overage = self.bytes_received - self.max_body_size
+            self._feed(data[:len(data) - overage])
+            self.is_truncated = True
+            log.msg("Body of %s exceeds %d bytes. Truncating." % (
+                self.response_url, self.max_body_size))
+            # Closes the connection out from under the rest of the body.
+            self.transport.stopProducing()
+            return
+
+        self._feed(data)
+
+    def _feed(self, data):
+        if self.is_unparseable:
+            return
+        started_at = time.time()
+        try:
+            self.extractor.feed(self.decoder.decode(data))
+        except HTMLParseError as exc:
+            # Keep what we've found so far, but this document is too far
+            # gone for us to keep going.
+            log.err("Giving up on parsing %s: %s" % (self.response_url, exc))
+            self.is_unparseable = True
+        self.parse_seconds += time.time() - started_at
+
+    def connectionLost(self, reason):
+        if not self.is_unparseable:
+            started_at = time.time()
+            try:
+                self.extractor.close()
+            except HTMLParseError:
+                pass
+            self.parse_seconds += time.time() - started_at
+        PARSE_SECONDS.observe(self.parse_seconds, backend='streaming')
+
+        deferred, self.deferred = self.deferred, None
+        if self.is_truncated or reason.check(ResponseDone, PotentialDataLoss):
+            linked_image_url_set, links_to_crawl_set = classify_links(
+                self.extractor.links_to_crawl_set)
+            deferred.callback((
+                self.extractor.image_response_url_set | linked_image_url_set,
+                links_to_crawl_set))
+        else:
+            deferred.errback(reason)
+
+
+def is_parseable_content_type(headers):
+    """
+    This only needs the headers, so we can decide whether a response is
+    worth reading before any of its body comes over the wire.
+
+    :param dict headers: A dict of response headers.
+    :rtype: bool
+    :returns: True if the response looks like something we can pull links
+        and images out of.
+    """
+
+    # TODO: Might consider making these exceptions.
+    if 'content-type' not in headers:
+        log.err('Missing Content-Type header. Skipping.')
+        return False
+    content_type = headers['content-type'].lower()
+    if 'text/html' not in content_type:
+        log.err('Content type "%s" not parseable. Skipping.' % content_type)
+        return False
+    return True
+
+
+def classify_links(link_urls):
+    """
+    Sort links into ones that point at images, ones worth crawling, and
+    junk. We go off of the scheme and the path's extension, since we don't
+    want to spend a fetch finding out.
+
+    :param set link_urls: Absolute link URLs found on a page.
+    :rtype: tuple
+    :returns: A tuple of sets in the form of (linked_image_url_set,
+        links_to_crawl_set). Anything else (binaries, mailto:, etc) is
+        dropped.
+    """
+
+    linked_image_url_set = set([])
+    links_to_crawl_set = set([])
+
+    for link_url in link_urls:
+        parsed_url = urlparse(link_url)
+        if parsed_url.scheme not in ('http', 'https'):
+            # mailto:, javascript:, tel:, and other things we can't crawl.
+            continue
+        extension = posixpath.splitext(parsed_url.path)[1].lower()
+        if extension in LINKED_IMAGE_EXTENSIONS:
+            linked_image_url_set.add(link_url)
+        elif extension not in SKIPPED_LINK_EXTENSIONS:
+            links_to_crawl_set.add(link_url)
+
+    return linked_image_url_set, links_to_crawl_set
+
+
+def _get_charset(headers):
+    """
+    :param dict headers: A dict of response headers.
+    :rtype: str
+    :returns: The charset from the Content-Type header, if there is one.
+    """
+
+    for param in headers.get('content-type', '').split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset':
+            return value.strip().strip('"\'')
+    return None
+
+
+def _get_incremental_decoder(charset):
+    """
+    Chunk boundaries can land in the middle of a multi-byte character, so we
+    need a decoder that keeps track of partial characters between chunks.
+    """
+
+    try:
+        return codecs.getincrementaldecoder(charset or 'utf-8')(errors='replace')
+    except LookupError:
+        # Somebody made up a charset. UTF-8 is our best guess.
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
 
 
 def _record_image(response_url, tag, image_response_url_set):
@@ -75,6 +314,10 @@ def _guess_absolute_response_url(response_url, relative_or_absolute_response_url
     :returns: A hopefully valid absolute URL.
     """
 
+    # Browsers ignore linebreaks and tabs in URLs, so we will too. This also
+    # keeps them from breaking our newline-delimited crawl messages.
+    relative_or_absolute_response_url = remove_cr_and_lf(
+        relative_or_absolute_response_url.strip())
     if relative_or_absolute_response_url.startswith('/'):
         # Definitely relative. This usually gives us something usable.
         return urljoin(response_url, relative_or_absolute_response_url)
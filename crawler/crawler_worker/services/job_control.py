@@ -0,0 +1,56 @@
+"""
+Keeps the worker's job control table (see
+:py:mod:`crawler.crawler_worker.lib.job_control`) up to date.
+"""
+
+import txredisapi
+from twisted.python import log
+from twisted.application.service import Service
+from twisted.internet import reactor
+
+from crawler.conf import REDIS_HOST, REDIS_PORT
+from crawler.crawler_worker.lib.job_control import get_job_control_table
+from crawler.lib.data_store import JOB_CONTROL_CHANNEL
+
+
+class _JobControlSubscriber(txredisapi.SubscriberProtocol):
+    """
+    Drops a job's cached entry whenever it gets stopped.
+    """
+
+    def connectionMade(self):
+        d = txredisapi.SubscriberProtocol.connectionMade(self)
+        d.addCallback(self._subscribe)
+        return d
+
+    def _subscribe(self, _):
+        # We might have missed something while we were disconnected.
+        get_job_control_table().clear()
+        log.msg("Subscribing to job control channel: %s" % JOB_CONTROL_CHANNEL)
+        return self.subscribe(JOB_CONTROL_CHANNEL)
+
+    def messageReceived(self, pattern, channel, message):
+        get_job_control_table().invalidate(message)
+
+
+class JobControlListenerService(Service):
+    """
+    Subscribes to the job control channel, reconnecting (and resubscribing)
+    if we lose Redis.
+    """
+
+    def __init__(self):
+        self.factory = None
+        self.connector = None
+
+    def startService(self):
+        Service.startService(self)
+        self.factory = txredisapi.SubscriberFactory()
+        self.factory.protocol = _JobControlSubscriber
+        self.connector = reactor.connectTCP(
+            REDIS_HOST, REDIS_PORT, self.factory)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.factory.stopTrying()
+        self.connector.disconnect()
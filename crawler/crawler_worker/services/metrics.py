@@ -0,0 +1,26 @@
+"""
+Serves the worker's metrics (see :py:mod:`crawler.lib.metrics`) over HTTP,
+for Prometheus to scrape. The profiler's control endpoint (see
+:py:mod:`crawler.crawler_worker.lib.profiling`) lives here too.
+"""
+
+from twisted.web.server import Site
+from twisted.web.resource import Resource
+from twisted.application import internet
+
+from crawler.conf import CRAWLER_METRICS_PORT
+from crawler.lib.metrics import MetricsResource
+from crawler.crawler_worker.lib.profiling import ProfileResource
+
+
+def get_metrics_service():
+    """
+    :returns: A service listening on ``CRAWLER_METRICS_PORT``, with the
+        metrics at /metrics and the profiler at /profile.
+    """
+
+    root = Resource()
+    root.putChild("metrics", MetricsResource())
+    root.putChild("profile", ProfileResource())
+    # noinspection PyUnresolvedReferences
+    return internet.TCPServer(CRAWLER_METRICS_PORT, Site(root))
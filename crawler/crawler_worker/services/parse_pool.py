@@ -0,0 +1,36 @@
+"""
+Keeps the parser process pool's lifetime tied to the worker's.
+"""
+
+from twisted.application.service import Service
+
+from crawler.crawler_worker.lib.parse_pool import start_parse_pool, \
+    stop_parse_pool
+
+
+class ParsePoolService(Service):
+    """
+    Starts the pool of parser processes used by the 'process' parser backend.
+    Add this before any other service, so we fork before there are sockets
+    (ZeroMQ, Redis, HTTP) for the children to inherit. Children started
+    later on, to replace ones that exited, close any they inherit.
+    """
+
+    def __init__(self, pool_size, max_tasks_per_child=0):
+        """
+        :param int pool_size: The number of parser processes to start. 0
+            means one per CPU.
+        :param int max_tasks_per_child: Replace each parser process after it
+            has parsed this many pages. 0 means never.
+        """
+
+        self.pool_size = pool_size
+        self.max_tasks_per_child = max_tasks_per_child
+
+    def startService(self):
+        Service.startService(self)
+        start_parse_pool(self.pool_size, self.max_tasks_per_child)
+
+    def stopService(self):
+        Service.stopService(self)
+        stop_parse_pool()
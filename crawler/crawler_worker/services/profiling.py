@@ -0,0 +1,38 @@
+"""
+Lets us start (and stop) profiling a running worker with SIGUSR2. See
+:py:mod:`crawler.crawler_worker.lib.profiling`.
+"""
+
+import os
+import signal
+
+from twisted.python import log
+from twisted.application.service import Service
+from twisted.internet import reactor
+
+from crawler.crawler_worker.lib.profiling import get_profiler
+
+
+class ProfilingSignalService(Service):
+    """
+    SIGUSR2 starts profiling with the defaults, or stops it early if it's
+    already going.
+    """
+
+    def __init__(self):
+        self.previous_handler = None
+
+    def startService(self):
+        Service.startService(self)
+        self.previous_handler = signal.signal(signal.SIGUSR2, self._toggle)
+        log.msg("Send SIGUSR2 to profile this worker (pid %d)." % os.getpid())
+
+    def stopService(self):
+        Service.stopService(self)
+        signal.signal(signal.SIGUSR2, self.previous_handler or signal.SIG_DFL)
+        get_profiler().stop()
+
+    def _toggle(self, signum, frame):
+        # Signal handlers can run in the middle of just about anything, so
+        # leave the real work for the reactor.
+        reactor.callFromThread(get_profiler().toggle)
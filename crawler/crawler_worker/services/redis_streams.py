@@ -0,0 +1,239 @@
+"""
+A pair of Redis Streams services that let the worker receive crawl jobs and
+delegate sub-urls it finds during the process of crawling. These are drop-in
+replacements for the ZeroMQ services, selected with ``QUEUE_BACKEND``.
+
+Unlike ZeroMQ, a stream entry isn't gone once we've read it. We only
+acknowledge it after every URL in it has been crawled. While we're working
+on it, we keep resetting its idle time. If we die first, another worker
+claims it once it has gone ``REDIS_STREAM_CLAIM_IDLE_MS`` without us
+touching or acknowledging it.
+"""
+
+from collections import deque
+
+from twisted.python import log
+from twisted.application.service import Service
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, Deferred, DeferredList
+from twisted.internet.task import LoopingCall, deferLater
+
+from crawler.conf import CRAWLER_MAX_IN_FLIGHT, REDIS_STREAM_CONSUMER, \
+    REDIS_STREAM_READ_COUNT, REDIS_STREAM_BLOCK_MS, \
+    REDIS_STREAM_CLAIM_IDLE_MS, REDIS_STREAM_CLAIM_INTERVAL, \
+    CRAWLER_MAX_HOST_WAITING
+from crawler.crawler_worker.lib.job_crawler import crawl_job_url, \
+    CRAWLS_IN_FLIGHT, CRAWLS_BACKLOGGED, CRAWLS_WAITING_ON_HOSTS
+from crawler.crawler_worker.lib.politeness import get_host_scheduler
+from crawler.lib.crawl_messages import decode_crawl_batch, count_crawl_batch
+from crawler.lib.redis_streams import add_stream_message, \
+    ensure_consumer_group, get_blocking_stream_conn, read_stream_entries, \
+    ack_stream_entries, claim_stale_entries, touch_stream_entries
+from crawler.lib.data_store import flush_image_records
+from crawler.lib.misc_utils import log_sampled
+from crawler.lib.tx_http import close_http_connection_pool
+
+
+class RedisStreamListenerService(Service):
+    """
+    Reads crawl batches from the stream through our consumer group. We only
+    read when we have room, so there's never more than a handful of entries
+    in our local backlog, and the rest stay in Redis for other workers. As
+    with the ZeroMQ listener, crawls waiting on a throttled host don't count
+    towards ``max_in_flight``.
+    """
+
+    def __init__(self, delegator_svc, max_in_flight=CRAWLER_MAX_IN_FLIGHT,
+                 consumer=REDIS_STREAM_CONSUMER):
+        """
+        :param RedisStreamDelegatorService delegator_svc: Used to hand off
+            any links we find while crawling.
+        :param int max_in_flight: The most crawls we'll have going at once.
+        :param str consumer: Our name within the consumer group.
+        """
+
+        self.delegator_svc = delegator_svc
+        self.max_in_flight = max_in_flight
+        self.consumer = consumer
+        self.in_flight = 0
+        # (entry_id, job_id, url, depth) tuples we haven't started yet.
+        self.backlog = deque()
+        # Stream entry ID -> number of its crawls that haven't finished.
+        self.entry_crawls_remaining = {}
+        self.blocking_conn = None
+        self._claim_loop = None
+        self._touch_loop = None
+        self._room_waiter = None
+
+    def startService(self):
+        Service.startService(self)
+        get_host_scheduler().observers.append(self._dispatch_backlog)
+        CRAWLS_IN_FLIGHT.set_function(lambda: self.in_flight)
+        CRAWLS_BACKLOGGED.set_function(lambda: len(self.backlog))
+        CRAWLS_WAITING_ON_HOSTS.set_function(
+            lambda: get_host_scheduler().waiting)
+        self._start().addErrback(log.err, "Stream listener failed to start.")
+
+    @inlineCallbacks
+    def _start(self):
+        yield ensure_consumer_group()
+        self.blocking_conn = yield get_blocking_stream_conn()
+        log.msg("Listener reading stream as consumer: %s" % self.consumer)
+        self._claim_loop = LoopingCall(self._claim_stale_entries)
+        self._claim_loop.start(REDIS_STREAM_CLAIM_INTERVAL, now=True)\
+            .addErrback(log.err, "Stream claim loop died.")
+        self._touch_loop = LoopingCall(self._touch_entries)
+        self._touch_loop.start(REDIS_STREAM_CLAIM_IDLE_MS / 3000.0, now=False)\
+            .addErrback(log.err, "Stream touch loop died.")
+        yield self._read_loop()
+
+    def stopService(self):
+        Service.stopService(self)
+        for loop in (self._claim_loop, self._touch_loop):
+            if loop and loop.running:
+                loop.stop()
+        if self.blocking_conn:
+            # Knocks the read loop out of its blocking read.
+            self.blocking_conn.disconnect()
+            self.blocking_conn = None
+        # Anything we haven't acknowledged gets claimed by another worker.
+        # Buffered image records still get written out, though.
+        return DeferredList([
+            flush_image_records(), close_http_connection_pool()])
+
+    def _has_room(self):
+        return not self.backlog and self._has_capacity()
+
+    def _has_capacity(self):
+        waiting = get_host_scheduler().waiting
+        return self.in_flight - waiting < self.max_in_flight and \
+            waiting < CRAWLER_MAX_HOST_WAITING
+
+    @inlineCallbacks
+    def _read_loop(self):
+        while self.running:
+            if not self._has_room():
+                self._room_waiter = Deferred()
+                yield self._room_waiter
+                continue
+
+            try:
+                entries = yield read_stream_entries(
+                    self.blocking_conn, self.consumer,
+                    REDIS_STREAM_READ_COUNT, REDIS_STREAM_BLOCK_MS)
+            except Exception:
+                if not self.running:
+                    break
+                log.err(None, "Failed to read from stream. Retrying shortly.")
+                yield deferLater(reactor, 1, lambda: None)
+                continue
+            self._queue_entries(entries)
+
+    @inlineCallbacks
+    def _claim_stale_entries(self):
+        """
+        Takes over entries whose consumer seems to have died. We only do
+        this when we've got room, since they'll keep until someone does.
+        """
+
+        if not self._has_room():
+            return
+        entries = yield claim_stale_entries(
+            self.consumer, REDIS_STREAM_CLAIM_IDLE_MS, REDIS_STREAM_READ_COUNT)
+        # If one of our own crawls is just slow, we might claim it back
+        # from ourselves. Don't crawl it twice.
+        entries = [entry for entry in entries
+                   if entry[0] not in self.entry_crawls_remaining]
+        if entries:
+            log.msg("Claimed %d stale stream entries." % len(entries))
+        self._queue_entries(entries)
+
+    def _touch_entries(self):
+        """
+        Keeps the entries we're still working on from looking stale to
+        other workers' :py:meth:`_claim_stale_entries`.
+        """
+
+        if not self.entry_crawls_remaining:
+            return
+        return touch_stream_entries(
+            self.consumer, self.entry_crawls_remaining.keys()).addErrback(
+            log.err, "Failed to touch in-progress stream entries.")
+
+    def _queue_entries(self, entries):
+        """
+        :param list entries: (entry_id, message) tuples from the stream.
+        """
+
+        finished_entry_ids = []
+        for entry_id, message in entries:
+            count_crawl_batch('listener', 'received', message)
+            try:
+                job_id, depth, urls = decode_crawl_batch(message)
+            except ValueError as exc:
+                log.err("Discarding malformed crawl message: %s" % exc)
+                finished_entry_ids.append(entry_id)
+                continue
+
+            log_sampled("Received %d URL(s) for job %s at depth %d.",
+                        len(urls), job_id, depth)
+            if not urls:
+                finished_entry_ids.append(entry_id)
+                continue
+            self.entry_crawls_remaining[entry_id] = len(urls)
+            self.backlog.extend((entry_id, job_id, url, depth) for url in urls)
+
+        if finished_entry_ids:
+            self._ack_entries(finished_entry_ids)
+        self._dispatch_backlog()
+
+    def _dispatch_backlog(self):
+        while self.backlog and self._has_capacity():
+            self._start_crawl(self.backlog.popleft())
+
+        if self._room_waiter and self._has_room():
+            waiter, self._room_waiter = self._room_waiter, None
+            waiter.callback(None)
+
+    def _start_crawl(self, crawl):
+        """
+        :param tuple crawl: An (entry_id, job_id, url, depth) tuple.
+        """
+
+        entry_id, job_id, url, depth = crawl
+        self.in_flight += 1
+        d = crawl_job_url(self.delegator_svc, job_id, url, depth)
+        d.addErrback(log.err, "Crawl failed for %s (job %s)" % (url, job_id))
+        d.addBoth(self._crawl_finished, entry_id)
+
+    def _crawl_finished(self, result, entry_id):
+        self.in_flight -= 1
+        self.entry_crawls_remaining[entry_id] -= 1
+        if not self.entry_crawls_remaining[entry_id]:
+            del self.entry_crawls_remaining[entry_id]
+            self._ack_entries([entry_id])
+        self._dispatch_backlog()
+
+    def _ack_entries(self, entry_ids):
+        ack_stream_entries(entry_ids).addErrback(
+            log.err, "Failed to acknowledge stream entries: %s" % entry_ids)
+
+
+class RedisStreamDelegatorService(Service):
+    """
+    Adds any sub-links we find back to the stream, where the first worker
+    with room will pick them up.
+    """
+
+    def send_message(self, message):
+        """
+        Matches the signature of ZeroMQDelegatorService so we can use them
+        interchangably in the job queue code.
+
+        :param str message: A batched crawler message.
+        """
+
+        count_crawl_batch('delegator', 'sent', message)
+        log_sampled("Delegating crawl batch (%d bytes).", len(message))
+        add_stream_message(message).addErrback(
+            log.err, "Failed to add delegated crawl batch to stream.")
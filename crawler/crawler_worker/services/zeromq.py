@@ -1,86 +1,295 @@
 """
 A pair of ZeroMQ services that let the worker receive crawl jobs and delegate
 sub-urls it finds during the process of crawling.
+
+Workers can talk to any number of web API instances (brokers). Optionally,
+they can also skip the brokers entirely for delegated links, pushing them
+straight to other workers instead (see ``CRAWLER_DELEGATION_MODE``).
 """
 
-import json
+from collections import deque
 
+import zmq
 from twisted.python import log
 from twisted.application.service import Service
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import DeferredList
+from twisted.internet.task import LoopingCall
 from txzmq import ZmqFactory, ZmqPullConnection, ZmqPushConnection, ZmqEndpoint
 
-from crawler.conf import ZMQ_PUSHER, ZMQ_REPEATER
-from crawler.crawler_worker.lib.job_crawler import crawl_job_url
+from crawler.conf import ZMQ_PUSHERS, ZMQ_REPEATERS, CRAWLER_MAX_IN_FLIGHT, \
+    CRAWLER_PULL_HWM, CRAWLER_DELEGATION_MODE, CRAWLER_PEER_BIND, \
+    CRAWLER_PEERS, ZMQ_BROADCAST_HWM, ZMQ_BROADCAST_RETRY_INTERVAL, \
+    CRAWLER_MAX_HOST_WAITING, CRAWLER_BROKER_CREDITS, \
+    CRAWLER_CREDIT_REFRESH_INTERVAL, CRAWLER_PEER_BUFFER_SIZE
+from crawler.crawler_worker.lib.job_crawler import crawl_job_url, \
+    CRAWLS_IN_FLIGHT, CRAWLS_BACKLOGGED, CRAWLS_WAITING_ON_HOSTS
+from crawler.crawler_worker.lib.politeness import get_host_scheduler
+from crawler.lib.crawl_messages import decode_crawl_batch, count_crawl_batch
+from crawler.lib.data_store import flush_image_records
+from crawler.lib.misc_utils import log_sampled
+from crawler.lib.tx_http import close_http_connection_pool
+from crawler.lib.zeromq import PushBacklog, CreditDealerConnection
+
+
+class _PeerPullConnection(ZmqPullConnection):
+    """
+    Where other workers delegate links to us directly. A small high water
+    mark and small TCP buffers keep ZeroMQ from buffering up a mountain of
+    work for us while we're busy. While we're paused, we leave whatever has
+    arrived where it is.
+    """
+
+    highWaterMark = CRAWLER_PULL_HWM
+
+    def __init__(self, factory):
+        self.is_paused = False
+        ZmqPullConnection.__init__(self, factory)
+        self.socket.set(zmq.RCVBUF, CRAWLER_PEER_BUFFER_SIZE)
+
+    def doRead(self):
+        # Same as txZMQ's, except that we check whether we've been paused
+        # between messages. Its own reads until there's nothing left.
+        while not self.is_paused and self.factory is not None:
+            if not self.socket.get(zmq.EVENTS) & zmq.POLLIN:
+                return
+            try:
+                message = self._readMultipart()
+            except zmq.ZMQError as exc:
+                if exc.errno == zmq.EAGAIN:
+                    continue
+                raise
+            log.callWithLogger(self, self.messageReceived, message)
+
+
+class _PeerPushConnection(ZmqPushConnection):
+    """
+    Used to delegate straight to other workers. Like the broadcaster, we keep
+    the high water mark small so busy workers get skipped.
+    """
+
+    highWaterMark = ZMQ_BROADCAST_HWM
+
+    def __init__(self, factory):
+        ZmqPushConnection.__init__(self, factory)
+        self.socket.set(zmq.SNDBUF, CRAWLER_PEER_BUFFER_SIZE)
 
 
 class ZeroMQListenerService(Service):
     """
-    This connects to the ZeroMQBroadcastService on the web API service daemon
-    and pulls crawling jobs.
+    This connects to the ZeroMQBroadcastService on each web API service
+    daemon and asks it for crawling jobs. In 'peer' delegation mode, we also
+    accept links delegated directly by other workers.
+
+    We only allow so many crawls to be in flight at once. Crawls that are
+    waiting their turn on a throttled host (see
+    :py:mod:`crawler.crawler_worker.lib.politeness`) don't count towards the
+    limit, up to ``CRAWLER_MAX_HOST_WAITING`` of them. Once we've got room
+    and nothing backlogged, we ask each broker for
+    ``CRAWLER_BROKER_CREDITS`` batches, and brokers never send us more than
+    we've asked for. That's what bounds the work that can pile up here:
+    at most that many batches per broker, so everything else waits with
+    the brokers for whichever worker asks first.
+
+    Peer delegation isn't asked for. While we're full, we stop reading from
+    the peer socket, and what piles up is bounded by ``CRAWLER_PULL_HWM``
+    and ``CRAWLER_PEER_BUFFER_SIZE`` on our end and the sender's.
     """
 
-    def __init__(self, delegator_svc):
+    def __init__(self, delegator_svc, max_in_flight=CRAWLER_MAX_IN_FLIGHT):
         """
 
         :param ZeroMQDelegatorService delegator_svc: If, during the process
             of crawling a page, we run into links to other pages, we send
             the link back to the ZeroMQRepeaterService running on the web API
             service, where the first available worker will grab it.
+        :param int max_in_flight: The most crawls we'll have going at once.
         """
 
-        self.conn = None
+        # One per broker.
+        self.broker_conns = []
+        # Only in 'peer' delegation mode.
+        self.peer_conn = None
         self.delegator_svc = delegator_svc
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        # (job_id, url, depth) tuples we've received but haven't started
+        # crawling yet. This only grows by what we asked the brokers for,
+        # plus whatever peers had buffered for us when we paused.
+        self.backlog = deque()
+        self.credit_loop = None
 
     def startService(self):
+        Service.startService(self)
         factory = ZmqFactory()
-        log.msg("Listener connecting to broadcaster: %s" % ZMQ_PUSHER)
-        endpoint = ZmqEndpoint('connect', ZMQ_PUSHER)
-        self.conn = ZmqPullConnection(factory, endpoint)
-        self.conn.onPull = self._message_received
+        for pusher in ZMQ_PUSHERS:
+            log.msg("Listener connecting to broadcaster: %s" % pusher)
+            conn = CreditDealerConnection(
+                factory, ZmqEndpoint('connect', pusher))
+            conn.onBatch = self._message_received
+            self.broker_conns.append(conn)
+        if CRAWLER_DELEGATION_MODE == 'peer':
+            log.msg("Listener binding for peer delegation on: %s" % (
+                CRAWLER_PEER_BIND))
+            self.peer_conn = _PeerPullConnection(factory)
+            self.peer_conn.addEndpoints(
+                [ZmqEndpoint('bind', CRAWLER_PEER_BIND)])
+            self.peer_conn.onPull = lambda message: \
+                self._message_received(message[0])
+        get_host_scheduler().observers.append(self._dispatch_backlog)
+        self.credit_loop = LoopingCall(self._refresh_credits)
+        self.credit_loop.start(CRAWLER_CREDIT_REFRESH_INTERVAL, now=False)\
+            .addErrback(log.err, "Credit refresh loop died.")
+        # Let the brokers know we're ready for work.
+        self._dispatch_backlog()
+        CRAWLS_IN_FLIGHT.set_function(lambda: self.in_flight)
+        CRAWLS_BACKLOGGED.set_function(lambda: len(self.backlog))
+        CRAWLS_WAITING_ON_HOSTS.set_function(
+            lambda: get_host_scheduler().waiting)
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.credit_loop and self.credit_loop.running:
+            self.credit_loop.stop()
+        for conn in self.broker_conns:
+            conn.shutdown()
+        self.broker_conns = []
+        if self.peer_conn:
+            self.peer_conn.shutdown()
+            self.peer_conn = None
+        # Write out any buffered image records, and shut down any idle
+        # keep-alive connections to the sites we crawled.
+        return DeferredList([
+            flush_image_records(), close_http_connection_pool()])
 
-    @inlineCallbacks
     def _message_received(self, message):
         """
-        We've received a crawl broadcast. Take it and get to work.
+        We've received a crawl broadcast. Split the batch up into individual
+        crawls, queue them, and get to work if we've got room.
 
-        :param str message: A JSON crawler message.
+        :param str message: A batched crawler message.
         """
 
-        # Not really sure why this is always a single-member list. Hopefully
-        # this doesn't break anything.
-        message = message[0]
-        log.msg("Message received: %s" % message)
-        message_dict = json.loads(message)
-        message_dict['depth'] = int(message_dict['depth'])
-        # Don't use dict expansion in a prod environment. Breaks with
-        # message format changes.
-        yield crawl_job_url(self.delegator_svc, **message_dict)
+        count_crawl_batch('listener', 'received', message)
+        try:
+            job_id, depth, urls = decode_crawl_batch(message)
+        except ValueError as exc:
+            log.err("Discarding malformed crawl message: %s" % exc)
+            return
+
+        log_sampled("Received %d URL(s) for job %s at depth %d.",
+                    len(urls), job_id, depth)
+        self.backlog.extend((job_id, url, depth) for url in urls)
+        self._dispatch_backlog()
+
+    def _dispatch_backlog(self):
+        """
+        Start as many backlogged crawls as our in-flight limit allows. If
+        we've still got room after that, ask for more work.
+        """
+
+        while self.backlog and self._has_capacity():
+            self._start_crawl(self.backlog.popleft())
+
+        has_capacity = self._has_capacity()
+        if has_capacity and not self.backlog:
+            for conn in self.broker_conns:
+                if conn.outstanding < CRAWLER_BROKER_CREDITS:
+                    conn.request(CRAWLER_BROKER_CREDITS)
+        if self.peer_conn:
+            self._set_peer_paused(not has_capacity)
+
+    def _has_capacity(self):
+        waiting = get_host_scheduler().waiting
+        return self.in_flight - waiting < self.max_in_flight and \
+            waiting < CRAWLER_MAX_HOST_WAITING
+
+    def _start_crawl(self, crawl):
+        """
+        :param tuple crawl: A (job_id, url, depth) tuple.
+        """
+
+        job_id, url, depth = crawl
+        self.in_flight += 1
+        d = crawl_job_url(self.delegator_svc, job_id, url, depth)
+        d.addErrback(log.err, "Crawl failed for %s (job %s)" % (url, job_id))
+        d.addBoth(self._crawl_finished)
+
+    def _crawl_finished(self, result):
+        self.in_flight -= 1
+        self._dispatch_backlog()
+
+    def _refresh_credits(self):
+        for conn in self.broker_conns:
+            conn.refresh(CRAWLER_CREDIT_REFRESH_INTERVAL)
+
+    def _set_peer_paused(self, is_paused):
+        """
+        Stop (or start again) reading from the peer socket. Anything ZeroMQ
+        has buffered for us stays there (or with the sender) until we
+        resume.
+        """
+
+        if self.peer_conn.is_paused == is_paused:
+            return
+        self.peer_conn.is_paused = is_paused
+        if not is_paused:
+            # ZeroMQ's file descriptor is edge-triggered, so it won't wake
+            # us up for messages that arrived while we weren't reading.
+            reactor.callLater(0, self.peer_conn.doRead)
 
 
 class ZeroMQDelegatorService(Service):
     """
-    This is an outbound PUSH connection to the web API ZeroMQRepeaterService
+    This is an outbound PUSH connection to the web API ZeroMQRepeaterServices
     that allows a worker to delegate any sub-links it finds (instead of taking
-    a detour to crawl them on their own).
+    a detour to crawl them on their own). With more than one repeater, ZeroMQ
+    round-robins between them.
+
+    In 'peer' delegation mode, we push to the other workers' listeners
+    directly instead, so delegated links don't have to pass through a broker.
     """
 
-    def __init__(self):
+    def __init__(self, delegation_mode=CRAWLER_DELEGATION_MODE):
+        """
+        :param str delegation_mode: Either 'broker' or 'peer'.
+        """
+
+        self.delegation_mode = delegation_mode
         self.conn = None
+        self.backlog = None
 
     def startService(self):
         factory = ZmqFactory()
-        log.msg("Delegator connecting to repeater: %s" % ZMQ_REPEATER)
-        endpoint = ZmqEndpoint('connect', ZMQ_REPEATER)
-        self.conn = ZmqPushConnection(factory, endpoint)
+        if self.delegation_mode == 'peer':
+            if not CRAWLER_PEERS:
+                raise ValueError("Peer delegation requires CRAWLER_PEERS.")
+            self.conn = _PeerPushConnection(factory)
+            targets = CRAWLER_PEERS
+        else:
+            self.conn = ZmqPushConnection(factory)
+            targets = ZMQ_REPEATERS
+
+        endpoints = []
+        for target in targets:
+            log.msg("Delegator connecting to %s: %s" % (
+                self.delegation_mode, target))
+            endpoints.append(ZmqEndpoint('connect', target))
+        self.conn.addEndpoints(endpoints)
+        self.backlog = PushBacklog(self.conn, ZMQ_BROADCAST_RETRY_INTERVAL)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.backlog.stop()
 
     def send_message(self, message):
         """
         Matches the signature of ZeroMQBroadcastService so we can use them
         interchangably in the job queue code.
 
-        :param str message: A JSON crawler message.
+        :param str message: A batched crawler message.
         """
 
-        log.msg("Delegating job: %s" % message)
-        self.conn.push(message)
+        count_crawl_batch('delegator', 'sent', message)
+        log_sampled("Delegating crawl batch (%d bytes).", len(message))
+        self.backlog.push(message)
@@ -0,0 +1,105 @@
+"""
+Encoding and decoding of the crawl announcements that get passed between
+the web API, the repeater, and the workers. Each message is a batch: one
+job header (ID and depth) followed by any number of URLs.
+
+There are two wire formats:
+
+* JSON: ``{"job_id": ..., "depth": ..., "urls": [...]}``
+* Compact: a marker byte, followed by a zlib-compressed, newline-delimited
+  body of job ID, depth, then one URL per line.
+
+:py:func:`decode_crawl_batch` figures out which one it was handed, and also
+understands the older one-URL-per-message JSON format.
+"""
+
+import json
+import zlib
+
+from crawler.conf import CRAWL_MESSAGE_COMPACT
+from crawler.lib import metrics
+
+# JSON messages always start with '{', so this can't be confused with one.
+COMPACT_MESSAGE_MARKER = '\x01'
+
+QUEUE_MESSAGES = metrics.counter(
+    'crawler_queue_messages_total',
+    "Crawl batches sent or received, by queue (broadcast, repeater, listener "
+    "or delegator) and direction.",
+    ['queue', 'direction'])
+QUEUE_BYTES = metrics.counter(
+    'crawler_queue_bytes_total',
+    "Bytes of crawl batches sent or received, by queue and direction.",
+    ['queue', 'direction'])
+
+
+def encode_crawl_batch(job_id, depth, urls, compact=CRAWL_MESSAGE_COMPACT):
+    """
+    :param str job_id: The job ID that these URLs fall under.
+    :param int depth: The depth that these crawls will be at.
+    :param list urls: The URLs to crawl.
+    :param bool compact: If True, use the compact binary encoding.
+    :rtype: str
+    :returns: A message, ready to send over the wire.
+    """
+
+    if compact:
+        lines = [job_id, str(depth)]
+        lines.extend(urls)
+        # URLs come in as both unicode and UTF-8 byte strings. Joining a mix
+        # would have Python decode the byte strings as ASCII, so everything
+        # gets to be bytes first.
+        body = '\n'.join(
+            line.encode('utf-8') if isinstance(line, unicode) else line
+            for line in lines)
+        return COMPACT_MESSAGE_MARKER + zlib.compress(body)
+
+    return json.dumps({
+        'job_id': job_id,
+        'depth': depth,
+        'urls': list(urls),
+    })
+
+
+def decode_crawl_batch(message):
+    """
+    :param str message: A message, as encoded by :py:func:`encode_crawl_batch`.
+    :rtype: tuple
+    :returns: A tuple in the form of (job_id, depth, url_list).
+    :raises: ValueError if the message is malformed.
+    """
+
+    if message.startswith(COMPACT_MESSAGE_MARKER):
+        try:
+            body = zlib.decompress(message[1:]).decode('utf-8')
+        except (zlib.error, UnicodeDecodeError) as exc:
+            raise ValueError("Undecodable compact crawl message: %s" % exc)
+        lines = body.split(u'\n')
+        if len(lines) < 2:
+            raise ValueError("Compact crawl message is missing its header.")
+        return lines[0], int(lines[1]), lines[2:]
+
+    message_dict = json.loads(message)
+    try:
+        if 'urls' in message_dict:
+            urls = message_dict['urls']
+        else:
+            # Single-URL messages from before batching was a thing.
+            urls = [message_dict['url']]
+        return message_dict['job_id'], int(message_dict['depth']), urls
+    except (KeyError, TypeError) as exc:
+        raise ValueError("Malformed crawl message: %s" % exc)
+
+
+def count_crawl_batch(queue, direction, message):
+    """
+    Records a crawl batch in the queue metrics.
+
+    :param str queue: Which queue it went through: 'broadcast', 'repeater',
+        'listener' or 'delegator'.
+    :param str direction: 'sent' or 'received'.
+    :param str message: The batch, as it went over the wire.
+    """
+
+    QUEUE_MESSAGES.inc(queue=queue, direction=direction)
+    QUEUE_BYTES.inc(len(message), queue=queue, direction=direction)
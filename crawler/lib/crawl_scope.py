@@ -0,0 +1,164 @@
+"""
+Per-job rules for which links are worth following. Open-web seeds link off
+to every social network and ad server going, so without these a job's
+fan-out gets away from it in a hurry.
+
+A job's rules are plain data (see :py:meth:`CrawlScope.to_dict`), stored
+with its budget. Workers compile them into a :py:class:`CrawlScope` once
+per job, and run every link they find through it before delegating.
+"""
+
+import re
+import urllib
+import urlparse
+
+# 'any' follows links anywhere. 'host' stays on the seeds' hosts. 'domain'
+# also allows their subdomains.
+SCOPE_MODES = ('any', 'host', 'domain')
+
+
+def get_host(url):
+    """
+    :param str url: An absolute URL.
+    :rtype: str
+    :returns: The URL's lowercased hostname, without the port.
+    """
+
+    return (urlparse.urlsplit(url).hostname or '').lower()
+
+
+def get_domain(host):
+    """
+    We don't carry a public suffix list around, so a host's "domain" is
+    just the host without any leading ``www.``.
+
+    :param str host: A lowercased hostname.
+    :rtype: str
+    """
+
+    if host.startswith('www.'):
+        return host[4:]
+    return host
+
+
+class CrawlScope(object):
+    """
+    A job's compiled scope rules.
+    """
+
+    def __init__(self, mode='any', seed_hosts=(), include=(), exclude=(),
+                 strip_params=()):
+        """
+        :param str mode: One of ``SCOPE_MODES``.
+        :param seed_hosts: The hosts of the job's seed URLs.
+        :param include: Regexes. If there are any, a link has to match at
+            least one of them.
+        :param exclude: Regexes. Links that match any of these are dropped.
+        :param strip_params: Query parameters to remove from links, such as
+            ``utm_source``. A trailing ``*`` matches any parameter starting
+            with what comes before it (``utm_*``).
+        :raises: ValueError if the mode is unknown, or a regex is invalid.
+        """
+
+        if mode not in SCOPE_MODES:
+            raise ValueError("Scope must be one of: %s" % ', '.join(SCOPE_MODES))
+        self.mode = mode
+        self.seed_hosts = set(host.lower() for host in seed_hosts)
+        self.seed_domains = set(get_domain(host) for host in self.seed_hosts)
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.strip_params = list(strip_params)
+        try:
+            self._include_res = [re.compile(pattern) for pattern in include]
+            self._exclude_res = [re.compile(pattern) for pattern in exclude]
+        except re.error as exc:
+            raise ValueError("Invalid scope regex: %s" % exc)
+        self._stripped_names = set(
+            name for name in strip_params if not name.endswith('*'))
+        self._stripped_prefixes = tuple(
+            name[:-1] for name in strip_params if name.endswith('*'))
+
+    @classmethod
+    def from_dict(cls, rules):
+        """
+        :param dict rules: Rules, as returned by :py:meth:`to_dict`.
+        :rtype: CrawlScope
+        """
+
+        return cls(
+            mode=rules.get('mode', 'any'),
+            seed_hosts=rules.get('seed_hosts', []),
+            include=rules.get('include', []),
+            exclude=rules.get('exclude', []),
+            strip_params=rules.get('strip_params', []))
+
+    def to_dict(self):
+        """
+        :rtype: dict
+        :returns: The rules as plain (JSON-friendly) data.
+        """
+
+        return {
+            'mode': self.mode,
+            'seed_hosts': sorted(self.seed_hosts),
+            'include': self.include,
+            'exclude': self.exclude,
+            'strip_params': self.strip_params,
+        }
+
+    def normalize(self, url):
+        """
+        Drops the URL's fragment, and any query parameters we strip.
+
+        :param str url: An absolute URL.
+        :rtype: str
+        """
+
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query and self.strip_params:
+            # Only look at the names. The pairs we keep go back exactly as
+            # they came, so we don't re-encode (or choke on) anything we
+            # weren't asked to touch.
+            query = '&'.join(
+                pair for pair in query.split('&')
+                if not self._is_stripped(
+                    urllib.unquote_plus(pair.split('=', 1)[0])))
+        return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+    def _is_stripped(self, name):
+        return name in self._stripped_names or \
+            name.startswith(self._stripped_prefixes)
+
+    def is_in_scope(self, url):
+        """
+        :param str url: An absolute (normalized) URL.
+        :rtype: bool
+        """
+
+        if self.mode != 'any':
+            host = get_host(url)
+            if self.mode == 'host' and host not in self.seed_hosts:
+                return False
+            if self.mode == 'domain' and not any(
+                    host == domain or host.endswith('.' + domain)
+                    for domain in self.seed_domains):
+                return False
+
+        if self._include_res and not any(
+                regex.search(url) for regex in self._include_res):
+            return False
+        return not any(regex.search(url) for regex in self._exclude_res)
+
+    def filter_links(self, urls):
+        """
+        :param set urls: Links found on one of the job's pages.
+        :rtype: set
+        :returns: The normalized links that are in scope.
+        """
+
+        links = set()
+        for url in urls:
+            url = self.normalize(url)
+            if self.is_in_scope(url):
+                links.add(url)
+        return links
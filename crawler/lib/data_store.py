@@ -4,28 +4,562 @@ case, it's Redis. If you cared enough to, you could probably turn this stuff
 into classes with overridable behavior, but I'm not a big fan of classes for
 the sake of classes. This example is on the simple side.
 
-.. note:: While we do use some pipelining, this set of functions have not
-    been optimized. There is quite a bit of room for improvement, but probably
-    at the sake of readability and simplicity.
+.. note:: The job's state changes (creating it, claiming a URL, completing
+    URLs, enqueueing new ones, stopping it) each run as a single Lua script,
+    which also keeps a hash of counters up to date. The read side is still
+    plain pipelined commands.
 """
 
+import hashlib
+import json
+import time
 import uuid
+import zlib
 
 import txredisapi
 from twisted.python import log
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, \
+    succeed, gatherResults
 
-from crawler.conf import REDIS_HOST, REDIS_PORT
+from crawler.conf import REDIS_HOST, REDIS_PORT, JOB_URL_DEDUP_MODE, \
+    JOB_URL_BLOOM_BITS, JOB_URL_BLOOM_HASHES, RECORD_FLUSH_MAX_URLS, \
+    RECORD_FLUSH_INTERVAL, JOB_STORAGE_LAYOUT, JOB_ARCHIVE_TTL, \
+    JOB_COMPACT_READ_PAGE_SIZE
+from crawler.lib import metrics
+from crawler.lib.json_encoder import JobDataEncoder
+from crawler.lib.misc_utils import log_sampled
 
 # NOTE: We're not multi-threaded currently. If you were to introduce a
 # threadpool, this would probably be a bad idea.
 __JOB_DATA_REDIS_CONN = None
+# Lazy-loaded by _get_image_record_buffer().
+__IMAGE_RECORD_BUFFER = None
+
+REDIS_SECONDS = metrics.histogram(
+    'crawler_redis_seconds',
+    "Time taken by Redis scripts and pipelines, by operation.",
+    ['operation'])
+RECORDED_URLS = metrics.counter(
+    'crawler_recorded_urls_total',
+    "Crawled URLs (and their images) written out by the record buffer.")
+
+# A set of the IDs of every job that still has live (unarchived) keys.
+JOBS_INDEX_KEY = 'jobs'
+# Whenever a job is stopped (cancelled, or out of budget), its ID gets
+# published here so workers can drop their cached copy of its budget.
+JOB_CONTROL_CHANNEL = 'job_control'
+# As a job makes progress, events describing it (see
+# _PUBLISH_JOB_EVENT_LUA) are published to this prefix plus its ID.
+JOB_EVENTS_CHANNEL_PREFIX = 'job_events:'
+# The last event a job gets, once it has been archived.
+JOB_ARCHIVED_EVENT = json.dumps({'archived': True})
+# The budget fields a job can be created with. See create_job().
+JOB_BUDGET_FIELDS = ('max_pages', 'max_bytes', 'max_depth', 'deadline')
+
+# The job sets that can be paged through with get_job_set_page(), mapped to
+# their key names from _get_job_keys().
+JOB_SET_KEYS = {
+    'urls': 'all_urls_key',
+    'pending': 'crawls_pending_key',
+    'in_progress': 'crawls_in_progress_key',
+    'completed': 'crawls_completed_key',
+    'failed': 'crawls_failed_key',
+    'images': 'images_key',
+}
+# The same sets, by their names in get_job_data()'s return value.
+_JOB_DATA_SET_NAMES = {
+    'urls': 'all_urls',
+    'pending': 'crawls_pending',
+    'in_progress': 'crawls_in_progress',
+    'completed': 'crawls_completed',
+    'failed': 'crawls_failed',
+    'images': 'images',
+}
+# The same sets in the compact layout, as (list key, state bitmap key).
+_COMPACT_JOB_SET_KEYS = {
+    'urls': ('url_list_key', None),
+    'pending': ('url_list_key', 'pending_bits_key'),
+    'in_progress': ('url_list_key', 'in_progress_bits_key'),
+    'completed': ('url_list_key', 'completed_bits_key'),
+    'failed': ('url_list_key', 'failed_bits_key'),
+    'images': ('image_list_key', None),
+}
+# How many hex characters of a fingerprint pick its bucket. 3 gives us 4096
+# buckets, which stay listpack-encoded (with Redis's default of 128 entries
+# per small hash) up to around half a million URLs per job.
+_FINGERPRINT_BUCKET_CHARS = 3
+
+# Job state changes run server-side as Lua scripts, so each one is a single
+# atomic EVALSHA rather than a handful of separate commands. Each script also
+# keeps the job's counters hash in step with its sets, so status checks don't
+# need to touch the sets at all.
+
+# Shared by the complete and fail scripts. A job's budget lives in its
+# control hash, next to a "stopped" field that holds why it was stopped (if
+# it was). Once a job has been through max_pages pages (crawled or failed)
+# or max_bytes bytes, we stop it and let the workers know. Returns why we
+# stopped it, or false if we didn't.
+_CHECK_BUDGET_LUA = """
+local function check_budget(job_id, counters_key, control_key)
+    local control = redis.call('HMGET', control_key, 'max_pages', 'max_bytes',
+                               'stopped')
+    if control[3] or not (control[1] or control[2]) then
+        return false
+    end
+    local counters = redis.call('HMGET', counters_key, 'completed', 'failed',
+                                'bytes')
+    local pages = tonumber(counters[1] or 0) + tonumber(counters[2] or 0)
+    local reason = false
+    if control[1] and pages >= tonumber(control[1]) then
+        reason = 'max_pages'
+    elseif control[2] and tonumber(counters[3] or 0) >= tonumber(control[2]) then
+        reason = 'max_bytes'
+    end
+    if not reason then
+        return false
+    end
+    redis.call('HSET', control_key, 'stopped', reason)
+    redis.call('PUBLISH', '%(channel)s', job_id)
+    return reason
+end
+""" % {'channel': JOB_CONTROL_CHANNEL}
+
+# Shared by the scripts that change a job's progress. Publishes an event
+# with whatever changed (any of "completed", "failed" and "images", each a
+# list of URLs that are new to that set, and "stopped" with why the job was
+# stopped), plus all of the job's counters after the change. Publishing with
+# nobody listening costs next to nothing, so we don't bother checking.
+_PUBLISH_JOB_EVENT_LUA = """
+local function publish_job_event(job_id, counters_key, event)
+    local counters = redis.call('HGETALL', counters_key)
+    event['counters'] = {}
+    for i = 1, #counters, 2 do
+        event['counters'][counters[i]] = tonumber(counters[i + 1])
+    end
+    redis.call('PUBLISH', '%(prefix)s' .. job_id, cjson.encode(event))
+end
+""" % {'prefix': JOB_EVENTS_CHANNEL_PREFIX}
+
+# Shared by the create and enqueue scripts. Adds each URL we haven't seen yet
+# to the job's pending set, and returns the new ones. With num_hashes of 0,
+# the all_urls set doubles as our "seen" set. Otherwise seen_key is a Bloom
+# filter bitmap, and each URL in args is followed by its num_hashes bit
+# offsets. In Bloom mode, we only keep the URLs in all_urls if keep_urls is
+# set, since not keeping them around is the whole point.
+_ENQUEUE_URLS_LUA = """
+local function enqueue_urls(all_urls_key, pending_key, seen_key, counters_key,
+                            num_hashes, keep_urls, args, first)
+    local unseen = {}
+    local i = first
+    while i <= #args do
+        local url = args[i]
+        local is_new = false
+        if num_hashes == 0 then
+            is_new = redis.call('SADD', all_urls_key, url) == 1
+        else
+            for j = 1, num_hashes do
+                if redis.call('SETBIT', seen_key, args[i + j], 1) == 0 then
+                    is_new = true
+                end
+            end
+            if is_new and keep_urls then
+                redis.call('SADD', all_urls_key, url)
+            end
+        end
+        if is_new then
+            redis.call('SADD', pending_key, url)
+            table.insert(unseen, url)
+        end
+        i = i + num_hashes + 1
+    end
+    if #unseen > 0 then
+        redis.call('HINCRBY', counters_key, 'urls', #unseen)
+        redis.call('HINCRBY', counters_key, 'pending', #unseen)
+    end
+    return unseen
+end
+"""
+
+# KEYS: all_urls, pending, seen, counters, the jobs index, control. ARGV:
+# the job ID, num_hashes, then the seed URLs (see enqueue_urls). Returns 0 if
+# the job already exists.
+_CREATE_JOB_SCRIPT = _ENQUEUE_URLS_LUA + """
+if redis.call('EXISTS', KEYS[4]) == 1 then
+    return 0
+end
+redis.call('HMSET', KEYS[4], 'urls', 0, 'pending', 0, 'in_progress', 0,
+           'completed', 0, 'failed', 0, 'images', 0, 'bytes', 0)
+redis.call('SADD', KEYS[5], ARGV[1])
+enqueue_urls(KEYS[1], KEYS[2], KEYS[3], KEYS[4], tonumber(ARGV[2]), true,
+             ARGV, 3)
+return 1
+"""
+
+# Same KEYS as above. ARGV: num_hashes, then the discovered URLs (see
+# enqueue_urls). Returns the URLs that were new, or nothing at all if the job
+# has been stopped or archived (or never existed).
+_ENQUEUE_URLS_SCRIPT = _ENQUEUE_URLS_LUA + """
+if redis.call('EXISTS', KEYS[4]) == 0 or
+        redis.call('HEXISTS', KEYS[6], 'stopped') == 1 then
+    return {}
+end
+return enqueue_urls(KEYS[1], KEYS[2], KEYS[3], KEYS[4], tonumber(ARGV[1]),
+                    false, ARGV, 2)
+"""
+
+# KEYS: pending, in_progress, completed, counters, failed, control. ARGV:
+# the URL. Moves the URL from pending to in progress. Returns 0 if it has
+# already been crawled (or given up on), or if the job is stopped or gone. A
+# URL that's already in progress is claimable again, in case whoever had it
+# before died.
+_CLAIM_URL_SCRIPT = """
+if redis.call('EXISTS', KEYS[4]) == 0 or
+        redis.call('HEXISTS', KEYS[6], 'stopped') == 1 then
+    return 0
+end
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 1 or
+        redis.call('SISMEMBER', KEYS[5], ARGV[1]) == 1 then
+    return 0
+end
+if redis.call('SMOVE', KEYS[1], KEYS[2], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[4], 'pending', -1)
+    redis.call('HINCRBY', KEYS[4], 'in_progress', 1)
+end
+return 1
+"""
+
+# KEYS: pending, in_progress, completed, failed, counters, control. ARGV: the
+# URL, the job ID. Gives up on a URL that we couldn't fetch, moving it to the
+# failed set. Returns 0 if it had already been crawled or given up on, or the
+# job is gone.
+_FAIL_URL_SCRIPT = _CHECK_BUDGET_LUA + _PUBLISH_JOB_EVENT_LUA + """
+if redis.call('EXISTS', KEYS[5]) == 0 then
+    return 0
+end
+if redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 1 then
+    return 0
+end
+if redis.call('SADD', KEYS[4], ARGV[1]) == 0 then
+    return 0
+end
+if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[5], 'in_progress', -1)
+elseif redis.call('SREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HINCRBY', KEYS[5], 'pending', -1)
+end
+redis.call('HINCRBY', KEYS[5], 'failed', 1)
+local stopped = check_budget(ARGV[2], KEYS[5], KEYS[6])
+publish_job_event(ARGV[2], KEYS[5], {failed = {ARGV[1]}, stopped = stopped or nil})
+return 1
+"""
+
+# Marks URLs as completed and records their images, for any number of jobs.
+# KEYS: pending, in_progress, completed, images, counters, control for each
+# job. ARGV: for each job, the job ID, the number of URLs and images, and the
+# bytes we downloaded for them, followed by the URLs and then the images.
+# Jobs that are gone are skipped.
+_COMPLETE_URLS_SCRIPT = _CHECK_BUDGET_LUA + _PUBLISH_JOB_EVENT_LUA + """
+local arg = 1
+for k = 1, #KEYS, 6 do
+    local job_id = ARGV[arg]
+    local num_urls = tonumber(ARGV[arg + 1])
+    local num_images = tonumber(ARGV[arg + 2])
+    local num_bytes = tonumber(ARGV[arg + 3])
+    local first_url = arg + 4
+    local first_image = first_url + num_urls
+    arg = first_image + num_images
+
+    if redis.call('EXISTS', KEYS[k + 4]) == 1 then
+        local completed, was_pending, was_in_progress = 0, 0, 0
+        local event = {}
+        for i = first_url, first_image - 1 do
+            if redis.call('SADD', KEYS[k + 2], ARGV[i]) == 1 then
+                completed = completed + 1
+                event['completed'] = event['completed'] or {}
+                table.insert(event['completed'], ARGV[i])
+                if redis.call('SREM', KEYS[k + 1], ARGV[i]) == 1 then
+                    was_in_progress = was_in_progress + 1
+                elseif redis.call('SREM', KEYS[k], ARGV[i]) == 1 then
+                    was_pending = was_pending + 1
+                end
+            end
+        end
+
+        local images = 0
+        for i = first_image, arg - 1 do
+            if redis.call('SADD', KEYS[k + 3], ARGV[i]) == 1 then
+                images = images + 1
+                event['images'] = event['images'] or {}
+                table.insert(event['images'], ARGV[i])
+            end
+        end
+
+        redis.call('HINCRBY', KEYS[k + 4], 'completed', completed)
+        -- Careful: -0 gets passed to Redis as '-0', which HINCRBY rejects.
+        redis.call('HINCRBY', KEYS[k + 4], 'pending', 0 - was_pending)
+        redis.call('HINCRBY', KEYS[k + 4], 'in_progress', 0 - was_in_progress)
+        redis.call('HINCRBY', KEYS[k + 4], 'images', images)
+        redis.call('HINCRBY', KEYS[k + 4], 'bytes', num_bytes)
+        event['stopped'] = check_budget(job_id, KEYS[k + 4], KEYS[k + 5]) or nil
+        publish_job_event(job_id, KEYS[k + 4], event)
+    end
+end
+return 1
+"""
+
+# The compact layout (JOB_STORAGE_LAYOUT = 'compact') keeps each URL string
+# exactly once, in a list, so a URL's ID is its index in that list. Which
+# state a URL is in is a bit in one of four bitmaps. To get from a URL back
+# to its ID, we keep a 64-bit fingerprint of each URL, spread over a bunch of
+# small hashes so that Redis can store them as compact listpacks. Images get
+# the same treatment: a list of image URLs, deduped by fingerprint.
+
+# Shared by the compact create and enqueue scripts. Each URL in ARGV (from
+# first_arg on) is followed by its fingerprint's field, and each URL's
+# fingerprint bucket key is in KEYS, starting at first_bucket.
+_ENQUEUE_URLS_COMPACT_LUA = """
+local function enqueue_urls(url_list_key, pending_bits_key, counters_key,
+                            first_bucket, first_arg)
+    local unseen = {}
+    local next_id = redis.call('LLEN', url_list_key)
+    for i = first_arg, #ARGV, 2 do
+        local bucket_key = KEYS[first_bucket + (i - first_arg) / 2]
+        if redis.call('HSETNX', bucket_key, ARGV[i + 1], next_id) == 1 then
+            redis.call('RPUSH', url_list_key, ARGV[i])
+            redis.call('SETBIT', pending_bits_key, next_id, 1)
+            next_id = next_id + 1
+            table.insert(unseen, ARGV[i])
+        end
+    end
+    if #unseen > 0 then
+        redis.call('HINCRBY', counters_key, 'urls', #unseen)
+        redis.call('HINCRBY', counters_key, 'pending', #unseen)
+    end
+    return unseen
+end
+"""
+
+# KEYS: url_list, pending_bits, counters, the jobs index, control, then the
+# URL fingerprint buckets. ARGV: the job ID, then (URL, fingerprint field)
+# pairs. Returns 0 if the job already exists.
+_CREATE_JOB_COMPACT_SCRIPT = _ENQUEUE_URLS_COMPACT_LUA + """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+redis.call('HMSET', KEYS[3], 'urls', 0, 'pending', 0, 'in_progress', 0,
+           'completed', 0, 'failed', 0, 'images', 0, 'bytes', 0)
+redis.call('SADD', KEYS[4], ARGV[1])
+enqueue_urls(KEYS[1], KEYS[2], KEYS[3], 6, 2)
+return 1
+"""
+
+# Same KEYS as above, and the same ARGV minus the job ID. Returns the URLs
+# that were new, or nothing at all if the job is stopped or gone.
+_ENQUEUE_URLS_COMPACT_SCRIPT = _ENQUEUE_URLS_COMPACT_LUA + """
+if redis.call('EXISTS', KEYS[3]) == 0 or
+        redis.call('HEXISTS', KEYS[5], 'stopped') == 1 then
+    return {}
+end
+return enqueue_urls(KEYS[1], KEYS[2], KEYS[3], 6, 1)
+"""
+
+# KEYS: the URL's fingerprint bucket, pending_bits, in_progress_bits,
+# completed_bits, counters, failed_bits, control. ARGV: the URL's
+# fingerprint field. A URL we've never heard of is left for the crawler to
+# deal with, but one for a job that's stopped or gone isn't.
+_CLAIM_URL_COMPACT_SCRIPT = """
+if redis.call('EXISTS', KEYS[5]) == 0 or
+        redis.call('HEXISTS', KEYS[7], 'stopped') == 1 then
+    return 0
+end
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if not id then
+    return 1
+end
+if redis.call('GETBIT', KEYS[4], id) == 1 or
+        redis.call('GETBIT', KEYS[6], id) == 1 then
+    return 0
+end
+if redis.call('SETBIT', KEYS[2], id, 0) == 1 then
+    redis.call('SETBIT', KEYS[3], id, 1)
+    redis.call('HINCRBY', KEYS[5], 'pending', -1)
+    redis.call('HINCRBY', KEYS[5], 'in_progress', 1)
+end
+return 1
+"""
+
+# KEYS: the URL's fingerprint bucket, pending_bits, in_progress_bits,
+# completed_bits, failed_bits, counters, control. ARGV: the URL's fingerprint
+# field, the job ID, the URL. The compact version of _FAIL_URL_SCRIPT.
+_FAIL_URL_COMPACT_SCRIPT = _CHECK_BUDGET_LUA + _PUBLISH_JOB_EVENT_LUA + """
+if redis.call('EXISTS', KEYS[6]) == 0 then
+    return 0
+end
+local id = redis.call('HGET', KEYS[1], ARGV[1])
+if not id or redis.call('GETBIT', KEYS[4], id) == 1 then
+    return 0
+end
+if redis.call('SETBIT', KEYS[5], id, 1) == 1 then
+    return 0
+end
+if redis.call('SETBIT', KEYS[3], id, 0) == 1 then
+    redis.call('HINCRBY', KEYS[6], 'in_progress', -1)
+elseif redis.call('SETBIT', KEYS[2], id, 0) == 1 then
+    redis.call('HINCRBY', KEYS[6], 'pending', -1)
+end
+redis.call('HINCRBY', KEYS[6], 'failed', 1)
+local stopped = check_budget(ARGV[2], KEYS[6], KEYS[7])
+publish_job_event(ARGV[2], KEYS[6], {failed = {ARGV[3]}, stopped = stopped or nil})
+return 1
+"""
+
+# Marks URLs as completed and records their images, for any number of jobs.
+# For each job, KEYS has pending_bits, in_progress_bits, completed_bits,
+# image_list, counters and control, then a fingerprint bucket for each URL
+# and image. ARGV has the job ID, the number of URLs and images, and the
+# bytes we downloaded for them, then a (URL, fingerprint field) pair for each
+# URL, then the same for each image. Jobs that are gone are skipped.
+_COMPLETE_URLS_COMPACT_SCRIPT = _CHECK_BUDGET_LUA + _PUBLISH_JOB_EVENT_LUA + """
+local key = 1
+local arg = 1
+while key <= #KEYS do
+    local pending_bits_key = KEYS[key]
+    local in_progress_bits_key = KEYS[key + 1]
+    local completed_bits_key = KEYS[key + 2]
+    local image_list_key = KEYS[key + 3]
+    local counters_key = KEYS[key + 4]
+    local control_key = KEYS[key + 5]
+    local job_id = ARGV[arg]
+    local num_urls = tonumber(ARGV[arg + 1])
+    local num_images = tonumber(ARGV[arg + 2])
+    local num_bytes = tonumber(ARGV[arg + 3])
+    key = key + 6
+    arg = arg + 4
+
+    if redis.call('EXISTS', counters_key) == 0 then
+        key = key + num_urls + num_images
+        arg = arg + (num_urls + num_images) * 2
+    else
+        local completed, was_pending, was_in_progress = 0, 0, 0
+        local event = {}
+        for i = 1, num_urls do
+            local id = redis.call('HGET', KEYS[key], ARGV[arg + 1])
+            if id and redis.call('SETBIT', completed_bits_key, id, 1) == 0 then
+                completed = completed + 1
+                event['completed'] = event['completed'] or {}
+                table.insert(event['completed'], ARGV[arg])
+                if redis.call('SETBIT', in_progress_bits_key, id, 0) == 1 then
+                    was_in_progress = was_in_progress + 1
+                elseif redis.call('SETBIT', pending_bits_key, id, 0) == 1 then
+                    was_pending = was_pending + 1
+                end
+            end
+            key = key + 1
+            arg = arg + 2
+        end
+
+        local images = 0
+        for i = 1, num_images do
+            if redis.call('HSETNX', KEYS[key], ARGV[arg + 1], 1) == 1 then
+                redis.call('RPUSH', image_list_key, ARGV[arg])
+                images = images + 1
+                event['images'] = event['images'] or {}
+                table.insert(event['images'], ARGV[arg])
+            end
+            key = key + 1
+            arg = arg + 2
+        end
+
+        -- Careful: -0 gets passed to Redis as '-0', which HINCRBY rejects.
+        redis.call('HINCRBY', counters_key, 'completed', completed)
+        redis.call('HINCRBY', counters_key, 'pending', 0 - was_pending)
+        redis.call('HINCRBY', counters_key, 'in_progress', 0 - was_in_progress)
+        redis.call('HINCRBY', counters_key, 'images', images)
+        redis.call('HINCRBY', counters_key, 'bytes', num_bytes)
+        event['stopped'] = check_budget(job_id, counters_key, control_key) or nil
+        publish_job_event(job_id, counters_key, event)
+    end
+end
+return 1
+"""
+
+# Expands part of a compact list back into strings. KEYS: a URL or image
+# list, plus an optional state bitmap to filter by. ARGV: the index to start
+# at and how many to look at (0 for all of them). Returns the next index to
+# start at (0 once we're done) and the matching strings.
+_READ_LIST_COMPACT_SCRIPT = """
+local start = tonumber(ARGV[1])
+local stop = -1
+if tonumber(ARGV[2]) > 0 then
+    stop = start + tonumber(ARGV[2]) - 1
+end
+local members = {}
+local entries = redis.call('LRANGE', KEYS[1], start, stop)
+for i, entry in ipairs(entries) do
+    if not KEYS[2] or redis.call('GETBIT', KEYS[2], start + i - 1) == 1 then
+        table.insert(members, entry)
+    end
+end
+local next_start = start + #entries
+if stop == -1 or next_start >= redis.call('LLEN', KEYS[1]) then
+    next_start = 0
+end
+return {next_start, members}
+"""
+
+# KEYS: counters, control. ARGV: the job ID, why we're stopping it. Returns
+# -1 if the job isn't live, 0 if it had already been stopped, or 1.
+_STOP_JOB_SCRIPT = _PUBLISH_JOB_EVENT_LUA + """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+if redis.call('HSETNX', KEYS[2], 'stopped', ARGV[2]) == 0 then
+    return 0
+end
+redis.call('PUBLISH', '%(channel)s', ARGV[1])
+publish_job_event(ARGV[1], KEYS[1], {stopped = ARGV[2]})
+return 1
+""" % {'channel': JOB_CONTROL_CHANNEL}
+
+_SCRIPTS = {
+    'create_job': _CREATE_JOB_SCRIPT,
+    'enqueue_urls': _ENQUEUE_URLS_SCRIPT,
+    'claim_url': _CLAIM_URL_SCRIPT,
+    'fail_url': _FAIL_URL_SCRIPT,
+    'complete_urls': _COMPLETE_URLS_SCRIPT,
+    'create_job_compact': _CREATE_JOB_COMPACT_SCRIPT,
+    'enqueue_urls_compact': _ENQUEUE_URLS_COMPACT_SCRIPT,
+    'claim_url_compact': _CLAIM_URL_COMPACT_SCRIPT,
+    'fail_url_compact': _FAIL_URL_COMPACT_SCRIPT,
+    'complete_urls_compact': _COMPLETE_URLS_COMPACT_SCRIPT,
+    'read_list_compact': _READ_LIST_COMPACT_SCRIPT,
+    'stop_job': _STOP_JOB_SCRIPT,
+}
+# Script name -> SHA1, filled in by _load_scripts().
+__SCRIPT_SHAS = {}
+
+
+def register_script(name, script):
+    """
+    Adds a Lua script to the ones we SCRIPT LOAD, so that other modules
+    keeping their own keys in our Redis (the page cache, the host scheduler)
+    can call it with :py:func:`run_script`. Do this at import time.
+
+    :param str name: What to call it. Must not clash with any other script.
+    :param str script: The script's source.
+    """
+
+    if _SCRIPTS.get(name, script) != script:
+        raise ValueError("There's already a script called %s." % name)
+    _SCRIPTS[name] = script
 
 
 @inlineCallbacks
-def _get_job_data_conn():
+def get_redis_conn():
     """
-    Lazy-load a Redis connection.
+    Lazy-load a Redis connection. Anything else that keeps its keys in the
+    same Redis should share this rather than open a pool of its own.
 
     :rtype: ConnectionPool
     :returns: A connection to Redis.
@@ -37,11 +571,68 @@ def _get_job_data_conn():
         returnValue(__JOB_DATA_REDIS_CONN)
 
     log.msg("Connecting to redis store: %s:%d" % (REDIS_HOST, REDIS_PORT))
-    __JOB_DATA_REDIS_CONN = yield txredisapi.ConnectionPool(
-        host=REDIS_HOST, port=REDIS_PORT)
+    conn = yield txredisapi.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT)
+    yield _load_scripts(conn)
+    __JOB_DATA_REDIS_CONN = conn
     returnValue(__JOB_DATA_REDIS_CONN)
 
 
+@inlineCallbacks
+def _load_scripts(conn):
+    """
+    SCRIPT LOADs our scripts, so they can be called by SHA from here on out.
+
+    :param ConnectionPool conn: A connection to Redis.
+    """
+
+    for name, script in _SCRIPTS.items():
+        __SCRIPT_SHAS[name] = yield conn.script_load(script)
+
+
+@inlineCallbacks
+def run_script(name, keys, args):
+    """
+    Runs one of our scripts (the job state ones, or any that have been
+    registered with :py:func:`register_script`) with a single EVALSHA.
+
+    :param str name: One of the keys in ``_SCRIPTS``.
+    :param list keys: The Redis keys the script touches.
+    :param list args: The script's arguments.
+    :returns: Whatever the script returns.
+    """
+
+    conn = yield get_redis_conn()
+    if name not in __SCRIPT_SHAS:
+        # Registered after we connected.
+        yield _load_scripts(conn)
+    started_at = time.time()
+    try:
+        result = yield conn.evalsha(__SCRIPT_SHAS[name], keys, args)
+    except txredisapi.ScriptDoesNotExist:
+        # Redis was restarted (or someone ran SCRIPT FLUSH) since we loaded
+        # the scripts. Load them again and have another go.
+        yield _load_scripts(conn)
+        result = yield conn.evalsha(__SCRIPT_SHAS[name], keys, args)
+    REDIS_SECONDS.observe_since(started_at, operation=name)
+    returnValue(result)
+
+
+@inlineCallbacks
+def _execute_pipeline(pipeline, operation):
+    """
+    Runs a pipeline, keeping track of how long it took.
+
+    :param pipeline: A txredisapi pipeline, with its commands queued up.
+    :param str operation: What to call it in the metrics.
+    :returns: The commands' results.
+    """
+
+    started_at = time.time()
+    results = yield pipeline.execute_pipeline()
+    REDIS_SECONDS.observe_since(started_at, operation=operation)
+    returnValue(results)
+
+
 def _get_job_keys(job_id):
     """
     Each job is comprised of several keys in Redis. Given a job ID, return
@@ -56,17 +647,81 @@ def _get_job_keys(job_id):
         'all_urls_key': '%s-all_urls_key' % job_id,
         'crawls_pending_key': '%s-crawls_pending' % job_id,
         'crawls_completed_key': '%s-crawls_completed' % job_id,
+        'crawls_in_progress_key': '%s-crawls_in_progress' % job_id,
+        'crawls_failed_key': '%s-crawls_failed' % job_id,
         'images_key': '%s-images' % job_id,
+        'seen_bloom_key': '%s-seen_bloom' % job_id,
+        'counters_key': '%s-counters' % job_id,
+        # The job's budget, and whether it has been stopped.
+        'control_key': '%s-control' % job_id,
+        # Only used by the compact layout.
+        'url_list_key': '%s-url_list' % job_id,
+        'pending_bits_key': '%s-pending_bits' % job_id,
+        'in_progress_bits_key': '%s-in_progress_bits' % job_id,
+        'completed_bits_key': '%s-completed_bits' % job_id,
+        'failed_bits_key': '%s-failed_bits' % job_id,
+        'image_list_key': '%s-image_list' % job_id,
+        # Where the job ends up once it's finished or idle (see archive_job).
+        'archive_key': '%s-archive' % job_id,
     }
 
 
+def _get_fingerprint_key(job_id, kind, url):
+    """
+    Works out where a URL's fingerprint lives in the compact layout.
+
+    :param str job_id: A job's UUID4 ID string.
+    :param str kind: Either 'url' or 'image'.
+    :param str url: The URL to fingerprint.
+    :rtype: tuple
+    :returns: A tuple in the form of (bucket_key, field).
+    """
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    # 64 bits of MD5 is plenty to tell a job's URLs apart.
+    fingerprint = hashlib.md5(url).hexdigest()[:16]
+    bucket = fingerprint[:_FINGERPRINT_BUCKET_CHARS]
+    return ('%s-%s_fps:%s' % (job_id, kind, bucket),
+            fingerprint[_FINGERPRINT_BUCKET_CHARS:])
+
+
+def _get_bloom_offsets(url):
+    """
+    Figures out which bits a URL maps to in a job's Bloom filter. We use
+    double hashing off of a single MD5 rather than k separate hashes.
+
+    :param str url: The URL to hash.
+    :rtype: list
+    :returns: A list of ``JOB_URL_BLOOM_HASHES`` bit offsets.
+    """
+
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    digest = hashlib.md5(url).hexdigest()
+    hash1 = int(digest[:16], 16)
+    hash2 = int(digest[16:], 16)
+    return [(hash1 + i * hash2) % JOB_URL_BLOOM_BITS
+            for i in range(JOB_URL_BLOOM_HASHES)]
+
+
 @inlineCallbacks
-def create_job(urls):
+def create_job(urls, budget=None, scope=None, ingesting=False):
     """
     Creates a job in Redis. Since each job is comprised of multiple keys,
     we've got a bit of work to do.
 
     :param set urls: The URLs to crawl for images.
+    :param dict budget: Optional limits on the job, keyed by any of
+        ``JOB_BUDGET_FIELDS``: the most pages to crawl, bytes to download,
+        and depth to crawl to, and a (UNIX timestamp) deadline. The job is
+        stopped once it runs through any of them.
+    :param dict scope: Optional rules for which links the job follows. See
+        :py:meth:`crawler.lib.crawl_scope.CrawlScope.to_dict`.
+    :param bool ingesting: True if ``urls`` are just the first of the seeds,
+        with more to come through :py:func:`enqueue_unseen_urls`. Call
+        :py:func:`finish_job_ingest` once they're all in, so the job can be
+        considered finished.
     :rtype: dict
     :returns: The job data that we stored in Redis. This will quickly be
         out of date, so don't rely on it for much.
@@ -75,14 +730,28 @@ def create_job(urls):
     if not urls:
         raise ValueError("No valid URLs provided.")
     job_id = str(uuid.uuid4())
-    job_keys = _get_job_keys(job_id)
 
-    conn = yield _get_job_data_conn()
-    # Pipeline to get reduce the numer of roundtrips.
-    pipeline = yield conn.pipeline()
-    pipeline.sadd(job_keys['all_urls_key'], urls)
-    pipeline.sadd(job_keys['crawls_pending_key'], urls)
-    yield pipeline.execute_pipeline()
+    control = dict(
+        (field, value) for field, value in (budget or {}).items()
+        if value is not None)
+    if scope:
+        control['scope'] = json.dumps(scope)
+    if ingesting:
+        control['ingesting'] = 1
+    if control:
+        # This has to be in place before any worker hears about the job.
+        conn = yield get_redis_conn()
+        yield conn.hmset(_get_job_keys(job_id)['control_key'], control)
+
+    # The seed URLs count as seen, so nobody delegates them a second time.
+    keys, args = _get_enqueue_script_params(job_id, urls)
+    args.insert(0, job_id)
+    if JOB_STORAGE_LAYOUT == 'compact':
+        created = yield run_script('create_job_compact', keys, args)
+    else:
+        created = yield run_script('create_job', keys, args)
+    if not created:
+        raise ValueError("Job already exists: %s" % job_id)
     job_data = yield get_job_data(job_id)
     returnValue(job_data)
 
@@ -98,7 +767,11 @@ def get_job_data(job_id):
     :return: A dict of job data, aggregated from all of the job's keys.
     """
 
-    conn = yield _get_job_data_conn()
+    if JOB_STORAGE_LAYOUT == 'compact':
+        job_data = yield _get_compact_job_data(job_id)
+        returnValue(job_data)
+
+    conn = yield get_redis_conn()
 
     job_keys = _get_job_keys(job_id)
     # Pipeline to get reduce the numer of roundtrips.
@@ -107,39 +780,777 @@ def get_job_data(job_id):
     pipeline.smembers(job_keys['crawls_pending_key'])
     pipeline.smembers(job_keys['crawls_completed_key'])
     pipeline.smembers(job_keys['images_key'])
+    pipeline.smembers(job_keys['crawls_in_progress_key'])
+    pipeline.smembers(job_keys['crawls_failed_key'])
     # We'll end up with one list member per pipelined command, in the
     # order they appear in above.
-    rval = yield pipeline.execute_pipeline()
+    rval = yield _execute_pipeline(pipeline, 'get_job_data')
     if not rval[0]:
-        # all_urls key should always have at least one entry.
-        raise ValueError("Invalid Job ID: %s" % job_id)
+        # all_urls key should always have at least one entry, unless the
+        # job has been archived.
+        job_data = yield _get_archived_job_data(job_id)
+        returnValue(job_data)
 
     retval = {
         'id': job_id,
         'all_urls': rval[0],
         'crawls_pending': rval[1],
+        'crawls_in_progress': rval[4] or set(),
         'crawls_completed': rval[2] or set(),
+        'crawls_failed': rval[5] or set(),
         'images': rval[3] or set(),
     }
     returnValue(retval)
 
 
 @inlineCallbacks
-def record_images_for_url(job_id, url, images):
+def _get_compact_job_data(job_id):
+    """
+    :py:func:`get_job_data` for the compact layout. This is where we expand
+    everything back out into strings. We go a page at a time, so if the job
+    is still going, a URL that changes state part way through can show up
+    in both its old set and its new one.
+    """
+
+    conn = yield get_redis_conn()
+    job_keys = _get_job_keys(job_id)
+    exists = yield conn.exists(job_keys['counters_key'])
+    if not exists:
+        job_data = yield _get_archived_job_data(job_id)
+        returnValue(job_data)
+
+    set_names = ['urls', 'pending', 'in_progress', 'completed', 'failed',
+                 'images']
+    results = yield gatherResults([
+        _read_all_compact_list(job_keys, set_name) for set_name in set_names])
+    members = dict(zip(set_names, results))
+
+    retval = {
+        'id': job_id,
+        'all_urls': members['urls'],
+        'crawls_pending': members['pending'],
+        'crawls_in_progress': members['in_progress'],
+        'crawls_completed': members['completed'],
+        'crawls_failed': members['failed'],
+        'images': members['images'],
+    }
+    returnValue(retval)
+
+
+def _read_compact_list(job_keys, set_name, start, count):
+    """
+    :param dict job_keys: The job's keys, from :py:func:`_get_job_keys`.
+    :param str set_name: One of the keys in ``_COMPACT_JOB_SET_KEYS``.
+    :param int start: The list index to start at.
+    :param int count: How many list entries to look at, or 0 for all.
+    :rtype: Deferred
+    :returns: A Deferred that fires with a (next_start, members) list.
+    """
+
+    list_key, bits_key = _COMPACT_JOB_SET_KEYS[set_name]
+    keys = [job_keys[list_key]]
+    if bits_key:
+        keys.append(job_keys[bits_key])
+    return run_script('read_list_compact', keys, [start, count])
+
+
+@inlineCallbacks
+def _read_all_compact_list(job_keys, set_name):
+    """
+    Reads a whole compact list, ``JOB_COMPACT_READ_PAGE_SIZE`` entries at a
+    time.
+
+    :param dict job_keys: The job's keys, from :py:func:`_get_job_keys`.
+    :param str set_name: One of the keys in ``_COMPACT_JOB_SET_KEYS``.
+    :rtype: Deferred
+    :returns: A Deferred that fires with a set of the members.
+    """
+
+    members = set()
+    start = 0
+    while True:
+        start, page = yield _read_compact_list(
+            job_keys, set_name, start, JOB_COMPACT_READ_PAGE_SIZE)
+        members.update(page)
+        if not start:
+            returnValue(members)
+
+
+@inlineCallbacks
+def get_job_summary(job_id):
+    """
+    A cheap alternative to :py:func:`get_job_data` for checking on progress.
+    This just reads the counters that the job state scripts keep up to date,
+    so it costs the same no matter how big the job is.
+
+    :param str job_id: A job's UUID4 ID string.
+    :rtype: dict
+    :return: A dict of the job's set sizes.
+    """
+
+    conn = yield get_redis_conn()
+
+    job_keys = _get_job_keys(job_id)
+    pipeline = yield conn.pipeline()
+    pipeline.hgetall(job_keys['counters_key'])
+    pipeline.hgetall(job_keys['control_key'])
+    counters, control = yield _execute_pipeline(pipeline, 'get_job_summary')
+    if not counters:
+        job_data = yield _get_archived_job_data(job_id)
+        returnValue({
+            'id': job_id,
+            'archived': True,
+            'stopped': job_data.get('stopped'),
+            'budget': job_data.get('budget', {}),
+            'scope': job_data.get('scope'),
+            'all_urls_count': len(job_data['all_urls']),
+            'crawls_pending_count': len(job_data['crawls_pending']),
+            'crawls_in_progress_count': len(job_data['crawls_in_progress']),
+            'crawls_completed_count': len(job_data['crawls_completed']),
+            'crawls_failed_count': len(job_data['crawls_failed']),
+            'images_count': len(job_data['images']),
+        })
+
+    retval = {
+        'id': job_id,
+        'all_urls_count': int(counters['urls']),
+        'crawls_pending_count': int(counters['pending']),
+        'crawls_in_progress_count': int(counters['in_progress']),
+        'crawls_completed_count': int(counters['completed']),
+        # Jobs from before we kept track of failures won't have this one.
+        'crawls_failed_count': int(counters.get('failed', 0)),
+        'images_count': int(counters['images']),
+        'bytes_fetched': int(counters.get('bytes', 0)),
+        'stopped': control.get('stopped'),
+        'budget': _parse_job_budget(control),
+        'scope': _parse_job_scope(control),
+        'ingesting': bool(control.get('ingesting')),
+    }
+    returnValue(retval)
+
+
+def _parse_job_budget(control):
+    """
+    :param dict control: A job's control hash.
+    :rtype: dict
+    :returns: Just the job's budget, as numbers.
+    """
+
+    budget = {}
+    for field in JOB_BUDGET_FIELDS:
+        if control.get(field) is not None:
+            budget[field] = float(control[field]) if field == 'deadline' \
+                else int(control[field])
+    return budget
+
+
+def _parse_job_scope(control):
+    """
+    :param dict control: A job's control hash.
+    :rtype: dict
+    :returns: The job's scope rules, or None if it doesn't have any.
+    """
+
+    if not control.get('scope'):
+        return None
+    return json.loads(control['scope'])
+
+
+@inlineCallbacks
+def get_job_control(job_id):
+    """
+    Everything a worker needs to know before crawling for a job: its budget,
+    its scope rules, and whether it has been stopped. Workers cache this (see
+    :py:mod:`crawler.crawler_worker.lib.job_control`).
+
+    :param str job_id: A job's UUID4 ID string.
+    :rtype: dict
+    :returns: A dict with the job's ``budget``, ``scope`` rules (None if it
+        has none), and why it was ``stopped`` (None if it wasn't). Jobs that
+        are gone count as stopped.
+    """
+
+    conn = yield get_redis_conn()
+    job_keys = _get_job_keys(job_id)
+    pipeline = yield conn.pipeline()
+    pipeline.exists(job_keys['counters_key'])
+    pipeline.hgetall(job_keys['control_key'])
+    exists, control = yield _execute_pipeline(pipeline, 'get_job_control')
+    stopped = control.get('stopped')
+    if not exists:
+        stopped = 'archived'
+    returnValue({
+        'budget': _parse_job_budget(control),
+        'scope': _parse_job_scope(control),
+        'stopped': stopped,
+    })
+
+
+@inlineCallbacks
+def finish_job_ingest(job_id):
+    """
+    Marks a job created with ``ingesting=True`` as having all of its seeds.
+
+    :param str job_id: A job's UUID4 ID string.
+    """
+
+    conn = yield get_redis_conn()
+    yield conn.hdel(_get_job_keys(job_id)['control_key'], 'ingesting')
+
+
+@inlineCallbacks
+def stop_job(job_id, reason='cancelled'):
+    """
+    Stops a job. Workers drop any of its URLs that they haven't started on,
+    and stop enqueueing new ones. Anything already in progress finishes.
+
+    :param str job_id: A job's UUID4 ID string.
+    :param str reason: Why we're stopping it.
+    :rtype: bool
+    :returns: False if the job had already been stopped.
+    :raises: ValueError if the job isn't live (it's archived, or never
+        existed).
+    """
+
+    job_keys = _get_job_keys(job_id)
+    stopped = yield run_script(
+        'stop_job', [job_keys['counters_key'], job_keys['control_key']],
+        [job_id, reason])
+    if stopped == -1:
+        raise ValueError("Invalid Job ID: %s" % job_id)
+    if stopped:
+        log.msg("Stopped job %s (%s)." % (job_id, reason))
+    returnValue(bool(stopped))
+
+
+@inlineCallbacks
+def get_job_set_page(job_id, set_name, cursor=0, count=100):
+    """
+    Pages through one of a job's sets with SSCAN, so that big jobs can be
+    read a bit at a time. Start with a cursor of 0, then keep passing the
+    returned cursor back in until it comes back as 0 again.
+
+    .. note:: Like SSCAN itself, ``count`` is a hint rather than a hard
+        limit, and a member may show up on more than one page.
+
+    :param str job_id: A job's UUID4 ID string.
+    :param str set_name: One of the keys in ``JOB_SET_KEYS``.
+    :param int cursor: Where to pick up from.
+    :param int count: Roughly how many members to return.
+    :rtype: dict
+    :return: A dict with the page's members and the next cursor.
+    """
+
+    if set_name not in JOB_SET_KEYS:
+        raise ValueError("Invalid job set: %s" % set_name)
+
+    conn = yield get_redis_conn()
+
+    job_keys = _get_job_keys(job_id)
+    exists = yield conn.exists(job_keys['counters_key'])
+    if not exists:
+        # Archived jobs get paged through by index, like the compact layout.
+        job_data = yield _get_archived_job_data(job_id)
+        members = sorted(job_data[_JOB_DATA_SET_NAMES[set_name]])
+        next_cursor = cursor + count
+        if next_cursor >= len(members):
+            next_cursor = 0
+        returnValue({
+            'id': job_id,
+            'set': set_name,
+            'cursor': next_cursor,
+            'members': members[cursor:cursor + count],
+        })
+
+    if JOB_STORAGE_LAYOUT == 'compact':
+        # Here, the cursor is just an index into the job's URL (or image)
+        # list, so pages never overlap.
+        next_cursor, members = yield _read_compact_list(
+            job_keys, set_name, cursor, count)
+        returnValue({
+            'id': job_id,
+            'set': set_name,
+            'cursor': int(next_cursor),
+            'members': members,
+        })
+
+    next_cursor, members = yield conn.execute_command(
+        'SSCAN', job_keys[JOB_SET_KEYS[set_name]], cursor, 'COUNT', count)
+    retval = {
+        'id': job_id,
+        'set': set_name,
+        'cursor': int(next_cursor),
+        'members': members,
+    }
+    returnValue(retval)
+
+
+@inlineCallbacks
+def get_in_progress_counts(job_ids):
+    """
+    Reads the in-progress counter for a bunch of jobs in one round trip.
+
+    :param list job_ids: UUID4 ID strings.
+    :rtype: dict
+    :returns: A dict of job ID -> URLs in progress. Jobs that are gone (or
+        archived) count as 0.
+    """
+
+    if not job_ids:
+        returnValue({})
+
+    conn = yield get_redis_conn()
+    pipeline = yield conn.pipeline()
+    for job_id in job_ids:
+        pipeline.hget(_get_job_keys(job_id)['counters_key'], 'in_progress')
+    counts = yield _execute_pipeline(pipeline, 'get_in_progress_counts')
+    returnValue(dict(
+        (job_id, int(count or 0)) for job_id, count in zip(job_ids, counts)))
+
+
+@inlineCallbacks
+def get_job_ids_page(cursor=0, count=100):
+    """
+    Pages through the IDs of jobs that haven't been archived yet.
+
+    :param int cursor: Where to pick up from. Start with 0.
+    :param int count: Roughly how many job IDs to return.
+    :rtype: tuple
+    :returns: A tuple in the form of (next_cursor, job_ids). We're done once
+        the cursor comes back as 0.
+    """
+
+    conn = yield get_redis_conn()
+    next_cursor, job_ids = yield conn.execute_command(
+        'SSCAN', JOBS_INDEX_KEY, cursor, 'COUNT', count)
+    returnValue((int(next_cursor), job_ids))
+
+
+@inlineCallbacks
+def archive_job(job_id):
+    """
+    Squashes all of a job's keys into a single compressed blob, which expires
+    after ``JOB_ARCHIVE_TTL`` seconds. The job's data is still available
+    from :py:func:`get_job_data` and friends afterwards, but workers will
+    stop crawling for it.
+
+    Reading the job and deleting its keys can't be a single script (the job
+    may be far too big for that), so we WATCH its counters and control hash
+    while we read. Every change to a job bumps one or the other, so if a
+    worker writes anything in the meantime, nothing gets deleted.
+
+    :param str job_id: A job's UUID4 ID string.
+    :rtype: int
+    :returns: The size of the archive in bytes, or None if there was nothing
+        left to archive, or the job changed while we were archiving it.
+    """
+
+    conn = yield get_redis_conn()
+    job_keys = _get_job_keys(job_id)
+    archive_key = job_keys.pop('archive_key')
+    transaction = yield conn.watch(
+        [job_keys['counters_key'], job_keys['control_key']])
+    try:
+        job_data = yield _get_job_archive_data(job_id, job_keys)
+    except Exception:
+        yield transaction.unwatch()
+        raise
+    if not job_data:
+        # Already archived (or expired). Just tidy up the index.
+        yield transaction.unwatch()
+        yield conn.srem(JOBS_INDEX_KEY, job_id)
+        returnValue(None)
+
+    live_keys = set(job_keys.values())
+    if JOB_STORAGE_LAYOUT == 'compact':
+        for url in job_data['all_urls']:
+            live_keys.add(_get_fingerprint_key(job_id, 'url', url)[0])
+        for image in job_data['images']:
+            live_keys.add(_get_fingerprint_key(job_id, 'image', image)[0])
+
+    blob = zlib.compress(json.dumps(job_data, cls=JobDataEncoder))
+    started_at = time.time()
+    yield transaction.multi()
+    transaction.set(archive_key, blob, expire=JOB_ARCHIVE_TTL or None)
+    transaction.delete(list(live_keys))
+    transaction.srem(JOBS_INDEX_KEY, job_id)
+    transaction.publish(JOB_EVENTS_CHANNEL_PREFIX + job_id, JOB_ARCHIVED_EVENT)
+    try:
+        yield transaction.commit()
+    except txredisapi.WatchError:
+        log.msg("Job %s changed while we were archiving it, leaving it be." %
+                job_id)
+        returnValue(None)
+    REDIS_SECONDS.observe_since(started_at, operation='archive_job')
+
+    log.msg("Archived job %s (%d URLs, %d images) into %d bytes." % (
+        job_id, len(job_data['all_urls']), len(job_data['images']),
+        len(blob)))
+    returnValue(len(blob))
+
+
+@inlineCallbacks
+def _get_job_archive_data(job_id, job_keys):
+    """
+    :param str job_id: A job's UUID4 ID string.
+    :param dict job_keys: The job's keys, from :py:func:`_get_job_keys`.
+    :rtype: dict
+    :returns: What goes in the job's archive, or None if it has already
+        been archived (or has expired).
+    """
+
+    try:
+        job_data = yield get_job_data(job_id)
+    except ValueError:
+        returnValue(None)
+    if job_data.get('archived'):
+        returnValue(None)
+
+    # Hang on to how the job ended, too.
+    conn = yield get_redis_conn()
+    control = yield conn.hgetall(job_keys['control_key'])
+    job_data['stopped'] = control.get('stopped')
+    job_data['budget'] = _parse_job_budget(control)
+    job_data['scope'] = _parse_job_scope(control)
+    returnValue(job_data)
+
+
+@inlineCallbacks
+def _get_archived_job_data(job_id):
+    """
+    :py:func:`get_job_data` for archived jobs.
+
+    :raises: ValueError if there's no such job, archived or otherwise.
+    """
+
+    conn = yield get_redis_conn()
+    blob = yield conn.get(_get_job_keys(job_id)['archive_key'])
+    if not blob:
+        raise ValueError("Invalid Job ID: %s" % job_id)
+    if isinstance(blob, unicode):
+        # txredisapi decodes anything that happens to be valid UTF-8.
+        blob = blob.encode('utf-8')
+
+    job_data = json.loads(zlib.decompress(blob))
+    for set_name in _JOB_DATA_SET_NAMES.values():
+        # Older archives won't have every set.
+        job_data[set_name] = set(job_data.get(set_name, []))
+    job_data['archived'] = True
+    returnValue(job_data)
+
+
+class ImageRecordBuffer(object):
+    """
+    Write-behind buffer for :py:func:`record_images_for_url`. Rather than a
+    round trip per crawled URL, we hold on to records for a short while and
+    then write them all at once, with a single script call for every job in
+    the batch.
+
+    A batch is flushed once it holds ``max_urls`` URLs, or ``interval``
+    seconds after the first URL went in, whichever comes first.
     """
-    Records images that we've found while crawling.
+
+    def __init__(self, max_urls=RECORD_FLUSH_MAX_URLS,
+                 interval=RECORD_FLUSH_INTERVAL):
+        """
+        :param int max_urls: Flush once this many URLs are buffered.
+        :param float interval: Flush this many seconds after the first URL
+            was buffered.
+        """
+
+        self.max_urls = max_urls
+        self.interval = interval
+        # job_id -> {'urls': set, 'images': set, 'bytes': int}
+        self.records = {}
+        self.url_count = 0
+        # Fired once the batch currently being buffered has been written.
+        self.waiters = []
+        self._flush_call = None
+
+    def record(self, job_id, url, images, num_bytes=0):
+        """
+        :param str job_id: A job's UUID4 ID string.
+        :param str url: The URL that the images were found at.
+        :param set images: The images found while crawling this URL.
+        :param int num_bytes: How much we downloaded to crawl this URL.
+        :rtype: Deferred
+        :returns: A Deferred that fires once this record is in Redis.
+        """
+
+        job_records = self.records.setdefault(
+            job_id, {'urls': set(), 'images': set(), 'bytes': 0})
+        job_records['urls'].add(url)
+        job_records['images'].update(images)
+        job_records['bytes'] += num_bytes
+        self.url_count += 1
+
+        d = Deferred()
+        self.waiters.append(d)
+
+        if self.url_count >= self.max_urls:
+            self.flush()
+        elif not self._flush_call:
+            self._flush_call = reactor.callLater(self.interval, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Writes everything we've buffered so far. Call this on shutdown.
+
+        :rtype: Deferred
+        :returns: A Deferred that fires once the write is done.
+        """
+
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        if not self.records:
+            return succeed(None)
+
+        records, self.records = self.records, {}
+        url_count, self.url_count = self.url_count, 0
+        waiters, self.waiters = self.waiters, []
+
+        d = self._write_records(records, url_count)
+        d.addCallbacks(self._notify_waiters, self._notify_waiters_of_error,
+                       callbackArgs=(waiters,), errbackArgs=(waiters,))
+        return d
+
+    @inlineCallbacks
+    def _write_records(self, records, url_count):
+        start_time = time.time()
+        keys = []
+        args = []
+        for job_id, job_records in records.items():
+            job_keys, job_args = _get_complete_script_params(
+                job_id, job_records['urls'], job_records['images'],
+                job_records['bytes'])
+            keys.extend(job_keys)
+            args.extend(job_args)
+        if JOB_STORAGE_LAYOUT == 'compact':
+            yield run_script('complete_urls_compact', keys, args)
+        else:
+            yield run_script('complete_urls', keys, args)
+
+        RECORDED_URLS.inc(url_count)
+        log_sampled("Flushed %d URL record(s) for %d job(s) in %.1fms.",
+                    url_count, len(records), (time.time() - start_time) * 1000)
+
+    def _notify_waiters(self, result, waiters):
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def _notify_waiters_of_error(self, failure, waiters):
+        log.err(failure, "Failed to flush URL records.")
+        for waiter in waiters:
+            waiter.errback(failure)
+
+
+def _get_image_record_buffer():
+    """
+    Lazy-load the process's write-behind buffer.
+
+    :rtype: ImageRecordBuffer
+    """
+
+    global __IMAGE_RECORD_BUFFER
+
+    if not __IMAGE_RECORD_BUFFER:
+        __IMAGE_RECORD_BUFFER = ImageRecordBuffer()
+    return __IMAGE_RECORD_BUFFER
+
+
+def record_images_for_url(job_id, url, images, num_bytes=0):
+    """
+    Records images that we've found while crawling. The write is buffered
+    and batched with others (see :py:class:`ImageRecordBuffer`), so there's
+    no need to wait on it before moving on to other work.
 
     :param str job_id: A job's UUID4 ID string.
     :param str url: The URL that the image was found at.
     :param set images: The images found while crawling this URL.
+    :param int num_bytes: How much we downloaded to crawl this URL. This
+        counts against the job's byte budget.
+    :rtype: Deferred
+    :returns: A Deferred that fires once the record is in Redis.
+    """
+
+    return _get_image_record_buffer().record(job_id, url, images, num_bytes)
+
+
+def flush_image_records():
+    """
+    Writes out any buffered image records. Call this on shutdown.
+
+    :rtype: Deferred
+    :returns: A Deferred that fires once the write is done.
+    """
+
+    if not __IMAGE_RECORD_BUFFER:
+        return succeed(None)
+    return __IMAGE_RECORD_BUFFER.flush()
+
+
+@inlineCallbacks
+def claim_job_url(job_id, url):
+    """
+    Marks a URL as in progress, just before we crawl it.
+
+    :param str job_id: A job's UUID4 ID string.
+    :param str url: The URL we're about to crawl.
+    :rtype: bool
+    :returns: False if the URL has already been crawled, or its job has been
+        stopped, in which case there's no need to crawl it.
     """
-    conn = yield _get_job_data_conn()
 
     job_keys = _get_job_keys(job_id)
-    # Pipeline to get reduce the numer of roundtrips.
-    pipeline = yield conn.pipeline()
-    pipeline.srem(job_keys['crawls_pending_key'], url)
-    pipeline.sadd(job_keys['crawls_completed_key'], url)
-    if images:
-        pipeline.sadd(job_keys['images_key'], images)
-    result = yield pipeline.execute_pipeline()
+    if JOB_STORAGE_LAYOUT == 'compact':
+        bucket_key, field = _get_fingerprint_key(job_id, 'url', url)
+        claimed = yield run_script(
+            'claim_url_compact',
+            [bucket_key, job_keys['pending_bits_key'],
+             job_keys['in_progress_bits_key'],
+             job_keys['completed_bits_key'], job_keys['counters_key'],
+             job_keys['failed_bits_key'], job_keys['control_key']],
+            [field])
+    else:
+        claimed = yield run_script(
+            'claim_url',
+            [job_keys['crawls_pending_key'], job_keys['crawls_in_progress_key'],
+             job_keys['crawls_completed_key'], job_keys['counters_key'],
+             job_keys['crawls_failed_key'], job_keys['control_key']],
+            [url])
+    returnValue(bool(claimed))
+
+
+@inlineCallbacks
+def fail_job_url(job_id, url):
+    """
+    Gives up on a URL that we couldn't fetch. It ends up in the job's
+    failed set, and won't be claimed again.
+
+    :param str job_id: A job's UUID4 ID string.
+    :param str url: The URL we're giving up on.
+    :rtype: bool
+    :returns: False if the URL had already been crawled or given up on, or
+        the job is gone.
+    """
+
+    job_keys = _get_job_keys(job_id)
+    if JOB_STORAGE_LAYOUT == 'compact':
+        bucket_key, field = _get_fingerprint_key(job_id, 'url', url)
+        failed = yield run_script(
+            'fail_url_compact',
+            [bucket_key, job_keys['pending_bits_key'],
+             job_keys['in_progress_bits_key'],
+             job_keys['completed_bits_key'], job_keys['failed_bits_key'],
+             job_keys['counters_key'], job_keys['control_key']],
+            [field, job_id, url])
+    else:
+        failed = yield run_script(
+            'fail_url',
+            [job_keys['crawls_pending_key'], job_keys['crawls_in_progress_key'],
+             job_keys['crawls_completed_key'], job_keys['crawls_failed_key'],
+             job_keys['counters_key'], job_keys['control_key']],
+            [url, job_id])
+    returnValue(bool(failed))
+
+
+@inlineCallbacks
+def enqueue_unseen_urls(job_id, urls):
+    """
+    Given a batch of URLs for a job, mark them all as seen, add the ones that
+    hadn't been seen before to the job's pending set, and hand those back.
+    This is a single, atomic round trip, so two workers finding the same link
+    can't both end up crawling it.
+
+    :param str job_id: A job's UUID4 ID string.
+    :param set urls: The URLs we'd like to crawl.
+    :rtype: set
+    :returns: The subset of ``urls`` that this job hasn't seen before.
+    """
+
+    if not urls:
+        returnValue(set())
+
+    keys, args = _get_enqueue_script_params(job_id, urls)
+    if JOB_STORAGE_LAYOUT == 'compact':
+        unseen = yield run_script('enqueue_urls_compact', keys, args)
+    else:
+        unseen = yield run_script('enqueue_urls', keys, args)
+    returnValue(set(unseen or []))
+
+
+def _get_enqueue_script_params(job_id, urls):
+    """
+    :param str job_id: A job's UUID4 ID string.
+    :param set urls: The URLs to enqueue.
+    :rtype: tuple
+    :returns: A tuple of (KEYS, ARGV) lists for the create and enqueue
+        scripts.
+    """
+
+    job_keys = _get_job_keys(job_id)
+
+    if JOB_STORAGE_LAYOUT == 'compact':
+        keys = [job_keys['url_list_key'], job_keys['pending_bits_key'],
+                job_keys['counters_key'], JOBS_INDEX_KEY,
+                job_keys['control_key']]
+        args = []
+        for url in urls:
+            bucket_key, field = _get_fingerprint_key(job_id, 'url', url)
+            keys.append(bucket_key)
+            args.extend([url, field])
+        return keys, args
+
+    if JOB_URL_DEDUP_MODE == 'bloom':
+        keys = [job_keys['all_urls_key'], job_keys['crawls_pending_key'],
+                job_keys['seen_bloom_key'], job_keys['counters_key'],
+                JOBS_INDEX_KEY, job_keys['control_key']]
+        args = [JOB_URL_BLOOM_HASHES]
+        for url in urls:
+            args.append(url)
+            args.extend(_get_bloom_offsets(url))
+        return keys, args
+
+    keys = [job_keys['all_urls_key'], job_keys['crawls_pending_key'],
+            job_keys['all_urls_key'], job_keys['counters_key'],
+            JOBS_INDEX_KEY, job_keys['control_key']]
+    return keys, [0] + list(urls)
+
+
+def _get_complete_script_params(job_id, urls, images, num_bytes):
+    """
+    :param str job_id: A job's UUID4 ID string.
+    :param set urls: The URLs that have been crawled.
+    :param set images: The images found on those URLs.
+    :param int num_bytes: How much we downloaded to crawl them.
+    :rtype: tuple
+    :returns: A tuple of this job's (KEYS, ARGV) lists for the complete
+        script. Several jobs' lists can be strung together.
+    """
+
+    job_keys = _get_job_keys(job_id)
+
+    if JOB_STORAGE_LAYOUT == 'compact':
+        keys = [job_keys['pending_bits_key'], job_keys['in_progress_bits_key'],
+                job_keys['completed_bits_key'], job_keys['image_list_key'],
+                job_keys['counters_key'], job_keys['control_key']]
+        args = [job_id, len(urls), len(images), num_bytes]
+        for url in urls:
+            bucket_key, field = _get_fingerprint_key(job_id, 'url', url)
+            keys.append(bucket_key)
+            args.extend([url, field])
+        for image in images:
+            bucket_key, field = _get_fingerprint_key(job_id, 'image', image)
+            keys.append(bucket_key)
+            args.extend([image, field])
+        return keys, args
+
+    keys = [job_keys['crawls_pending_key'], job_keys['crawls_in_progress_key'],
+            job_keys['crawls_completed_key'], job_keys['images_key'],
+            job_keys['counters_key'], job_keys['control_key']]
+    args = [job_id, len(urls), len(images), num_bytes] + list(urls) + \
+        list(images)
+    return keys, args
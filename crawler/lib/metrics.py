@@ -0,0 +1,255 @@
+"""
+A tiny metrics registry, shared by the web API and the workers. Modules
+declare their counters, gauges and histograms at import time, and
+:py:class:`MetricsResource` serves the lot up in Prometheus' text format.
+
+We're single-threaded, so there's no locking. Recording a value is a dict
+lookup and an addition, which is a good deal cheaper than the log line it
+often replaces.
+"""
+
+import bisect
+import time
+from collections import OrderedDict
+
+from twisted.web.resource import Resource
+
+# Seconds. Fine enough for Redis round trips, wide enough for slow sites.
+DEFAULT_LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30, 60)
+
+
+def _format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')\
+        .replace('\n', '\\n')
+
+
+class _Metric(object):
+    """
+    The bits every type of metric has in common. Values are kept per set of
+    label values.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, description, label_names=()):
+        """
+        :param str name: The metric's name.
+        :param str description: What it measures.
+        :param tuple label_names: The labels each value is recorded with.
+        """
+
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        # Tuple of label values -> the value.
+        self.values = {}
+
+    def _get_key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.label_names, key) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, _escape_label_value(value))
+            for name, value in pairs)
+
+    def render(self):
+        """
+        :rtype: list
+        :returns: The metric's lines, in Prometheus' text format.
+        """
+
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s %s' % (self.name, self.metric_type),
+        ]
+        for key in sorted(self.values):
+            lines.extend(self._render_value(key, self.values[key]))
+        return lines
+
+    def _render_value(self, key, value):
+        return ['%s%s %s' % (
+            self.name, self._format_labels(key), _format_value(value))]
+
+
+class Counter(_Metric):
+    """
+    Only ever goes up.
+    """
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Goes up and down. Either set it as things change, or hand it a function
+    to call whenever the metrics are read.
+    """
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, description, label_names=()):
+        _Metric.__init__(self, name, description, label_names)
+        # Tuple of label values -> function returning the value.
+        self.functions = {}
+
+    def set(self, value, **labels):
+        self.values[self._get_key(labels)] = value
+
+    def set_function(self, function, **labels):
+        """
+        :param callable function: Called with no arguments whenever the
+            metrics are read. Returns the gauge's value.
+        """
+
+        self.functions[self._get_key(labels)] = function
+
+    def render(self):
+        for key, function in self.functions.items():
+            self.values[key] = function()
+        return _Metric.render(self)
+
+
+class Histogram(_Metric):
+    """
+    Counts observations (usually latencies, in seconds) into buckets.
+    """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        :param tuple buckets: The buckets' (sorted) upper bounds.
+        """
+
+        _Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # Per-bucket counts (plus one for +Inf), the sum, and the count.
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def observe_since(self, started_at, **labels):
+        """
+        :param float started_at: A ``time.time()`` from when the thing
+            we're timing started.
+        """
+
+        self.observe(time.time() - started_at, **labels)
+
+    def _render_value(self, key, state):
+        bucket_counts, total, count = state
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(
+                self.buckets + ('+Inf',), bucket_counts):
+            cumulative += bucket_count
+            le = bound if bound == '+Inf' else _format_value(bound)
+            lines.append('%s_bucket%s %d' % (
+                self.name, self._format_labels(key, [('le', le)]), cumulative))
+        lines.append('%s_sum%s %s' % (
+            self.name, self._format_labels(key), _format_value(total)))
+        lines.append('%s_count%s %d' % (
+            self.name, self._format_labels(key), count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Every metric the process knows about.
+    """
+
+    def __init__(self):
+        # name -> metric, in the order they were declared.
+        self.metrics = OrderedDict()
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, *args, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError("Metric %s is already a %s." % (
+                name, metric.metric_type))
+        return metric
+
+    def counter(self, name, description, label_names=()):
+        """
+        :rtype: Counter
+        """
+
+        return self._get_or_create(Counter, name, description, label_names)
+
+    def gauge(self, name, description, label_names=()):
+        """
+        :rtype: Gauge
+        """
+
+        return self._get_or_create(Gauge, name, description, label_names)
+
+    def histogram(self, name, description, label_names=(),
+                  buckets=DEFAULT_LATENCY_BUCKETS):
+        """
+        :rtype: Histogram
+        """
+
+        return self._get_or_create(
+            Histogram, name, description, label_names, buckets=buckets)
+
+    def render(self):
+        """
+        :rtype: str
+        :returns: Every metric, in Prometheus' text format.
+        """
+
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Declaring a metric that already exists hands back the existing one, so
+# it's fine for more than one module to declare the same metric.
+REGISTRY = MetricsRegistry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class MetricsResource(Resource):
+    """
+    URL: /metrics
+
+    Everything in :py:data:`REGISTRY`, in Prometheus' text format.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY):
+        Resource.__init__(self)
+
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render()
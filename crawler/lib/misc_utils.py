@@ -3,8 +3,13 @@ Assorted utility functions that are generally useful, but don't fit in
 nicely in any one place.
 """
 
+import random
 import re
 
+from twisted.python import log
+
+from crawler.conf import LOG_SAMPLE_RATE
+
 CR_LF_REGEX = re.compile("[\n\t\r]")
 
 
@@ -19,3 +24,17 @@ def remove_cr_and_lf(str_to_chomp):
     """
 
     return CR_LF_REGEX.sub("", str_to_chomp)
+
+
+def log_sampled(message, *args):
+    """
+    For log lines that come up for every message or URL. Only
+    ``LOG_SAMPLE_RATE`` of them actually get logged, and we don't bother
+    formatting the ones that don't.
+
+    :param str message: The message, with ``%`` placeholders for ``args``.
+    """
+
+    if LOG_SAMPLE_RATE < 1 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    log.msg(message % args if args else message)
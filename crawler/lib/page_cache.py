@@ -0,0 +1,185 @@
+"""
+A page cache shared by every worker (and every job). Lots of jobs start from
+the same handful of sites, so rather than downloading and parsing the same
+pages over and over, we keep what we extracted from each page in Redis,
+along with its ``ETag``/``Last-Modified`` headers.
+
+A cached page that was checked recently enough is used as-is. Past that, we
+revalidate it with a conditional GET, and only download and parse the page
+again if the server says it changed.
+
+Entries expire after ``PAGE_CACHE_TTL`` seconds, and once there are more than
+``PAGE_CACHE_MAX_ENTRIES`` of them, the oldest get evicted.
+"""
+
+import hashlib
+import json
+import time
+import urlparse
+import zlib
+
+from twisted.python import log
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from crawler.conf import PAGE_CACHE_TTL, PAGE_CACHE_FRESH_SECONDS, \
+    PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_MAX_ENTRY_BYTES
+from crawler.lib.data_store import get_redis_conn, register_script, \
+    run_script
+
+# A sorted set of entry keys, scored by when they were stored. This is how
+# we find the oldest entries to evict.
+PAGE_CACHE_INDEX_KEY = 'page_cache_index'
+
+# KEYS: the entry's key, the index. ARGV: the entry, TTL, the current time,
+# the most entries we'll keep. Stores the entry, then evicts the oldest
+# entries if we're over the limit. Returns how many were evicted.
+_STORE_PAGE_SCRIPT = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+-- Anything that has expired on its own can come out of the index.
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf',
+           tonumber(ARGV[3]) - tonumber(ARGV[2]))
+local excess = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if excess <= 0 then
+    return 0
+end
+local oldest = redis.call('ZRANGE', KEYS[2], 0, excess - 1)
+for _, key in ipairs(oldest) do
+    redis.call('DEL', key)
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, excess - 1)
+return excess
+"""
+register_script('store_page', _STORE_PAGE_SCRIPT)
+
+
+def normalize_url(url):
+    """
+    Boils a URL down so that trivially different spellings of the same page
+    share a cache entry. Scheme and host are lowercased, default ports and
+    fragments are dropped, and an empty path becomes ``/``.
+
+    :param str url: The URL to normalize.
+    :rtype: str
+    """
+
+    parsed = urlparse.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme, netloc.rsplit(':', 1)[-1]) in (('http', '80'), ('https', '443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    return urlparse.urlunsplit(
+        (scheme, netloc, parsed.path or '/', parsed.query, ''))
+
+
+def _get_page_key(url):
+    """
+    :param str url: The page's URL.
+    :rtype: str
+    :returns: The Redis key for the page's cache entry.
+    """
+
+    normalized = normalize_url(url)
+    if isinstance(normalized, unicode):
+        normalized = normalized.encode('utf-8')
+    return 'page_cache:%s' % hashlib.md5(normalized).hexdigest()
+
+
+@inlineCallbacks
+def get_cached_page(url):
+    """
+    :param str url: The page's URL.
+    :rtype: dict
+    :returns: The page's cache entry, or None if we don't have one. Entries
+        have ``images`` and ``links`` sets, ``etag`` and ``last_modified``
+        headers (either can be None), and a ``checked_at`` timestamp.
+    """
+
+    conn = yield get_redis_conn()
+    blob = yield conn.get(_get_page_key(url))
+    if not blob:
+        returnValue(None)
+    if isinstance(blob, unicode):
+        # txredisapi decodes anything that happens to be valid UTF-8.
+        blob = blob.encode('utf-8')
+
+    page = json.loads(zlib.decompress(blob))
+    page['images'] = set(page['images'])
+    page['links'] = set(page['links'])
+    returnValue(page)
+
+
+def is_fresh(page):
+    """
+    :param dict page: A page cache entry.
+    :rtype: bool
+    :returns: True if the page was checked recently enough that we can use
+        it without asking the server.
+    """
+
+    return time.time() - page['checked_at'] < PAGE_CACHE_FRESH_SECONDS
+
+
+def get_conditional_headers(page):
+    """
+    :param dict page: A page cache entry.
+    :rtype: dict
+    :returns: Request headers that'll get us a 304 if the page hasn't
+        changed. Empty if the server didn't give us anything to go on.
+    """
+
+    # These come back out of JSON as unicode, which Twisted won't send.
+    headers = {}
+    if page['etag']:
+        headers['If-None-Match'] = page['etag'].encode('utf-8')
+    if page['last_modified']:
+        headers['If-Modified-Since'] = page['last_modified'].encode('utf-8')
+    return headers
+
+
+@inlineCallbacks
+def cache_page(url, images, links, headers):
+    """
+    Stores what we extracted from a page.
+
+    :param str url: The page's URL.
+    :param set images: The page's image URLs.
+    :param set links: The page's links (before any per-job filtering).
+    :param dict headers: The response's headers, as returned by
+        :py:func:`crawler.lib.tx_http.get_response_headers`.
+    """
+
+    page = {
+        'images': list(images),
+        'links': list(links),
+        'etag': headers.get('etag'),
+        'last_modified': headers.get('last-modified'),
+        'checked_at': time.time(),
+    }
+    blob = zlib.compress(json.dumps(page))
+    if len(blob) > PAGE_CACHE_MAX_ENTRY_BYTES:
+        log.msg("Not caching %s, its entry would be %d bytes." % (
+            url, len(blob)))
+        return
+
+    evicted = yield run_script(
+        'store_page', [_get_page_key(url), PAGE_CACHE_INDEX_KEY],
+        [blob, PAGE_CACHE_TTL, '%.6f' % time.time(), PAGE_CACHE_MAX_ENTRIES])
+    if evicted:
+        log.msg("Evicted %d page cache entries." % evicted)
+
+
+def refresh_cached_page(url, page):
+    """
+    The server told us (with a 304) that a page hasn't changed. Mark it as
+    freshly checked.
+
+    :param str url: The page's URL.
+    :param dict page: The page's cache entry.
+    :rtype: Deferred
+    """
+
+    return cache_page(url, page['images'], page['links'], {
+        'etag': page['etag'],
+        'last-modified': page['last_modified'],
+    })
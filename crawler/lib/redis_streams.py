@@ -0,0 +1,195 @@
+"""
+Functions for using a Redis Stream as a durable crawl queue. Entries are
+crawl batches (see :py:mod:`crawler.lib.crawl_messages`), read by workers
+through a consumer group. An entry stays pending until the worker that read
+it acknowledges it, so work from a crashed worker can be claimed by another.
+
+.. note:: Our Redis client predates Streams, so we send the raw commands.
+    Streams need Redis 5.0+, and :py:func:`claim_stale_entries` needs 6.2+.
+"""
+
+import txredisapi
+from twisted.python import log
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from crawler.conf import REDIS_HOST, REDIS_PORT, REDIS_STREAM_KEY, \
+    REDIS_STREAM_GROUP, REDIS_STREAM_MAXLEN
+
+# NOTE: We're not multi-threaded currently. If you were to introduce a
+# threadpool, this would probably be a bad idea.
+__STREAM_REDIS_CONN = None
+
+
+@inlineCallbacks
+def _get_stream_conn():
+    """
+    Lazy-load a Redis connection pool for non-blocking stream commands.
+
+    :rtype: ConnectionPool
+    :returns: A connection to Redis.
+    """
+
+    global __STREAM_REDIS_CONN
+
+    if __STREAM_REDIS_CONN:
+        returnValue(__STREAM_REDIS_CONN)
+
+    log.msg("Connecting to redis stream store: %s:%d" % (REDIS_HOST, REDIS_PORT))
+    __STREAM_REDIS_CONN = yield txredisapi.ConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT)
+    returnValue(__STREAM_REDIS_CONN)
+
+
+def get_blocking_stream_conn():
+    """
+    XREADGROUP ... BLOCK ties up a connection until it returns, so each
+    reader needs one of its own rather than one from the shared pool.
+
+    :rtype: Deferred
+    :returns: A Deferred that fires with a dedicated Redis connection.
+    """
+
+    return txredisapi.Connection(host=REDIS_HOST, port=REDIS_PORT)
+
+
+def _parse_entries(entries):
+    """
+    :param list entries: Stream entries, as returned by Redis, in the form
+        of ``[[entry_id, [field, value, ...]], ...]``.
+    :rtype: list
+    :returns: A list of (entry_id, message) tuples.
+    """
+
+    parsed = []
+    for entry_id, fields in entries or []:
+        # Deleted entries come back with no fields.
+        if not fields:
+            continue
+        fields = dict(zip(fields[::2], fields[1::2]))
+        message = fields.get(u'message')
+        if message is None:
+            continue
+        # The client decodes anything that looks like UTF-8. Messages may be
+        # binary (compact encoding), so hand back the original bytes.
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        parsed.append((entry_id, message))
+    return parsed
+
+
+@inlineCallbacks
+def add_stream_message(message):
+    """
+    Appends a crawl message to the stream.
+
+    :param str message: A batched crawler message.
+    :rtype: str
+    :returns: The new entry's ID.
+    """
+
+    conn = yield _get_stream_conn()
+    entry_id = yield conn.execute_command(
+        'XADD', REDIS_STREAM_KEY, 'MAXLEN', '~', REDIS_STREAM_MAXLEN,
+        '*', 'message', message)
+    returnValue(entry_id)
+
+
+@inlineCallbacks
+def ensure_consumer_group():
+    """
+    Creates the stream and its consumer group if they don't already exist.
+    New groups start from the beginning of the stream, so anything enqueued
+    before the first worker showed up still gets crawled.
+    """
+
+    conn = yield _get_stream_conn()
+    try:
+        yield conn.execute_command(
+            'XGROUP', 'CREATE', REDIS_STREAM_KEY, REDIS_STREAM_GROUP, '0',
+            'MKSTREAM')
+    except txredisapi.ResponseError as exc:
+        if 'BUSYGROUP' not in str(exc):
+            raise
+
+
+@inlineCallbacks
+def read_stream_entries(blocking_conn, consumer, count, block_ms):
+    """
+    Reads new entries on behalf of a consumer in our group.
+
+    :param blocking_conn: A connection from
+        :py:func:`get_blocking_stream_conn`.
+    :param str consumer: This consumer's name.
+    :param int count: The most entries to return.
+    :param int block_ms: How long to wait for entries if there are none.
+    :rtype: list
+    :returns: A (possibly empty) list of (entry_id, message) tuples.
+    """
+
+    reply = yield blocking_conn.execute_command(
+        'XREADGROUP', 'GROUP', REDIS_STREAM_GROUP, consumer,
+        'COUNT', count, 'BLOCK', block_ms, 'STREAMS', REDIS_STREAM_KEY, '>')
+    if not reply:
+        returnValue([])
+    # One [stream_key, entries] pair per stream we asked for.
+    returnValue(_parse_entries(reply[0][1]))
+
+
+@inlineCallbacks
+def ack_stream_entries(entry_ids):
+    """
+    Acknowledges entries as done, and deletes them. We're the stream's only
+    consumer group, so nobody else needs them.
+
+    :param list entry_ids: The IDs of the entries we finished.
+    """
+
+    conn = yield _get_stream_conn()
+    pipeline = yield conn.pipeline()
+    pipeline.execute_command(
+        'XACK', REDIS_STREAM_KEY, REDIS_STREAM_GROUP, *entry_ids)
+    pipeline.execute_command('XDEL', REDIS_STREAM_KEY, *entry_ids)
+    yield pipeline.execute_pipeline()
+
+
+@inlineCallbacks
+def claim_stale_entries(consumer, min_idle_ms, count):
+    """
+    Takes over entries that another consumer read but never acknowledged,
+    presumably because it died.
+
+    :param str consumer: The consumer taking the entries over.
+    :param int min_idle_ms: Only claim entries that have been pending for
+        at least this long.
+    :param int count: The most entries to claim.
+    :rtype: list
+    :returns: A (possibly empty) list of (entry_id, message) tuples.
+    """
+
+    conn = yield _get_stream_conn()
+    reply = yield conn.execute_command(
+        'XAUTOCLAIM', REDIS_STREAM_KEY, REDIS_STREAM_GROUP, consumer,
+        min_idle_ms, '0-0', 'COUNT', count)
+    # [next_start_id, entries, (deleted_ids on 7.0+)]
+    returnValue(_parse_entries(reply[1]))
+
+
+@inlineCallbacks
+def touch_stream_entries(consumer, entry_ids):
+    """
+    Resets the idle time of entries we're still working on, so that
+    :py:func:`claim_stale_entries` doesn't hand them to someone else just
+    because their crawls are taking a while. This claims them no matter
+    who has them, so it needs doing well within the claim idle time.
+
+    :param str consumer: The consumer working on the entries.
+    :param list entry_ids: The IDs of the entries.
+    :rtype: list
+    :returns: The IDs of the entries that were still pending.
+    """
+
+    conn = yield _get_stream_conn()
+    touched_ids = yield conn.execute_command(
+        'XCLAIM', REDIS_STREAM_KEY, REDIS_STREAM_GROUP, consumer, 0,
+        *(list(entry_ids) + ['JUSTID']))
+    returnValue(touched_ids)
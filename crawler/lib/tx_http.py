@@ -2,13 +2,62 @@
 Abstracting away Twisted's incredibly verbose HTTP client.
 """
 
+import time
+import weakref
+
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed, \
+    Deferred
+from twisted.internet.protocol import Protocol
 from twisted.internet.ssl import ClientContextFactory
-from twisted.web.client import Agent, RedirectAgent
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, RedirectAgent, HTTPConnectionPool, \
+    ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from crawler.conf import CRAWLER_USER_AGENT, HTTP_POOL_IDLE_TIMEOUT, \
+    HTTP_POOL_MAX_PERSISTENT_PER_HOST, HTTP_CONNECT_TIMEOUT, \
+    HTTP_RESPONSE_TIMEOUT, HTTP_TOTAL_TIMEOUT
+from crawler.lib import metrics
+
+# NOTE: We're not multi-threaded currently. If you were to introduce a
+# threadpool, this would probably be a bad idea.
+__HTTP_CONNECTION_POOL = None
+# Agents are cheap, but there's no reason to build one per request either.
+# Keyed by the follow_redirs value they were built with.
+__HTTP_AGENTS = {}
+# Response -> the time by which we need to be done reading its body. See
+# visit_url() and deliver_body().
+__RESPONSE_DEADLINES = weakref.WeakKeyDictionary()
+# Response -> the protocol that deliver_body() wrapped around its reader,
+# which keeps count of the body's size. See get_body_size().
+__RESPONSE_BODY_PROTOCOLS = weakref.WeakKeyDictionary()
+
+# Unwanted bodies up to this size get read and thrown away so the connection
+# can be re-used. Anything bigger (or of unknown size) isn't worth the
+# bandwidth, so we hang up instead.
+DISCARD_DRAIN_MAX_BYTES = 64 * 1024
+
+FETCH_CONNECT_SECONDS = metrics.histogram(
+    'crawler_fetch_connect_seconds',
+    "Time taken to open new connections (re-used ones aren't counted).")
+FETCH_TTFB_SECONDS = metrics.histogram(
+    'crawler_fetch_ttfb_seconds',
+    "Time from sending a request to having its response headers.")
+FETCH_BODY_SECONDS = metrics.histogram(
+    'crawler_fetch_body_seconds',
+    "Time spent reading (and, when streaming, parsing) response bodies.")
+FETCH_BODY_BYTES = metrics.counter(
+    'crawler_fetch_body_bytes_total', "Response body bytes received.")
+
 
-from crawler.conf import CRAWLER_USER_AGENT
+class FetchTimeout(Exception):
+    """
+    Raised when a request takes longer than one of our HTTP timeouts.
+    """
 
 
 class WebClientContextFactory(ClientContextFactory):
@@ -25,24 +74,200 @@ class WebClientContextFactory(ClientContextFactory):
         return ClientContextFactory.getContext(self)
 
 
+class _DiscardBodyProtocol(Protocol):
+    """
+    Reads a response body and throws it away. Persistent connections can't
+    go back into the pool until their response body has been fully read.
+    If ``abort`` is True, we close the connection instead of reading.
+    """
+
+    def __init__(self, deferred, abort):
+        self.deferred = deferred
+        self.abort = abort
+
+    def connectionMade(self):
+        if self.abort:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        pass
+
+    def connectionLost(self, reason):
+        self.deferred.callback(None)
+
+
+class _CappedBodyProtocol(Protocol):
+    """
+    Like the protocol behind Twisted's ``readBody``, but stops reading (and
+    drops the connection) once the body passes ``max_body_size`` bytes.
+    """
+
+    def __init__(self, deferred, max_body_size):
+        self.deferred = deferred
+        self.max_body_size = max_body_size
+        self.bytes_received = 0
+        self.data_buffer = []
+        self.is_truncated = False
+
+    def dataReceived(self, data):
+        if self.is_truncated:
+            return
+
+        self.bytes_received += len(data)
+        if self.bytes_received > self.max_body_size:
+            overage = self.bytes_received - self.max_body_size
+            self.data_buffer.append(data[:len(data) - overage])
+            self.is_truncated = True
+            self.transport.stopProducing()
+            return
+
+        self.data_buffer.append(data)
+
+    def connectionLost(self, reason):
+        if self.is_truncated or reason.check(ResponseDone, PotentialDataLoss):
+            self.deferred.callback(''.join(self.data_buffer))
+        else:
+            self.deferred.errback(reason)
+
+
+class _BodyDeadlineProtocol(Protocol):
+    """
+    Wraps another body protocol, and drops the connection if the body is
+    still coming in once the deadline passes. The wrapped protocol then sees
+    a :py:class:`FetchTimeout` in ``connectionLost``. We also keep count of
+    how many bytes came in along the way, and how long it took.
+    """
+
+    def __init__(self, wrapped, deadline):
+        self.wrapped = wrapped
+        self.deadline = deadline
+        self.timed_out = False
+        self.bytes_received = 0
+        self.started_at = None
+        self._timeout_call = None
+
+    def makeConnection(self, transport):
+        self.started_at = time.time()
+        Protocol.makeConnection(self, transport)
+        self.wrapped.makeConnection(transport)
+        if self.deadline:
+            self._timeout_call = reactor.callLater(
+                max(self.deadline - time.time(), 0), self._time_out)
+
+    def dataReceived(self, data):
+        self.bytes_received += len(data)
+        self.wrapped.dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self._timeout_call and self._timeout_call.active():
+            self._timeout_call.cancel()
+        FETCH_BODY_SECONDS.observe_since(self.started_at)
+        FETCH_BODY_BYTES.inc(self.bytes_received)
+        if self.timed_out:
+            reason = Failure(FetchTimeout("Timed out reading response body."))
+        self.wrapped.connectionLost(reason)
+
+    def _time_out(self):
+        self.timed_out = True
+        self.transport.stopProducing()
+
+
+class _TimedEndpoint(object):
+    """
+    Wraps a client endpoint to time how long connecting takes.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+
+    def connect(self, protocol_factory):
+        started_at = time.time()
+        d = self.endpoint.connect(protocol_factory)
+        d.addCallback(self._connected, started_at)
+        return d
+
+    def _connected(self, protocol, started_at):
+        FETCH_CONNECT_SECONDS.observe_since(started_at)
+        return protocol
+
+
+class _TimedAgent(Agent):
+    """
+    An Agent that times new connections. The pool only asks the endpoint to
+    connect when it doesn't have a connection to re-use.
+    """
+
+    def _getEndpoint(self, scheme, host, port):
+        return _TimedEndpoint(Agent._getEndpoint(self, scheme, host, port))
+
+
+def get_http_connection_pool():
+    """
+    Lazy-load the worker's shared HTTP connection pool.
+
+    :rtype: twisted.web.client.HTTPConnectionPool
+    :returns: A persistent (keep-alive) connection pool, shared by every
+        request this process makes.
+    """
+
+    global __HTTP_CONNECTION_POOL
+
+    if __HTTP_CONNECTION_POOL:
+        return __HTTP_CONNECTION_POOL
+
+    log.msg("Creating HTTP connection pool (max %d persistent per host)" % (
+        HTTP_POOL_MAX_PERSISTENT_PER_HOST))
+    pool = HTTPConnectionPool(reactor, persistent=True)
+    pool.maxPersistentPerHost = HTTP_POOL_MAX_PERSISTENT_PER_HOST
+    # Idle connections get evicted from the pool after this many seconds.
+    pool.cachedConnectionTimeout = HTTP_POOL_IDLE_TIMEOUT
+    __HTTP_CONNECTION_POOL = pool
+    return __HTTP_CONNECTION_POOL
+
+
+def close_http_connection_pool():
+    """
+    Closes any cached persistent connections. Call this on shutdown.
+
+    :rtype: Deferred
+    :returns: A Deferred that fires once all cached connections are closed.
+    """
+
+    global __HTTP_CONNECTION_POOL
+
+    if not __HTTP_CONNECTION_POOL:
+        return succeed(None)
+
+    pool = __HTTP_CONNECTION_POOL
+    __HTTP_CONNECTION_POOL = None
+    __HTTP_AGENTS.clear()
+    return pool.closeCachedConnections()
+
+
 def get_http_agent(follow_redirs):
     """
     :param bool follow_redirs: If True, follow 301/302 redirects transparently.
     :rtype: twisted.web.client.Agent
     :returns: A properly instantiated Agent for Twisted's HTTP client. Optionally
-        with redirect-following support.
+        with redirect-following support. All agents share the same
+        connection pool.
     """
 
+    if follow_redirs in __HTTP_AGENTS:
+        return __HTTP_AGENTS[follow_redirs]
+
     contextFactory = WebClientContextFactory()
-    agent = Agent(reactor, contextFactory)
+    agent = _TimedAgent(
+        reactor, contextFactory, pool=get_http_connection_pool(),
+        connectTimeout=HTTP_CONNECT_TIMEOUT)
     if follow_redirs:
-        return RedirectAgent(agent)
-    else:
-        return agent
+        agent = RedirectAgent(agent)
+    __HTTP_AGENTS[follow_redirs] = agent
+    return agent
 
 
 @inlineCallbacks
-def visit_url(url, follow_redirs):
+def visit_url(url, follow_redirs, headers=None):
     """
     This is probably the only function that will be of general interest in
     this module. It abstracts away all of the insanity required to make an
@@ -50,15 +275,103 @@ def visit_url(url, follow_redirs):
 
     :param str url: The URL to visit.
     :param bool follow_redirs: If True, follow 301/302 redirects transparently.
+    :param dict headers: Any extra request headers to send, such as
+        ``If-None-Match`` for a conditional GET.
     :returns: A Twisted response which we can read from.
+    :raises: FetchTimeout if we don't have the response headers within
+        ``HTTP_RESPONSE_TIMEOUT`` seconds.
     """
 
+    request_headers = Headers({'User-Agent': [CRAWLER_USER_AGENT]})
+    for name, value in (headers or {}).items():
+        request_headers.setRawHeaders(name, [value])
+
+    started_at = time.time()
     agent = get_http_agent(follow_redirs)
-    response = yield agent.request(
-        'GET', url.encode('utf-8'), Headers({'User-Agent': [CRAWLER_USER_AGENT]}))
+    d = agent.request('GET', url.encode('utf-8'), request_headers)
+    timeout_call = reactor.callLater(HTTP_RESPONSE_TIMEOUT, d.cancel)
+    try:
+        response = yield d
+    except Exception:
+        if not timeout_call.active():
+            raise FetchTimeout("No response within %ss." % HTTP_RESPONSE_TIMEOUT)
+        raise
+    finally:
+        if timeout_call.active():
+            timeout_call.cancel()
+
+    FETCH_TTFB_SECONDS.observe_since(started_at)
+    # Whatever reads the body needs to be done with it by then.
+    __RESPONSE_DEADLINES[response] = started_at + HTTP_TOTAL_TIMEOUT
     returnValue(response)
 
 
+def deliver_body(response, protocol):
+    """
+    Like ``response.deliverBody(protocol)``, but the connection gets dropped
+    if we're still reading once ``HTTP_TOTAL_TIMEOUT`` seconds have passed
+    since the request went out, and we keep track of the body's size (see
+    :py:func:`get_body_size`). Use this rather than calling ``deliverBody``
+    directly.
+
+    :param response: A Twisted HTTP client response, from
+        :py:func:`visit_url`.
+    :param protocol: The protocol to deliver the body to.
+    """
+
+    protocol = _BodyDeadlineProtocol(
+        protocol, __RESPONSE_DEADLINES.get(response))
+    __RESPONSE_BODY_PROTOCOLS[response] = protocol
+    response.deliverBody(protocol)
+
+
+def get_body_size(response):
+    """
+    :param response: A Twisted HTTP client response, whose body was read
+        through :py:func:`deliver_body`.
+    :rtype: int
+    :returns: How many bytes of the body we've received so far.
+    """
+
+    protocol = __RESPONSE_BODY_PROTOCOLS.get(response)
+    return protocol.bytes_received if protocol else 0
+
+
+def discard_response_body(response):
+    """
+    Gets rid of a response body we don't care about. Small bodies are read
+    and dropped, so the connection can be handed back to the pool for
+    re-use. Big ones (or ones that don't tell us their size) aren't worth
+    downloading, so we drop the connection instead.
+
+    :param response: A Twisted HTTP client response.
+    :rtype: Deferred
+    :returns: A Deferred that fires once the body has been dealt with.
+    """
+
+    should_abort = response.length is UNKNOWN_LENGTH or \
+        response.length > DISCARD_DRAIN_MAX_BYTES
+    d = Deferred()
+    deliver_body(response, _DiscardBodyProtocol(d, should_abort))
+    return d
+
+
+def read_body(response, max_body_size):
+    """
+    Reads a response's body into memory, up to a limit.
+
+    :param response: A Twisted HTTP client response.
+    :param int max_body_size: The most body bytes we'll read. If the body
+        is bigger than this, we drop the connection and truncate.
+    :rtype: Deferred
+    :returns: A Deferred that fires with the (possibly truncated) body.
+    """
+
+    d = Deferred()
+    deliver_body(response, _CappedBodyProtocol(d, max_body_size))
+    return d
+
+
 def get_response_headers(response):
     """
     Pulls the headers from a Twisted response and spits them out in dict form.
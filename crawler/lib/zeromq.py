@@ -0,0 +1,211 @@
+"""
+ZeroMQ bits shared by the web API and the workers.
+"""
+
+from collections import deque, OrderedDict
+import time
+
+import zmq
+from twisted.internet import reactor
+from twisted.python import log
+from txzmq import ZmqRouterConnection, ZmqDealerConnection
+
+# The first frame of a worker's request for work. The second is how many
+# batches it wants.
+CREDIT_MESSAGE = 'credit'
+
+
+class PushBacklog(object):
+    """
+    Sits in front of a PUSH connection. When every peer's pipe is at its
+    high water mark, ZeroMQ refuses new messages (EAGAIN). Rather than
+    dropping them, we hold on to them here and try again in a little bit.
+    """
+
+    def __init__(self, conn, retry_interval):
+        """
+        :param ZmqPushConnection conn: The connection to push through.
+        :param float retry_interval: Seconds to wait before trying again
+            when every peer is full.
+        """
+
+        self.conn = conn
+        self.retry_interval = retry_interval
+        self.backlog = deque()
+        self._retry_call = None
+
+    def __len__(self):
+        return len(self.backlog)
+
+    def push(self, message):
+        """
+        :param str message: The message to send along.
+        """
+
+        self.backlog.append(message)
+        if not self._retry_call:
+            # Otherwise we're already waiting on the peers to free up.
+            self.flush()
+
+    def flush(self):
+        """
+        Push as many backlogged messages as the peers will take. If they're
+        all full, try again in a little bit.
+        """
+
+        self._retry_call = None
+        while self.backlog:
+            try:
+                self.conn.push(self.backlog[0])
+            except zmq.ZMQError as exc:
+                if exc.errno != zmq.EAGAIN:
+                    raise
+                self._retry_call = reactor.callLater(
+                    self.retry_interval, self.flush)
+                return
+            self.backlog.popleft()
+
+    def stop(self):
+        """
+        Stop retrying. Anything still backlogged is dropped.
+        """
+
+        if self._retry_call and self._retry_call.active():
+            self._retry_call.cancel()
+        self._retry_call = None
+        if self.backlog:
+            log.msg("Dropping %d backlogged message(s) for %r." % (
+                len(self.backlog), self.conn))
+        self.backlog.clear()
+
+
+class CreditRouterConnection(ZmqRouterConnection):
+    """
+    The broker's end of credit-based dispatch. Workers (through a
+    :py:class:`CreditDealerConnection`) tell us how many batches they want,
+    and we only ever send them that many. Work nobody has asked for stays
+    with the broker, where it can be scheduled fairly, rather than piling up
+    in some busy worker's socket buffers.
+
+    :py:meth:`push` works like a PUSH socket's: it raises EAGAIN if no
+    worker has asked for anything, so it fits in behind the same backlogs.
+    """
+
+    def __init__(self, factory, endpoint=None):
+        # Worker identity -> batches it has asked for that we haven't sent.
+        # Kept in the order we'll get to them in, for round-robin.
+        self.credits = OrderedDict()
+        # Called with no arguments whenever a worker asks for work.
+        self.onCredit = None
+        ZmqRouterConnection.__init__(self, factory, endpoint)
+        # Fail sends to workers that have gone away, rather than silently
+        # dropping them.
+        self.socket.set(zmq.ROUTER_MANDATORY, 1)
+
+    def gotMessage(self, sender_id, *parts):
+        if len(parts) != 2 or parts[0] != CREDIT_MESSAGE:
+            log.msg("Ignoring unexpected message from a worker: %r" % (
+                parts,))
+            return
+        try:
+            wanted = int(parts[1])
+        except ValueError:
+            log.msg("Ignoring bad credit from a worker: %r" % parts[1])
+            return
+
+        # Workers say how many they want in all, not how many more, so
+        # repeating themselves is harmless.
+        self.credits.pop(sender_id, None)
+        if wanted > 0:
+            self.credits[sender_id] = wanted
+            if self.onCredit:
+                self.onCredit()
+
+    def has_credit(self):
+        """
+        :rtype: bool
+        :returns: True if some worker has asked for work.
+        """
+
+        return bool(self.credits)
+
+    def get_credit_count(self):
+        """
+        :rtype: int
+        :returns: How many batches workers have asked for in all.
+        """
+
+        return sum(self.credits.values())
+
+    def push(self, message):
+        """
+        Sends a message to the next worker in line that has asked for one.
+
+        :param str message: The message to send along.
+        :raises: ZMQError (EAGAIN) if no worker has asked for anything.
+        """
+
+        while self.credits:
+            worker_id, wanted = self.credits.popitem(last=False)
+            try:
+                self.send([worker_id, message])
+            except zmq.ZMQError as exc:
+                if exc.errno not in (zmq.EHOSTUNREACH, zmq.EAGAIN):
+                    raise
+                # It's gone (or wedged). If it's still around, it'll ask
+                # again.
+                continue
+            if wanted > 1:
+                self.credits[worker_id] = wanted - 1
+            return
+        raise zmq.ZMQError(zmq.EAGAIN)
+
+
+class CreditDealerConnection(ZmqDealerConnection):
+    """
+    A worker's end of credit-based dispatch, connected to one broker. We ask
+    for work with :py:meth:`request`, and the broker never sends more than
+    we've asked for, so that's all that can pile up here.
+    """
+
+    def __init__(self, factory, endpoint=None):
+        # Batches we've asked for that haven't shown up yet.
+        self.outstanding = 0
+        # When we last asked, or last heard from the broker.
+        self.last_activity = 0
+        # Called with each batch (a str) the broker sends us.
+        self.onBatch = None
+        ZmqDealerConnection.__init__(self, factory, endpoint)
+
+    def gotMessage(self, message, *parts):
+        self.outstanding = max(0, self.outstanding - 1)
+        self.last_activity = time.time()
+        if self.onBatch:
+            self.onBatch(message)
+
+    def request(self, wanted):
+        """
+        :param int wanted: How many batches we want from this broker in all,
+            counting any we've already asked for.
+        """
+
+        self.outstanding = wanted
+        self.last_activity = time.time()
+        try:
+            self.send([CREDIT_MESSAGE, str(wanted)])
+        except zmq.ZMQError as exc:
+            if exc.errno != zmq.EAGAIN:
+                raise
+            # Not connected yet. refresh() will try again.
+
+    def refresh(self, interval):
+        """
+        If we've been waiting on work for longer than ``interval`` seconds,
+        ask again. The broker may have restarted, or our request may have
+        got lost along the way.
+
+        :param float interval: How long to wait before asking again.
+        """
+
+        if self.outstanding and time.time() - self.last_activity > interval:
+            self.request(self.outstanding)
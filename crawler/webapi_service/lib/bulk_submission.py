@@ -0,0 +1,168 @@
+"""
+Bulk job submission. Rather than one long run of URLs, the request body
+holds a URL per line (``format=lines``), or a JSON value per line
+(``format=ndjson``): either a URL string, or an object with a ``url``.
+
+Twisted spools big request bodies to a temporary file before we see them,
+so we read that a chunk at a time. The job is created as soon as we have
+the first chunk, and the rest goes into Redis and out to the workers in the
+background, so the caller gets their job ID without waiting for the lot.
+"""
+
+import json
+from itertools import islice
+from urlparse import urlsplit
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.task import deferLater
+
+from crawler.conf import BULK_SUBMIT_CHUNK_SIZE, BULK_SUBMIT_MAX_BACKLOG, \
+    BULK_SUBMIT_BACKOFF
+from crawler.lib.crawl_scope import get_host
+from crawler.lib.data_store import enqueue_unseen_urls, get_job_control, \
+    finish_job_ingest
+from crawler.lib.misc_utils import remove_cr_and_lf
+from crawler.webapi_service.lib.job_queue import enqueue_crawling_job
+
+BULK_FORMATS = ('lines', 'ndjson')
+
+
+def iter_bulk_urls(body_file, input_format):
+    """
+    :param file body_file: The request body.
+    :param str input_format: One of ``BULK_FORMATS``.
+    :returns: A generator of the (valid, absolute HTTP or HTTPS) URLs in the
+        body, with any CRs and LFs taken out. Anything else is logged and
+        skipped.
+    """
+
+    skipped = 0
+    for line in body_file:
+        line = line.strip()
+        if not line:
+            continue
+
+        url = line
+        if input_format == 'ndjson':
+            try:
+                url = json.loads(line)
+            except ValueError:
+                url = None
+            if isinstance(url, dict):
+                url = url.get('url')
+            if isinstance(url, unicode):
+                url = url.encode('utf-8')
+
+        if not isinstance(url, str):
+            skipped += 1
+            continue
+        # A JSON string can hold a \n (and a line can hold a lone \r), which
+        # would split the URL in two in a newline-delimited crawl batch.
+        url = remove_cr_and_lf(url)
+        if _is_valid_url(url):
+            yield url
+        else:
+            skipped += 1
+
+    if skipped:
+        log.msg("Skipped %d invalid line(s) in bulk submission." % skipped)
+
+
+def _is_valid_url(url):
+    """
+    :param str url: A URL from a bulk submission.
+    :rtype: bool
+    """
+
+    try:
+        parsed = urlsplit(url)
+    except ValueError:
+        return False
+    return parsed.scheme in ('http', 'https') and bool(parsed.hostname)
+
+
+def iter_chunks(urls, chunk_size=BULK_SUBMIT_CHUNK_SIZE):
+    """
+    :param urls: An iterable of URLs.
+    :param int chunk_size: The most URLs per chunk.
+    :returns: A generator of sets of up to ``chunk_size`` URLs.
+    """
+
+    urls = iter(urls)
+    while True:
+        chunk = set(islice(urls, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@inlineCallbacks
+def get_bulk_seed_hosts(body_file, input_format):
+    """
+    Host and domain scopes need to know every seed's host before the job is
+    created. This reads through the whole body to find them, then rewinds.
+    There are usually far fewer hosts than URLs. The body can be big, so we
+    go a chunk at a time, letting the reactor get on with other things in
+    between.
+
+    :param file body_file: The request body.
+    :param str input_format: One of ``BULK_FORMATS``.
+    :rtype: Deferred
+    :returns: A Deferred that fires with the set of hosts.
+    """
+
+    hosts = set()
+    for chunk in iter_chunks(iter_bulk_urls(body_file, input_format)):
+        hosts.update(get_host(url) for url in chunk)
+        yield deferLater(reactor, 0, lambda: None)
+    body_file.seek(0)
+    returnValue(hosts)
+
+
+def _sleep(seconds):
+    d = Deferred()
+    reactor.callLater(seconds, d.callback, None)
+    return d
+
+
+@inlineCallbacks
+def ingest_job_urls(broadcast_svc, job_id, chunks, body_file):
+    """
+    Feeds the rest of a bulk submission's seeds into a job (created with
+    ``ingesting=True``), a chunk at a time. If the broadcaster gets backed
+    up, we wait for it rather than hold every announcement in memory.
+
+    :param broadcast_svc: The service that announces work to the workers.
+    :param str job_id: A job's UUID4 ID string.
+    :param chunks: The rest of the seeds, from :py:func:`iter_chunks`.
+    :param file body_file: The request body. We close it once we're done.
+    """
+
+    url_count = 0
+    try:
+        for chunk in chunks:
+            while broadcast_svc.get_backlog_size() > BULK_SUBMIT_MAX_BACKLOG:
+                yield _sleep(BULK_SUBMIT_BACKOFF)
+
+            # The seeds count as seen, same as for create_job(), so any
+            # repeats are dropped here.
+            urls = yield enqueue_unseen_urls(job_id, chunk)
+            if urls:
+                enqueue_crawling_job(broadcast_svc, job_id, urls, depth=0)
+                url_count += len(urls)
+                continue
+
+            # Either they were all repeats, or the job has been stopped.
+            control = yield get_job_control(job_id)
+            if control['stopped']:
+                log.msg("Job %s was stopped (%s) during bulk submission." % (
+                    job_id, control['stopped']))
+                break
+    finally:
+        body_file.close()
+
+    yield finish_job_ingest(job_id)
+    log.msg("Finished bulk submission for job %s (%d more URL(s))." % (
+        job_id, url_count))
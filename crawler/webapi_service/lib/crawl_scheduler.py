@@ -0,0 +1,246 @@
+"""
+Decides which crawl announcements go out first when the workers can't keep
+up. Rather than first come, first served, every job with work waiting gets
+an even share of the workers, so one big job's fan-out can't hold up the
+seeds of every job submitted after it.
+
+Workers only take the work they've asked for (see
+:py:class:`crawler.lib.zeromq.CreditRouterConnection`), so whatever they
+can't keep up with waits here, and this is where it gets scheduled.
+"""
+
+from collections import deque
+
+import zmq
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from crawler.conf import CRAWL_DEPTH_COST, JOB_MAX_IN_FLIGHT, \
+    JOB_IN_FLIGHT_REFRESH_INTERVAL
+from crawler.lib.crawl_messages import decode_crawl_batch
+from crawler.lib.data_store import get_in_progress_counts
+
+
+class FairShareBacklog(object):
+    """
+    A drop-in replacement for :py:class:`crawler.lib.zeromq.PushBacklog`
+    that schedules backlogged batches with start-time fair queuing.
+
+    Each job has a virtual time: how much of the workers' time it has had,
+    in URLs. URLs count ``depth_cost`` times over for each level of depth,
+    so a deep fan-out gets less of a share than a job's seeds do. We always
+    send the next batch from the job with the lowest virtual time, and
+    within a job, the shallowest batch goes first. A job that shows up (or
+    comes back after a quiet spell) starts out level with whatever was sent
+    last, so it can't hog the workers to make up for lost time.
+
+    With ``max_in_flight`` set, jobs with that many URLs in progress are
+    passed over until some of them finish. We only find out how many a job
+    has in progress every ``refresh_interval`` seconds, and URLs we've sent
+    haven't necessarily been picked up by a worker yet. So we count what we
+    sent a job over the last refresh interval as in progress too. The limit
+    is approximate either way.
+
+    Batches are only decoded once they have to wait. When nothing is
+    backlogged and a worker is asking for work, they go straight through
+    as-is. With ``max_in_flight`` set, we have to know each batch's job,
+    so every batch gets decoded.
+    """
+
+    def __init__(self, conn, retry_interval, depth_cost=CRAWL_DEPTH_COST,
+                 max_in_flight=JOB_MAX_IN_FLIGHT,
+                 refresh_interval=JOB_IN_FLIGHT_REFRESH_INTERVAL):
+        """
+        :param CreditRouterConnection conn: The connection to push through.
+        :param float retry_interval: Seconds to wait before trying again
+            when no worker has asked for work.
+        :param float depth_cost: How many times over a URL counts against
+            its job's share for each level of depth.
+        :param int max_in_flight: The most URLs a job can have in progress
+            before we hold the rest of its work back. 0 for no limit.
+        :param float refresh_interval: How often (in seconds) to check how
+            many URLs each job has in progress.
+        """
+
+        self.conn = conn
+        self.retry_interval = retry_interval
+        self.depth_cost = depth_cost
+        self.max_in_flight = max_in_flight
+        self.refresh_interval = refresh_interval
+        # job_id -> {depth: deque of (message, num_urls) tuples}.
+        self.queues = {}
+        # job_id -> virtual time, for jobs with work waiting.
+        self.virtual_times = {}
+        # The virtual time of the last batch we sent.
+        self.virtual_time = 0
+        # job_id -> roughly how many URLs it has in progress. Only kept up
+        # to date when there's a limit.
+        self.in_flight = {}
+        # job_id -> URLs sent since the last refresh.
+        self.recently_sent = {}
+        self._size = 0
+        self._retry_call = None
+        self._refresh_loop = None
+
+    def __len__(self):
+        return self._size
+
+    def push(self, message):
+        """
+        :param str message: A batched crawl message to send along.
+        """
+
+        if not self._size and not self.max_in_flight:
+            # Nothing is waiting, so there's nobody to be fair to. Send it
+            # straight along if a worker wants it, without decoding it.
+            try:
+                self.conn.push(message)
+                return
+            except zmq.ZMQError as exc:
+                if exc.errno != zmq.EAGAIN:
+                    raise
+
+        try:
+            job_id, depth, urls = decode_crawl_batch(message)
+        except ValueError as exc:
+            log.err("Discarding malformed crawl message: %s" % exc)
+            return
+
+        job_queues = self.queues.get(job_id)
+        if job_queues is None:
+            job_queues = self.queues[job_id] = {}
+            self.virtual_times[job_id] = self.virtual_time
+        job_queues.setdefault(depth, deque()).append((message, len(urls)))
+        self._size += 1
+
+        if self.max_in_flight:
+            self._start_refreshing()
+        if not self._retry_call:
+            # Otherwise we're already waiting on the peers to free up.
+            self.flush()
+
+    def flush(self):
+        """
+        Push as many backlogged messages as the peers will take, fairest
+        first. If they're all full, try again in a little bit.
+        """
+
+        self._retry_call = None
+        while self._size:
+            job_id = self._pick_job()
+            if job_id is None:
+                # Every job with work waiting is at its limit. The next
+                # refresh will pick things back up.
+                return
+
+            job_queues = self.queues[job_id]
+            depth = min(job_queues)
+            message, num_urls = job_queues[depth][0]
+            try:
+                self.conn.push(message)
+            except zmq.ZMQError as exc:
+                if exc.errno != zmq.EAGAIN:
+                    raise
+                self._retry_call = reactor.callLater(
+                    self.retry_interval, self.flush)
+                return
+            self._sent(job_id, depth, num_urls)
+
+    def wake(self):
+        """
+        Try sending again now, rather than waiting for the next retry. Used
+        when a worker asks for work.
+        """
+
+        if not self._retry_call:
+            # Either nothing is waiting, or every job is at its limit.
+            return
+        if self._retry_call.active():
+            self._retry_call.cancel()
+        self.flush()
+
+    def _pick_job(self):
+        """
+        :rtype: str
+        :returns: The ID of the job whose turn it is, or None if every job
+            with work waiting is at its limit.
+        """
+
+        job_ids = self.queues.keys()
+        if self.max_in_flight:
+            job_ids = [
+                job_id for job_id in job_ids
+                if self.in_flight.get(job_id, 0) < self.max_in_flight]
+        if not job_ids:
+            return None
+        return min(job_ids, key=self.virtual_times.get)
+
+    def _sent(self, job_id, depth, num_urls):
+        job_queues = self.queues[job_id]
+        job_queues[depth].popleft()
+        if not job_queues[depth]:
+            del job_queues[depth]
+        self._size -= 1
+
+        self.virtual_time = self.virtual_times[job_id]
+        self.virtual_times[job_id] += num_urls * self.depth_cost ** depth
+        if self.max_in_flight:
+            self.in_flight[job_id] = self.in_flight.get(job_id, 0) + num_urls
+            self.recently_sent[job_id] = \
+                self.recently_sent.get(job_id, 0) + num_urls
+
+        if not job_queues:
+            del self.queues[job_id]
+            del self.virtual_times[job_id]
+
+    def _start_refreshing(self):
+        if self._refresh_loop and self._refresh_loop.running:
+            return
+        self._refresh_loop = LoopingCall(self._refresh_in_flight)
+        self._refresh_loop.start(self.refresh_interval)\
+            .addErrback(log.err, "Job in-flight refresh loop died.")
+
+    def _refresh_in_flight(self):
+        if not self._size:
+            # Nothing's being held back, so there's nothing to keep track of
+            # until the backlog builds up again. We hang on to the last
+            # numbers we got until then, stale or not.
+            self._refresh_loop.stop()
+            return
+
+        return get_in_progress_counts(self.queues.keys())\
+            .addCallbacks(self._in_flight_refreshed, self._in_flight_failed)
+
+    def _in_flight_refreshed(self, counts):
+        self.in_flight = counts
+        for job_id, num_urls in self.recently_sent.items():
+            self.in_flight[job_id] = self.in_flight.get(job_id, 0) + num_urls
+        self.recently_sent = {}
+        if not self._retry_call:
+            self.flush()
+
+    def _in_flight_failed(self, failure):
+        # Rather than hold jobs back on numbers we can't update, let
+        # everything through until Redis comes back.
+        log.err(failure, "Couldn't check how many URLs jobs have in progress.")
+        self._in_flight_refreshed({})
+
+    def stop(self):
+        """
+        Stop retrying. Anything still backlogged is dropped.
+        """
+
+        if self._retry_call and self._retry_call.active():
+            self._retry_call.cancel()
+        self._retry_call = None
+        if self._refresh_loop and self._refresh_loop.running:
+            self._refresh_loop.stop()
+        if self._size:
+            log.msg("Dropping %d backlogged message(s) for %r." % (
+                self._size, self.conn))
+        self.queues.clear()
+        self.virtual_times.clear()
+        self.in_flight.clear()
+        self.recently_sent.clear()
+        self._size = 0
@@ -0,0 +1,155 @@
+"""
+Fans job progress events out to everyone following them. The job state
+scripts publish an event to a job's channel whenever it makes progress (see
+:py:data:`crawler.lib.data_store.JOB_EVENTS_CHANNEL_PREFIX`). We keep a
+single Redis subscription per job, no matter how many clients are
+following it, and drop it once the last of them goes away.
+
+The subscriber connection itself is looked after by
+:py:class:`JobEventListenerService
+<crawler.webapi_service.services.job_events.JobEventListenerService>`.
+"""
+
+from twisted.python import log
+from twisted.internet.defer import Deferred
+
+from crawler.lib.data_store import JOB_EVENTS_CHANNEL_PREFIX
+
+# Lazy-loaded by get_job_event_hub().
+__JOB_EVENT_HUB = None
+
+
+class JobEventHub(object):
+    """
+    Keeps track of who's listening for which job's events.
+    """
+
+    def __init__(self):
+        # job_id -> set of callables, each called with every event (a JSON
+        # string) published for the job.
+        self.listeners = {}
+        # job_id -> Deferreds waiting for the job's subscription to go
+        # through. Each SUBSCRIBE holds on to the list it was sent for, so a
+        # late reply to one we've since given up on can't fire anybody else's.
+        self._subscribing = {}
+        # Our SubscriberProtocol, while we're connected.
+        self.protocol = None
+
+    def add_listener(self, job_id, listener):
+        """
+        :param str job_id: A job's UUID4 ID string.
+        :param callable listener: Called with each of the job's events.
+        :rtype: Deferred
+        :returns: A Deferred that fires once we're subscribed to the job's
+            events, so nothing published from then on will be missed. If
+            subscribing fails, so does this, and the listener is dropped.
+        """
+
+        if job_id not in self.listeners:
+            self.listeners[job_id] = set()
+            self._subscribe(job_id)
+        self.listeners[job_id].add(listener)
+
+        d = Deferred()
+        if job_id in self._subscribing:
+            self._subscribing[job_id].append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def remove_listener(self, job_id, listener):
+        """
+        :param str job_id: A job's UUID4 ID string.
+        :param callable listener: A listener passed to
+            :py:meth:`add_listener`.
+        """
+
+        listeners = self.listeners.get(job_id)
+        if not listeners:
+            return
+        listeners.discard(listener)
+        if listeners:
+            return
+
+        del self.listeners[job_id]
+        # Nobody's left waiting on these.
+        self._subscribing.pop(job_id, None)
+        if self.protocol:
+            self.protocol.unsubscribe(JOB_EVENTS_CHANNEL_PREFIX + job_id)\
+                .addErrback(log.err, "Failed to unsubscribe from %s" % job_id)
+
+    def _subscribe(self, job_id):
+        waiters = self._subscribing.setdefault(job_id, [])
+        if not self.protocol:
+            # We'll get to it once we're connected.
+            return
+        self.protocol.subscribe(JOB_EVENTS_CHANNEL_PREFIX + job_id)\
+            .addCallbacks(self._subscribed, self._subscribe_failed,
+                          callbackArgs=(job_id, waiters),
+                          errbackArgs=(job_id, waiters))
+
+    def _subscribed(self, _, job_id, waiters):
+        if self._subscribing.get(job_id) is not waiters:
+            # Everybody went away while we were subscribing.
+            return
+        del self._subscribing[job_id]
+        for d in waiters:
+            d.callback(None)
+
+    def _subscribe_failed(self, failure, job_id, waiters):
+        log.err(failure, "Failed to subscribe to %s" % job_id)
+        if self._subscribing.get(job_id) is not waiters:
+            return
+        # We're not getting this job's events, so forget its listeners, and
+        # the next one to come along will try subscribing again. Any that
+        # were already listening (we're resubscribing after a reconnect)
+        # stop hearing about it, as they would have anyway.
+        del self._subscribing[job_id]
+        self.listeners.pop(job_id, None)
+        for d in waiters:
+            d.errback(failure)
+
+    def connected(self, protocol):
+        """
+        Called once our subscriber connection is ready. Subscribes to every
+        job that somebody's listening to.
+
+        :param txredisapi.SubscriberProtocol protocol: The connection.
+        """
+
+        self.protocol = protocol
+        for job_id in self.listeners:
+            self._subscribe(job_id)
+
+    def disconnected(self):
+        """
+        Called when we lose our subscriber connection. Anything published
+        until we're back is lost, though the counters in the next event
+        catch listeners back up.
+        """
+
+        self.protocol = None
+
+    def message_received(self, channel, message):
+        """
+        :param str channel: The channel the event was published to.
+        :param str message: The event, as a JSON string.
+        """
+
+        job_id = channel[len(JOB_EVENTS_CHANNEL_PREFIX):]
+        for listener in list(self.listeners.get(job_id, ())):
+            listener(message)
+
+
+def get_job_event_hub():
+    """
+    Lazy-load the process's job event hub.
+
+    :rtype: JobEventHub
+    """
+
+    global __JOB_EVENT_HUB
+
+    if not __JOB_EVENT_HUB:
+        __JOB_EVENT_HUB = JobEventHub()
+    return __JOB_EVENT_HUB
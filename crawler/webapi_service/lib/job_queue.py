@@ -4,7 +4,8 @@ for the sake of simplicity. If we were more concerned about durability,
 RabbitMQ, Kafka, or any number of alternatives are a better fit.
 """
 
-import json
+from crawler.conf import CRAWL_MESSAGE_BATCH_SIZE
+from crawler.lib.crawl_messages import encode_crawl_batch
 
 
 def enqueue_crawling_job(delegate_or_broadcast_svc, job_id, urls, depth):
@@ -19,19 +20,16 @@ def enqueue_crawling_job(delegate_or_broadcast_svc, job_id, urls, depth):
         service uses ZeroMQDelegatorService to delegate any sub-links found
         while scouring a page.
     :param int job_id: The job ID that these URLs fall under.
-    :param set urls: The URLs to crawl. We'll send out one announcement
-        per URL.
+    :param set urls: The URLs to crawl. These go out in batches of up to
+        ``CRAWL_MESSAGE_BATCH_SIZE`` per announcement.
     :param int depth: The depth that this crawl will be at. 0 being initial.
     :rtype: int
-    :returns: The number of crawler announcements made. One per URL.
+    :returns: The number of URLs announced.
     """
 
-    message_dict = {
-        'job_id': job_id,
-        'depth': depth
-    }
-    for url in urls:
-        message_dict['url'] = url
-        message_str = json.dumps(message_dict)
+    urls = list(urls)
+    for i in range(0, len(urls), CRAWL_MESSAGE_BATCH_SIZE):
+        message_str = encode_crawl_batch(
+            job_id, depth, urls[i:i + CRAWL_MESSAGE_BATCH_SIZE])
         delegate_or_broadcast_svc.send_message(message_str)
     return len(urls)
@@ -5,11 +5,18 @@ Web resources that are used to view job details.
 import json
 
 from twisted.python import log
+from twisted.internet.task import LoopingCall
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
-from crawler.lib.data_store import get_job_data
+from crawler.conf import JOB_EVENTS_KEEPALIVE_INTERVAL
+from crawler.lib.data_store import get_job_data, get_job_summary, \
+    get_job_set_page, stop_job, JOB_SET_KEYS, JOB_ARCHIVED_EVENT
 from crawler.lib.json_encoder import JobDataEncoder
+from crawler.webapi_service.lib.job_events import get_job_event_hub
+
+# The most set members we'll hand back per page.
+MAX_PAGE_SIZE = 1000
 
 
 class JobResource(Resource):
@@ -34,7 +41,8 @@ class JobDetailResource(Resource):
     """
     URL: /job/<job-id-uuid>
 
-    Retrieves a JSON dict of job data for the given ID.
+    Retrieves a JSON dict of job data for the given ID. Pass ``?summary=1``
+    to get counts instead of full sets, which is much cheaper for big jobs.
     """
 
     def __init__(self, broadcast_svc, job_id):
@@ -43,9 +51,21 @@ class JobDetailResource(Resource):
         self.broadcast_svc = broadcast_svc
         self.job_id = job_id
 
+    def getChild(self, path, request):
+        if path in JOB_SET_KEYS:
+            return JobSetResource(self.broadcast_svc, self.job_id, path)
+        if path == 'cancel':
+            return JobCancelResource(self.broadcast_svc, self.job_id)
+        if path == 'events':
+            return JobEventsResource(self.broadcast_svc, self.job_id)
+        return Resource.getChild(self, path, request)
+
     def render_GET(self, request):
-        get_job_data(self.job_id)\
-            .addCallback(self._handle_success, request)\
+        if request.args.get('summary', ['0'])[0] == '1':
+            d = get_job_summary(self.job_id)
+        else:
+            d = get_job_data(self.job_id)
+        d.addCallback(self._handle_success, request)\
             .addErrback(self._handle_error, request)
         return NOT_DONE_YET
 
@@ -55,16 +75,16 @@ class JobDetailResource(Resource):
         request.finish()
 
     def _handle_error(self, err, request):
-        exc = err.trap(ValueError)
-        if exc == ValueError:
+        # Anything else (failing to subscribe to a job's events, say) still
+        # needs an answer, or the client is left hanging.
+        if err.check(ValueError):
             request.setResponseCode(404)
             error_json = json.dumps({
                     'message': "Invalid job ID.",
             })
             print "VALUERROR"
         else:
-            log.err("Error encountered when retrieving job data.")
-            log.err(exc)
+            log.err(err, "Error encountered when retrieving job data.")
 
             request.setResponseCode(500)
             error_json = json.dumps({
@@ -74,3 +94,171 @@ class JobDetailResource(Resource):
         request.setHeader('Content-Type', 'application/json')
         request.write(error_json)
         request.finish()
+
+
+# noinspection PyPep8Naming
+class JobSetResource(JobDetailResource):
+    """
+    URL: /job/<job-id-uuid>/<urls|pending|in_progress|completed|failed|images>
+
+    Pages through one of the job's sets. Takes optional ``cursor`` and
+    ``count`` query args. Keep passing the returned cursor back in until
+    it comes back as 0.
+    """
+
+    isLeaf = True
+
+    def __init__(self, broadcast_svc, job_id, set_name):
+        JobDetailResource.__init__(self, broadcast_svc, job_id)
+
+        self.set_name = set_name
+
+    def render_GET(self, request):
+        try:
+            cursor = int(request.args.get('cursor', ['0'])[0])
+            count = int(request.args.get('count', ['100'])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({
+                'message': "cursor and count must be integers.",
+            })
+
+        count = max(1, min(count, MAX_PAGE_SIZE))
+        get_job_set_page(self.job_id, self.set_name, cursor, count)\
+            .addCallback(self._handle_success, request)\
+            .addErrback(self._handle_error, request)
+        return NOT_DONE_YET
+
+
+# noinspection PyPep8Naming
+class JobCancelResource(JobDetailResource):
+    """
+    URL: /job/<job-id-uuid>/cancel
+
+    POST here to cancel a job. Workers drop any of its URLs they haven't
+    started on, and whatever is in progress is allowed to finish. Returns
+    the job's summary.
+    """
+
+    isLeaf = True
+    # Only POST makes sense here.
+    render_GET = None
+
+    def render_POST(self, request):
+        d = stop_job(self.job_id, 'cancelled')
+        d.addCallback(lambda _: get_job_summary(self.job_id))
+        d.addCallback(self._handle_success, request)\
+            .addErrback(self._handle_error, request)
+        return NOT_DONE_YET
+
+
+# noinspection PyPep8Naming
+class JobEventsResource(JobDetailResource):
+    """
+    URL: /job/<job-id-uuid>/events
+
+    Streams the job's progress as Server-Sent Events, so there's no need to
+    poll. The first event (``summary``) is the job's summary, as from
+    ``/job/<id>?summary=1``. After that, each ``progress`` event holds
+    whatever changed: any of ``completed``, ``failed`` and ``images`` (lists
+    of URLs new to those sets), ``stopped`` (why the job was stopped), and
+    the job's ``counters`` as they now stand. Once the job has been
+    archived, we send an ``archived`` event and close the stream.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        _JobEventStream(self.job_id, request).start()\
+            .addErrback(self._handle_error, request)
+        return NOT_DONE_YET
+
+
+class _JobEventStream(object):
+    """
+    One client's stream of a job's events.
+    """
+
+    def __init__(self, job_id, request):
+        self.job_id = job_id
+        self.request = request
+        # Events that showed up before we'd sent the summary.
+        self.pending = []
+        self.summary_sent = False
+        self.finished = False
+        self.keepalive = LoopingCall(self._send_keepalive)
+
+    def start(self):
+        """
+        :rtype: Deferred
+        :returns: A Deferred that fires once the summary has been sent, or
+            fails with ValueError if there's no such job.
+        """
+
+        self.request.notifyFinish().addBoth(self._stop)
+        # Subscribe before reading the summary, so nothing can slip through
+        # the gap between the two.
+        d = get_job_event_hub().add_listener(self.job_id, self._event_received)
+        d.addCallback(lambda _: get_job_summary(self.job_id))
+        d.addCallback(self._send_summary)
+        d.addErrback(self._ignore_if_gone)
+        return d
+
+    def _ignore_if_gone(self, failure):
+        # If the client has already hung up, there's nobody to tell.
+        if not self.finished:
+            return failure
+
+    def _send_summary(self, summary):
+        if self.finished:
+            return
+        self.request.setHeader('Content-Type', 'text/event-stream')
+        self.request.setHeader('Cache-Control', 'no-cache')
+        self._write_event('summary', json.dumps(summary, cls=JobDataEncoder))
+        if summary.get('archived'):
+            self._finish()
+            return
+
+        self.summary_sent = True
+        pending, self.pending = self.pending, []
+        for message in pending:
+            self._event_received(message)
+        if not self.finished:
+            self.keepalive.start(JOB_EVENTS_KEEPALIVE_INTERVAL, now=False)
+
+    def _event_received(self, message):
+        if self.finished:
+            return
+        if not self.summary_sent:
+            self.pending.append(message)
+            return
+
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        if message == JOB_ARCHIVED_EVENT:
+            self._write_event('archived', message)
+            self._finish()
+        else:
+            # Events are already JSON, straight from the job state scripts.
+            self._write_event('progress', message)
+
+    def _write_event(self, event, data):
+        self.request.write('event: %s\ndata: %s\n\n' % (event, data))
+
+    def _send_keepalive(self):
+        self.request.write(': keepalive\n\n')
+
+    def _finish(self):
+        self.request.finish()
+        self._stop(None)
+
+    def _stop(self, result):
+        # Called once we're done, or the client has gone away.
+        if self.finished:
+            return
+        self.finished = True
+        if self.keepalive.running:
+            self.keepalive.stop()
+        get_job_event_hub().remove_listener(
+            self.job_id, self._event_received)
@@ -1,11 +1,17 @@
 import cgi
 import json
+import time
+from StringIO import StringIO
 
 from twisted.python import log
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
+from crawler.lib.crawl_scope import CrawlScope, get_host
 from crawler.lib.data_store import create_job
+from crawler.webapi_service.lib.bulk_submission import BULK_FORMATS, \
+    iter_bulk_urls, iter_chunks, get_bulk_seed_hosts, ingest_job_urls
 from crawler.webapi_service.lib.job_queue import enqueue_crawling_job
 from crawler.lib.misc_utils import remove_cr_and_lf
 from crawler.lib.json_encoder import JobDataEncoder
@@ -24,6 +30,35 @@ class JobSubmissionResource(Resource):
     we have to do our best with this, it's not fool-proof.
 
     Valid responses and errors are both returned with in JSON.
+
+    Jobs can be given a budget with any of these query args:
+
+    * ``max_pages``: Stop after crawling (or failing to crawl) this many pages.
+    * ``max_bytes``: Stop after downloading this many bytes.
+    * ``max_depth``: Don't follow links any deeper than this.
+    * ``max_seconds``: Stop this many seconds after the job was submitted.
+
+    Budgets are checked as the job goes, so a job may overshoot a little.
+
+    Jobs can also be kept from wandering off with these:
+
+    * ``scope``: ``host`` only follows links to the seed URLs' hosts, and
+      ``domain`` to those or their subdomains (``www.`` is ignored). The
+      default, ``any``, follows links anywhere.
+    * ``include``: Only follow links matching this regex. May be repeated,
+      in which case links have to match one of them.
+    * ``exclude``: Don't follow links matching this regex. May be repeated.
+    * ``strip_params``: A comma-separated list of query parameters to remove
+      from links before following them, so ``?utm_source=a`` and
+      ``?utm_source=b`` get crawled once. ``utm_*`` strips every parameter
+      starting with ``utm_``.
+
+    For big seed lists, pass ``format=lines`` (one URL per line) or
+    ``format=ndjson`` (one JSON URL string, or object with a ``url``, per
+    line). Invalid lines are skipped. The response comes back once the job
+    has its first batch of seeds, with ``ingesting`` set. The rest are added
+    in the background, and ``ingesting`` drops out of the job's summary once
+    they're all in.
     """
 
     def __init__(self, broadcast_svc):
@@ -32,6 +67,10 @@ class JobSubmissionResource(Resource):
         self.broadcast_svc = broadcast_svc
 
     def render_POST(self, request):
+        input_format = request.args.get('format', [None])[0]
+        if input_format:
+            return self._render_bulk_POST(request, input_format)
+
         # Read their whole request body in at once. If we were serious, we'd
         # probably buffer this and make sure our front-facing proxy protects us.
         body = cgi.escape(request.content.read())
@@ -41,11 +80,134 @@ class JobSubmissionResource(Resource):
         body = remove_cr_and_lf(body)
         # Do our best to figure out which URLs to crawl.
         urls_to_crawl = parse_linebreakless_url_str(body)
-        create_job(urls_to_crawl)\
+        try:
+            budget = self._get_budget(request)
+            scope = self._get_scope(
+                request, set(get_host(url) for url in urls_to_crawl))
+        except ValueError as exc:
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({
+                'message': exc.message,
+            })
+
+        create_job(urls_to_crawl, budget, scope)\
             .addCallback(self._handle_success, request)\
             .addErrback(self._handle_error, request)
         return NOT_DONE_YET
 
+    def _render_bulk_POST(self, request, input_format):
+        # Twisted closes the body once we've responded, and we've still got
+        # reading to do, so it's ours now.
+        body_file, request.content = request.content, StringIO()
+        try:
+            if input_format not in BULK_FORMATS:
+                raise ValueError("format must be one of: %s" % ', '.join(
+                    BULK_FORMATS))
+            budget = self._get_budget(request)
+            # Catch a bad scope before we go reading through the body for
+            # its seed hosts.
+            self._get_scope(request, set())
+        except ValueError as exc:
+            body_file.close()
+            request.setResponseCode(400)
+            request.setHeader('Content-Type', 'application/json')
+            return json.dumps({
+                'message': exc.message,
+            })
+
+        self._create_bulk_job(request, body_file, input_format, budget)\
+            .addCallbacks(self._handle_bulk_success, self._handle_bulk_error,
+                          callbackArgs=(request, body_file),
+                          errbackArgs=(request, body_file))
+        return NOT_DONE_YET
+
+    @inlineCallbacks
+    def _create_bulk_job(self, request, body_file, input_format, budget):
+        """
+        :rtype: Deferred
+        :returns: A Deferred that fires with a (job_data, chunks) tuple, where
+            ``chunks`` are the seeds that didn't make it into the first batch,
+            from :py:func:`iter_chunks`.
+        """
+
+        seed_hosts = set()
+        if request.args.get('scope', ['any'])[0] != 'any':
+            seed_hosts = yield get_bulk_seed_hosts(body_file, input_format)
+        scope = self._get_scope(request, seed_hosts)
+
+        chunks = iter_chunks(iter_bulk_urls(body_file, input_format))
+        first_chunk = next(chunks, set())
+        job_data = yield create_job(first_chunk, budget, scope, ingesting=True)
+        returnValue((job_data, chunks))
+
+    def _handle_bulk_success(self, result, request, body_file):
+        job_data, chunks = result
+        job_data['ingesting'] = True
+        self._handle_success(job_data, request)
+        ingest_job_urls(self.broadcast_svc, job_data['id'], chunks, body_file)\
+            .addErrback(log.err, "Bulk submission for job %s failed." % (
+                job_data['id']))
+
+    def _handle_bulk_error(self, err, request, body_file):
+        body_file.close()
+        self._handle_error(err, request)
+
+    def _get_budget(self, request):
+        """
+        :rtype: dict
+        :returns: The job's budget, as given in the query args. See
+            :py:func:`crawler.lib.data_store.create_job`.
+        :raises: ValueError if any of them aren't whole numbers, or are too
+            small to make sense.
+        """
+
+        budget = {}
+        for arg in ('max_pages', 'max_bytes', 'max_depth', 'max_seconds'):
+            if arg not in request.args:
+                continue
+            # A max_depth of 0 crawls the seeds and nothing else.
+            minimum = 0 if arg == 'max_depth' else 1
+            try:
+                value = int(request.args[arg][0])
+            except ValueError:
+                value = None
+            if value is None or value < minimum:
+                raise ValueError("%s must be an integer of at least %d." % (
+                    arg, minimum))
+            budget[arg] = value
+
+        if 'max_seconds' in budget:
+            budget['deadline'] = time.time() + budget.pop('max_seconds')
+        return budget
+
+    def _get_scope(self, request, seed_hosts):
+        """
+        :param set seed_hosts: The hosts of the job's seed URLs.
+        :rtype: dict
+        :returns: The job's scope rules, as given in the query args, or None
+            if there aren't any. See
+            :py:meth:`crawler.lib.crawl_scope.CrawlScope.to_dict`.
+        :raises: ValueError if the scope is unknown, or a regex is invalid.
+        """
+
+        strip_params = []
+        for arg in request.args.get('strip_params', []):
+            strip_params.extend(
+                name.strip() for name in arg.split(',') if name.strip())
+        # Compiling them now means we'll catch bad regexes here, rather than
+        # on every worker.
+        scope = CrawlScope(
+            mode=request.args.get('scope', ['any'])[0],
+            seed_hosts=seed_hosts,
+            include=request.args.get('include', []),
+            exclude=request.args.get('exclude', []),
+            strip_params=strip_params)
+        if scope.mode == 'any' and not (
+                scope.include or scope.exclude or scope.strip_params):
+            return None
+        return scope.to_dict()
+
     def _handle_success(self, job_data, request):
         job_json = json.dumps(job_data, cls=JobDataEncoder)
         request.write(job_json)
@@ -64,7 +226,7 @@ class JobSubmissionResource(Resource):
         if exc == ValueError:
             request.setResponseCode(400)
             error_json = json.dumps({
-                'message': exc.message,
+                'message': err.value.message,
             })
         else:
             log.err("Error encountered when creating new job.")
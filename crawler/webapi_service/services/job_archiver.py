@@ -0,0 +1,120 @@
+"""
+Keeps Redis from growing forever by archiving jobs once they're done with.
+See :py:func:`crawler.lib.data_store.archive_job`.
+"""
+
+import time
+
+from twisted.python import log
+from twisted.application.service import Service
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall
+
+from crawler.conf import JOB_ARCHIVE_SWEEP_INTERVAL, JOB_IDLE_TIMEOUT
+from crawler.lib.data_store import get_job_ids_page, get_job_summary, \
+    archive_job
+
+
+class JobArchiverService(Service):
+    """
+    Every so often, looks over the jobs that are still live in Redis, and
+    archives the ones that have finished (nothing pending or in progress) or
+    been stopped, or that haven't made any progress in a while. A job has to
+    look finished on two sweeps in a row, with nothing changed in between,
+    since a worker records its last URL as done a moment before it enqueues
+    the links it found there.
+
+    It's fine to run this on every web API instance. At worst, two of them
+    archive the same job, and the second one finds nothing left to do.
+    """
+
+    def __init__(self, interval=JOB_ARCHIVE_SWEEP_INTERVAL,
+                 idle_timeout=JOB_IDLE_TIMEOUT):
+        """
+        :param float interval: How often (in seconds) to look for jobs to
+            archive.
+        :param float idle_timeout: Archive unfinished jobs whose counters
+            haven't budged in this many seconds.
+        """
+
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        # job_id -> (counters, when they last changed). We only learn about
+        # progress by sweeping, so idleness is only accurate to a sweep.
+        self.progress = {}
+        self._sweep_loop = None
+
+    def startService(self):
+        Service.startService(self)
+        self._sweep_loop = LoopingCall(self._sweep)
+        self._sweep_loop.start(self.interval, now=False)\
+            .addErrback(log.err, "Job archiver sweep loop died.")
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._sweep_loop and self._sweep_loop.running:
+            self._sweep_loop.stop()
+
+    @inlineCallbacks
+    def _sweep(self):
+        now = time.time()
+        seen_job_ids = set()
+        archived = 0
+        cursor = 0
+        while True:
+            cursor, job_ids = yield get_job_ids_page(cursor)
+            for job_id in job_ids:
+                seen_job_ids.add(job_id)
+                try:
+                    should_archive = yield self._should_archive(job_id, now)
+                    if should_archive:
+                        archive_size = yield archive_job(job_id)
+                        if archive_size is not None:
+                            self.progress.pop(job_id, None)
+                            archived += 1
+                except Exception:
+                    log.err(None, "Failed to check or archive job %s" % job_id)
+            if not cursor:
+                break
+
+        # Forget about anything that somebody else archived.
+        for job_id in set(self.progress) - seen_job_ids:
+            del self.progress[job_id]
+        if archived:
+            log.msg("Archived %d job(s) in %.1fs." % (
+                archived, time.time() - now))
+
+    @inlineCallbacks
+    def _should_archive(self, job_id, now):
+        """
+        :param str job_id: A job's UUID4 ID string.
+        :param float now: The time this sweep started.
+        :rtype: bool
+        """
+
+        try:
+            summary = yield get_job_summary(job_id)
+        except ValueError:
+            # Its keys expired or were deleted. archive_job() will tidy up
+            # the index.
+            returnValue(True)
+        if summary.get('archived'):
+            returnValue(True)
+
+        counters = (summary['all_urls_count'], summary['crawls_pending_count'],
+                    summary['crawls_in_progress_count'],
+                    summary['crawls_completed_count'],
+                    summary['crawls_failed_count'], summary['images_count'])
+        last_counters, changed_at = self.progress.get(job_id, (None, now))
+        if counters != last_counters:
+            changed_at = now
+        self.progress[job_id] = (counters, changed_at)
+
+        if not summary['crawls_in_progress_count'] and \
+                (summary['stopped'] or not (
+                    summary['crawls_pending_count'] or summary['ingesting'])):
+            # Finished, or stopped and done with whatever was in progress.
+            # Bulk submissions may still have seeds on the way, but those
+            # count as progress, so an abandoned one still goes idle.
+            returnValue(counters == last_counters)
+        returnValue(now - changed_at >= self.idle_timeout)
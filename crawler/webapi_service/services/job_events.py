@@ -0,0 +1,52 @@
+"""
+Keeps the web API's job event hub (see
+:py:mod:`crawler.webapi_service.lib.job_events`) connected to Redis.
+"""
+
+import txredisapi
+from twisted.application.service import Service
+from twisted.internet import reactor
+
+from crawler.conf import REDIS_HOST, REDIS_PORT
+from crawler.webapi_service.lib.job_events import get_job_event_hub
+
+
+class _JobEventSubscriber(txredisapi.SubscriberProtocol):
+    """
+    Hands everything we hear over to the hub.
+    """
+
+    def connectionMade(self):
+        d = txredisapi.SubscriberProtocol.connectionMade(self)
+        d.addCallback(lambda _: get_job_event_hub().connected(self))
+        return d
+
+    def connectionLost(self, reason):
+        get_job_event_hub().disconnected()
+        return txredisapi.SubscriberProtocol.connectionLost(self, reason)
+
+    def messageReceived(self, pattern, channel, message):
+        get_job_event_hub().message_received(channel, message)
+
+
+class JobEventListenerService(Service):
+    """
+    Holds the hub's subscriber connection, reconnecting (and resubscribing)
+    if we lose Redis.
+    """
+
+    def __init__(self):
+        self.factory = None
+        self.connector = None
+
+    def startService(self):
+        Service.startService(self)
+        self.factory = txredisapi.SubscriberFactory()
+        self.factory.protocol = _JobEventSubscriber
+        self.connector = reactor.connectTCP(
+            REDIS_HOST, REDIS_PORT, self.factory)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.factory.stopTrying()
+        self.connector.disconnect()
@@ -0,0 +1,44 @@
+"""
+A Redis Streams alternative to :py:mod:`ZeroMQBroadcastService
+<crawler.webapi_service.services.zeromq>`. Announcements are appended to a
+stream that workers read through a consumer group, so nothing is lost if
+the web API or a worker restarts.
+"""
+
+from twisted.python import log
+from twisted.application.service import Service
+
+from crawler.lib.crawl_messages import count_crawl_batch
+from crawler.lib.misc_utils import log_sampled
+from crawler.lib.redis_streams import add_stream_message
+
+
+class RedisStreamBroadcastService(Service):
+    """
+    This is used by the HTTP API to hand crawl jobs off to the crawler pool.
+    There's no repeater to go with this one, since workers add their
+    delegated links to the stream themselves.
+    """
+
+    def send_message(self, message):
+        """
+        Matches the signature of ZeroMQBroadcastService so we can use them
+        interchangably in the job queue code.
+
+        :param str message: A batched crawler message.
+        """
+
+        count_crawl_batch('broadcast', 'sent', message)
+        log_sampled("Queued crawl announcement (%d bytes).", len(message))
+        add_stream_message(message).addErrback(
+            log.err, "Failed to add crawl announcement to stream.")
+
+    def get_backlog_size(self):
+        """
+        Matches the signature of ZeroMQBroadcastService. Announcements go
+        straight to Redis, so we never have any waiting.
+
+        :rtype: int
+        """
+
+        return 0
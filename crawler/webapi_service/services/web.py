@@ -1,6 +1,9 @@
 from twisted.web.server import Site
 from twisted.application import internet
 
+from crawler.conf import WEB_API_PORT
+from crawler.lib.metrics import MetricsResource
+
 from crawler.webapi_service.resources.job_detail import JobResource
 from crawler.webapi_service.resources.root import RootResource
 
@@ -9,8 +12,9 @@ def get_web_service(broadcast_svc):
 
     root = RootResource(broadcast_svc)
     root.putChild("job", JobResource(broadcast_svc))
+    root.putChild("metrics", MetricsResource())
     factory = Site(root)
     factory.amqp = broadcast_svc
     # noinspection PyUnresolvedReferences
-    webserver = internet.TCPServer(8000, factory)
+    webserver = internet.TCPServer(WEB_API_PORT, factory)
     return webserver
@@ -5,27 +5,75 @@ announcement messages.
 
 from twisted.python import log
 from twisted.application.service import Service
-from txzmq import ZmqFactory, ZmqPushConnection, ZmqEndpoint, ZmqPullConnection
+from txzmq import ZmqFactory, ZmqEndpoint, ZmqPullConnection
+
+from crawler.conf import ZMQ_BROADCAST_RETRY_INTERVAL, ZMQ_BROADCAST_BIND, \
+    ZMQ_REPEATER_BIND
+from crawler.lib import metrics
+from crawler.lib.crawl_messages import count_crawl_batch
+from crawler.lib.misc_utils import log_sampled
+from crawler.lib.zeromq import CreditRouterConnection
+from crawler.webapi_service.lib.crawl_scheduler import FairShareBacklog
+
+BROADCAST_BACKLOG = metrics.gauge(
+    'crawler_broadcast_backlog_messages',
+    "Crawl announcements waiting for a worker with room.")
+BROADCAST_CREDITS = metrics.gauge(
+    'crawler_broadcast_credits',
+    "Crawl batches workers have asked for that we haven't sent yet.")
 
 
 class ZeroMQBroadcastService(Service):
     """
     This is used by the HTTP API to hand crawl jobs off to the crawler pool.
+
+    Workers ask for work when they have room for it (see
+    :py:class:`CreditRouterConnection
+    <crawler.lib.zeromq.CreditRouterConnection>`), and we only send them
+    what they've asked for. Until someone asks, announcements wait in a
+    local backlog. The backlog is shared out fairly between jobs (see
+    :py:class:`FairShareBacklog
+    <crawler.webapi_service.lib.crawl_scheduler.FairShareBacklog>`), so a
+    big job can't starve the small ones.
     """
 
-    def __init__(self):
+    def __init__(self, bind_point=ZMQ_BROADCAST_BIND):
+        """
+        :param str bind_point: The ZeroMQ endpoint workers connect to.
+        """
+
+        self.bind_point = bind_point
         self.conn = None
+        self.backlog = None
 
     def startService(self):
         factory = ZmqFactory()
-        bind_point = 'tcp://0.0.0.0:8050'
-        log.msg("Broadcaster binding on: %s" % bind_point)
-        endpoint = ZmqEndpoint('bind', bind_point)
-        self.conn = ZmqPushConnection(factory, endpoint)
+        log.msg("Broadcaster binding on: %s" % self.bind_point)
+        endpoint = ZmqEndpoint('bind', self.bind_point)
+        self.conn = CreditRouterConnection(factory, endpoint)
+        self.backlog = FairShareBacklog(
+            self.conn, ZMQ_BROADCAST_RETRY_INTERVAL)
+        # Don't wait for the next retry once a worker asks for work.
+        self.conn.onCredit = self.backlog.wake
+        BROADCAST_BACKLOG.set_function(lambda: len(self.backlog))
+        BROADCAST_CREDITS.set_function(self.conn.get_credit_count)
+
+    def stopService(self):
+        Service.stopService(self)
+        self.backlog.stop()
 
     def send_message(self, message):
-        log.msg("Sent crawl announcement: %s" % message)
-        self.conn.push(message)
+        count_crawl_batch('broadcast', 'sent', message)
+        log_sampled("Queued crawl announcement (%d bytes).", len(message))
+        self.backlog.push(message)
+
+    def get_backlog_size(self):
+        """
+        :rtype: int
+        :returns: How many announcements are waiting to go out.
+        """
+
+        return len(self.backlog)
 
 
 class ZeroMQRepeaterService(Service):
@@ -36,19 +84,29 @@ class ZeroMQRepeaterService(Service):
     the message to the whole pool (through ZeroMQBroadcastService).
     """
 
-    def __init__(self, broadcaster_svc):
+    def __init__(self, broadcaster_svc, bind_point=ZMQ_REPEATER_BIND):
+        """
+        :param ZeroMQBroadcastService broadcaster_svc: Where we re-broadcast
+            delegated links.
+        :param str bind_point: The ZeroMQ endpoint workers delegate to.
+        """
+
         self.conn = None
         self.broadcaster_svc = broadcaster_svc
+        self.bind_point = bind_point
 
     def startService(self):
         factory = ZmqFactory()
-        bind_point = 'tcp://0.0.0.0:8051'
-        log.msg("Repeater binding on: %s" % bind_point)
-        endpoint = ZmqEndpoint('bind', bind_point)
+        log.msg("Repeater binding on: %s" % self.bind_point)
+        endpoint = ZmqEndpoint('bind', self.bind_point)
         self.conn = ZmqPullConnection(factory, endpoint)
         self.conn.onPull = self._message_received
 
     def _message_received(self, message):
-        log.msg("Repeater message received: %s" % message)
+        # Batches get passed through as-is. The broadcaster reads them to
+        # work out whose turn it is, but sends the original bytes along.
+        count_crawl_batch('repeater', 'received', message[0])
+        log_sampled("Repeater received crawl batch (%d bytes).",
+                    len(message[0]))
         # Turn around and immediately re-broadcast to the entire pool.
         self.broadcaster_svc.send_message(message[0])
@@ -0,0 +1,45 @@
+"""
+Tests for :py:mod:`crawler.webapi_service.lib.bulk_submission`. Run with::
+
+    PYTHONPATH=. python -m unittest discover tests
+"""
+
+import unittest
+from StringIO import StringIO
+
+from crawler.webapi_service.lib.bulk_submission import iter_bulk_urls
+
+
+class IterBulkUrlsTests(unittest.TestCase):
+
+    def get_urls(self, body, input_format):
+        return list(iter_bulk_urls(StringIO(body), input_format))
+
+    def test_lines(self):
+        self.assertEqual(
+            self.get_urls(
+                'http://a.com/\r\n\nnot a url\nftp://b.com/\nhttp://c.com/\n',
+                'lines'),
+            ['http://a.com/', 'http://c.com/'])
+
+    def test_ndjson(self):
+        self.assertEqual(
+            self.get_urls(
+                '"http://a.com/"\n{"url": "http://b.com/p"}\n{"u": 1}\n'
+                '[1]\nnope\n"http://c.com/caf\\u00e9"\n',
+                'ndjson'),
+            ['http://a.com/', 'http://b.com/p', 'http://c.com/caf\xc3\xa9'])
+
+    def test_cr_and_lf_are_stripped(self):
+        self.assertEqual(
+            self.get_urls(
+                '"http://a.com/x\\ny"\n{"url": "http://b.com/\\r\\nz"}\n',
+                'ndjson'),
+            ['http://a.com/xy', 'http://b.com/z'])
+        self.assertEqual(
+            self.get_urls('http://a.com/x\ry\n', 'lines'),
+            ['http://a.com/xy'])
+
+
+if __name__ == '__main__':
+    unittest.main()
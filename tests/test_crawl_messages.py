@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for :py:mod:`crawler.lib.crawl_messages`. Run with::
+
+    PYTHONPATH=. python -m unittest discover tests
+"""
+
+import unittest
+
+from crawler.lib.crawl_messages import encode_crawl_batch, decode_crawl_batch
+
+JOB_ID = '9c48b4d7-346f-4fa3-a3be-1f28aa33f5fc'
+
+
+class CrawlBatchTests(unittest.TestCase):
+
+    def round_trip(self, urls, compact):
+        return decode_crawl_batch(
+            encode_crawl_batch(JOB_ID, 2, urls, compact=compact))
+
+    def test_non_ascii_urls(self):
+        # Bulk submissions hand us UTF-8 byte strings, the parser unicode.
+        urls = ['http://c.com/caf\xc3\xa9', u'http://d.com/caf\xe9',
+                'http://e.com/']
+        for compact in (True, False):
+            self.assertEqual(
+                self.round_trip(urls, compact),
+                (JOB_ID, 2, [u'http://c.com/caf\xe9', u'http://d.com/caf\xe9',
+                             u'http://e.com/']))
+
+    def test_no_urls(self):
+        for compact in (True, False):
+            self.assertEqual(self.round_trip([], compact), (JOB_ID, 2, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for :py:mod:`crawler.lib.crawl_scope`. Run with::
+
+    PYTHONPATH=. python -m unittest discover tests
+"""
+
+import unittest
+
+from crawler.lib.crawl_scope import CrawlScope
+
+
+class NormalizeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.scope = CrawlScope(strip_params=['utm_*', 'sessionid'])
+
+    def test_non_ascii_query(self):
+        # The parser hands us unicode links.
+        self.assertEqual(
+            self.scope.normalize(u'http://a.com/p?q=caf\xe9&utm_source=x'),
+            u'http://a.com/p?q=caf\xe9')
+
+    def test_kept_params_are_untouched(self):
+        self.assertEqual(
+            self.scope.normalize(
+                'http://a.com/p?q=a%20b&x=1+2&sessionid=9&flag&utm_medium=y'
+                '#frag'),
+            'http://a.com/p?q=a%20b&x=1+2&flag')
+
+    def test_encoded_names_are_stripped(self):
+        self.assertEqual(
+            self.scope.normalize('http://a.com/p?utm%5Fsource=x&a=1'),
+            'http://a.com/p?a=1')
+
+    def test_filter_links_with_non_ascii(self):
+        scope = CrawlScope('host', ['a.com'], strip_params=['utm_*'])
+        self.assertEqual(
+            scope.filter_links([
+                u'http://a.com/caf\xe9?utm_source=x',
+                u'http://b.com/caf\xe9']),
+            set([u'http://a.com/caf\xe9']))
+
+
+if __name__ == '__main__':
+    unittest.main()
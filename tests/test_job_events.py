@@ -0,0 +1,77 @@
+"""
+Tests for :py:mod:`crawler.webapi_service.lib.job_events`. Run with::
+
+    PYTHONPATH=. python -m unittest discover tests
+"""
+
+import unittest
+
+from twisted.internet.defer import Deferred, succeed
+
+from crawler.webapi_service.lib.job_events import JobEventHub
+
+
+class FakeSubscriberProtocol(object):
+
+    def __init__(self):
+        self.subscribing = []
+
+    def subscribe(self, channel):
+        d = Deferred()
+        self.subscribing.append(d)
+        return d
+
+    def unsubscribe(self, channel):
+        return succeed(None)
+
+
+class JobEventHubTests(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = JobEventHub()
+        self.protocol = FakeSubscriberProtocol()
+        self.hub.connected(self.protocol)
+        self.results = []
+
+    def add_listener(self, listener):
+        d = self.hub.add_listener('job', listener)
+        d.addBoth(self.results.append)
+
+    def test_subscribed(self):
+        self.add_listener(len)
+        self.assertEqual(self.results, [])
+        self.protocol.subscribing[0].callback(None)
+        self.assertEqual(self.results, [None])
+        self.add_listener(repr)
+        self.assertEqual(self.results, [None, None])
+
+    def test_subscribe_failed(self):
+        self.add_listener(len)
+        self.add_listener(repr)
+        self.protocol.subscribing[0].errback(RuntimeError("nope"))
+        self.assertEqual(len(self.results), 2)
+        for result in self.results:
+            result.trap(RuntimeError)
+        self.assertEqual(self.hub.listeners, {})
+        self.assertEqual(self.hub._subscribing, {})
+
+        # The next listener tries again.
+        self.add_listener(len)
+        self.assertEqual(len(self.protocol.subscribing), 2)
+
+    def test_removed_while_subscribing(self):
+        self.add_listener(len)
+        self.hub.remove_listener('job', len)
+        self.assertEqual(self.hub._subscribing, {})
+
+        # Somebody else turns up before the first reply comes back. It
+        # mustn't fire them, since it's the second SUBSCRIBE that counts.
+        self.add_listener(repr)
+        self.protocol.subscribing[0].callback(None)
+        self.assertEqual(self.results, [])
+        self.protocol.subscribing[1].callback(None)
+        self.assertEqual(self.results, [None])
+
+
+if __name__ == '__main__':
+    unittest.main()